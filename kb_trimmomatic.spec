@@ -13,11 +13,56 @@ module kb_trimmomatic {
     
     /* using KBaseFile.PairedEndLibrary */
 
+    /*
+        input_read_library - names of the read libraries to trim, as the
+            narrative sends them.  One name trims that library; several are
+            trimmed as the lanes of one sequencing run: all of them go
+            through one Trimmomatic run into one set of output libraries and
+            one report.  The lanes must share read_type and quality
+            encoding.  A plain string, as older callers send, is still
+            accepted as a single name.
+        adapterFa - adapter FASTA file name from the Trimmomatic adapters
+            directory, or 'auto' to pick the best matching set for read_type
+            from a sample of the reads.
+        trimlog_stats - if 1, read counts and trimmed length / leading and
+            trailing cut histograms are aggregated from the Trimmomatic
+            trim log while it is written, and added to the report.
+        read_qc - if 1, per position quality quantiles, base composition,
+            length distribution and N content of the input and the trimmed
+            reads are added to the report.
+        remove_duplicates - if 1, exact duplicate reads (for paired reads,
+            pairs whose forward and reverse sequences both repeat an earlier
+            pair) are removed before trimming and the duplicate rate is
+            added to the report.
+        screen_contaminants - if 1, reads whose k-mers mostly match the
+            bundled contaminant sequences (PhiX, UniVec_Core) are removed
+            before trimming and counted in the report; for paired reads a
+            pair is removed when either mate matches.
+        keep_contaminants - if 1 (with screen_contaminants), the removed
+            reads are saved as an extra library named
+            output_read_library + '_contaminants'.
+        downsample_reads, downsample_fraction, downsample_coverage -
+            optional, at most one of them: keep about this many reads
+            (pairs for paired end reads), this fraction of the reads, or
+            enough reads for this coverage of a genome of genome_size bases.
+            Reads are selected by a hash of their name before trimming, so
+            mates stay together and the subset is reproducible.
+        staged_reads - optional, read files already on storage shared with
+            the service, used instead of the files of input_read_library:
+            one file (single end or interleaved) or forward and reverse.
+            Each is a file:// URL or a path in the user's staging area and
+            must be under a directory the deployment allows.
+        quality_binning - optional, 'illumina8' or 'illumina4' to bin the
+            quality scores of the trimmed reads to Illumina's 8 or 4 levels
+            as they are written, which makes them compress much better;
+            'none' or empty keeps them.  The gzip'd size of a sample of the
+            outputs before and after binning is added to the report.
+    */
     typedef structure {
         workspace_name input_ws;
         workspace_name output_ws;
         string read_type;
-        string input_read_library;
+        list<string> input_read_library;
         string adapterFa;
         int seed_mismatches;
         int palindrome_clip_threshold;
@@ -31,6 +76,17 @@ module kb_trimmomatic {
         int head_crop_length;
         int min_length;
         string output_read_library;
+        int trimlog_stats;
+        int read_qc;
+        int remove_duplicates;
+        int screen_contaminants;
+        int keep_contaminants;
+        int downsample_reads;
+        float downsample_fraction;
+        float downsample_coverage;
+        int genome_size;
+        list<string> staged_reads;
+        string quality_binning;
     } TrimmomaticInput;
 
     typedef structure {
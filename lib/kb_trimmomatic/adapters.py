@@ -0,0 +1,156 @@
+"""
+Adapter set detection from a read sample.
+
+A k-mer index is built once over every adapter FASTA in the Trimmomatic
+adapter directory (both strands of every sequence) and cached on disk,
+keyed by the names, sizes and modification times of the FASTA files.
+detect() scans sample reads against it and picks the adapter set whose
+k-mers occur in the most reads.
+"""
+import glob
+import hashlib
+import os
+import pickle
+import re
+
+DEFAULT_K = 16
+# fraction of sampled reads that must contain an adapter k-mer
+DEFAULT_MIN_FRACTION = 0.002
+
+_COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+_loaded = {}
+
+
+def _reverse_complement(sequence):
+    return ''.join(_COMPLEMENT.get(base, 'N') for base in reversed(sequence))
+
+
+def read_fasta(path):
+    sequences = []
+    current = []
+    with open(path) as fasta:
+        for line in fasta:
+            line = line.strip()
+            if line.startswith('>'):
+                if current:
+                    sequences.append(''.join(current).upper())
+                current = []
+            elif line:
+                current.append(line)
+    if current:
+        sequences.append(''.join(current).upper())
+    return sequences
+
+
+class AdapterIndex(object):
+    '''
+    kmers maps every adapter k-mer to a bit mask over adapter_sets, the
+    sorted list of adapter FASTA file names.
+    '''
+
+    def __init__(self, adapter_sets, kmers, k, fingerprint):
+        self.adapter_sets = adapter_sets
+        self.kmers = kmers
+        self.k = k
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def fingerprint_dir(adapter_dir, k):
+        digest = hashlib.md5(str(k).encode('ascii'))
+        for path in sorted(glob.glob(os.path.join(adapter_dir, '*.fa'))):
+            st = os.stat(path)
+            digest.update(('%s:%d:%d;' % (os.path.basename(path), st.st_size,
+                                          int(st.st_mtime))).encode('utf-8'))
+        return digest.hexdigest()
+
+    @classmethod
+    def build(cls, adapter_dir, k=DEFAULT_K):
+        paths = sorted(glob.glob(os.path.join(adapter_dir, '*.fa')))
+        if not paths:
+            raise ValueError('No adapter FASTA files found in ' + adapter_dir)
+        adapter_sets = [os.path.basename(path) for path in paths]
+        kmers = {}
+        for bit, path in enumerate(paths):
+            for sequence in read_fasta(path):
+                for strand in (sequence, _reverse_complement(sequence)):
+                    for i in range(len(strand) - k + 1):
+                        kmer = strand[i:i + k]
+                        kmers[kmer] = kmers.get(kmer, 0) | (1 << bit)
+        return cls(adapter_sets, kmers, k, cls.fingerprint_dir(adapter_dir, k))
+
+    @classmethod
+    def load(cls, adapter_dir, cache_dir, k=DEFAULT_K):
+        '''Return the index for adapter_dir, from memory, the disk cache or built fresh.'''
+        fingerprint = cls.fingerprint_dir(adapter_dir, k)
+        if fingerprint in _loaded:
+            return _loaded[fingerprint]
+        cache_path = os.path.join(cache_dir, 'adapter_index_' + fingerprint + '.pickle')
+        index = None
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'rb') as cache:
+                    index = pickle.load(cache)
+            except Exception:
+                index = None
+        if index is None:
+            index = cls.build(adapter_dir, k)
+            tmp_path = cache_path + '.' + str(os.getpid())
+            with open(tmp_path, 'wb') as cache:
+                pickle.dump(index, cache, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, cache_path)
+        _loaded[fingerprint] = index
+        return index
+
+    def count_hits(self, sequences):
+        '''Number of sequences containing at least one k-mer of each adapter set.'''
+        hits = [0] * len(self.adapter_sets)
+        k = self.k
+        kmers = self.kmers
+        for sequence in sequences:
+            mask = 0
+            for i in range(len(sequence) - k + 1):
+                found = kmers.get(sequence[i:i + k])
+                if found:
+                    mask |= found
+            if mask:
+                for bit in range(len(hits)):
+                    if mask & (1 << bit):
+                        hits[bit] += 1
+        return hits
+
+    def detect(self, sequences, read_type, min_fraction=DEFAULT_MIN_FRACTION):
+        '''
+        Returns (adapter file name or None, evidence dict).  Only sets meant
+        for read_type (-PE.fa or -SE.fa, or a numbered variant such as
+        TruSeq3-PE-2.fa) are considered.
+        '''
+        sequences = [s.decode('ascii') if isinstance(s, bytes) else s for s in sequences]
+        sequences = [s.upper() for s in sequences]
+        hits = self.count_hits(sequences)
+        meant_for = re.compile(r'-' + re.escape(read_type) + r'(-\d+)?\.fa$')
+        total = len(sequences)
+        candidates = [(hits[i], name) for i, name in enumerate(self.adapter_sets)
+                      if meant_for.search(name)]
+        evidence = {'reads_scanned': total,
+                    'k': self.k,
+                    'min_fraction': min_fraction,
+                    'reads_with_adapter': dict((name, hits[i]) for i, name
+                                               in enumerate(self.adapter_sets))}
+        best = None
+        if candidates and total:
+            # most hits wins; ties go to the alphabetically first set, which
+            # keeps the choice deterministic
+            count, name = sorted(candidates, key=lambda c: (-c[0], c[1]))[0]
+            if float(count) / total >= min_fraction:
+                best = name
+        evidence['selected'] = best
+        return best, evidence
+
+
+def describe(evidence):
+    total = evidence['reads_scanned'] or 1
+    parts = ['%s %d (%.2f%%)' % (name, count, 100.0 * count / total)
+             for name, count in sorted(evidence['reads_with_adapter'].items())]
+    return ('adapter detection: %s selected from %d sampled reads; reads with adapter k-mers: %s'
+            % (evidence['selected'] or 'no adapter set', evidence['reads_scanned'], ', '.join(parts)))
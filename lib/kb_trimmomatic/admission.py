@@ -0,0 +1,350 @@
+"""
+Admission control for the runTrimmomatic jobs of a node.
+
+Nothing used to limit how many jobs ran at once: a burst of requests started
+them all, and together they oversubscribed the CPUs, the memory and the
+scratch space of the node.  Every job now asks for admission once the sizes
+of its inputs are known and before it downloads anything, with an estimate
+of what it will use:
+
+    cpus    the threads Trimmomatic runs with, times the Trimmomatic
+            processes a sharded job starts on the node
+    memory  the Java heap and the JVM beyond its heap of every one of those
+            processes, the job process and the Bloom filter of the
+            remove_duplicates stage
+    disk    the peak scratch use (jobdir.estimate_scratch_bytes)
+
+A job is admitted when its cost fits in what the running jobs leave of the
+node's budgets, rejected when it could never fit or when too many jobs are
+waiting already, and otherwise waits for the jobs ahead of it.  Small jobs
+(inputs up to small_job_bytes) wait ahead of larger ones, and any job may
+start before a job ahead of it that does not fit yet; a large job waiting
+longer than aging seconds counts as small and holds back the jobs behind it
+until it fits, so a stream of small jobs cannot starve it.  A job waiting
+longer than max_wait seconds is rejected.
+
+The server processes and the async job processes of a node share the
+controller through a ledger file of running and waiting jobs, read and
+written under an exclusive lock; the file has to be on storage every
+container of the node mounts.  Entries are keyed by the host name (the
+container) and the job.  A job renews its entry while it waits and, from a
+heartbeat thread, while it runs; an entry not renewed for lease seconds
+belonged to a job that is gone and is dropped whenever the ledger is read, so
+a killed job does not hold on to its share.  Process ids are never compared,
+they mean nothing across the PID namespaces of containers.  The disk budget
+is planned capacity: the job directory reservation still checks the space
+actually free when the job starts.
+"""
+import fcntl
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+
+from kb_trimmomatic import metrics
+from kb_trimmomatic.jobdir import estimate_scratch_bytes
+
+DEFAULT_MAX_QUEUE = 100
+DEFAULT_MAX_WAIT = 3600
+DEFAULT_SMALL_JOB_BYTES = 1 << 30
+DEFAULT_AGING = 1800
+DEFAULT_POLL = 1.0
+DEFAULT_LEASE = 120
+
+# resident memory of a JVM beyond its heap: metaspace, thread stacks, code cache
+JVM_OVERHEAD = 256 << 20
+# resident memory of the job process itself: transfer buffers, pipes, read QC
+PROCESS_MEMORY = 256 << 20
+
+
+class AdmissionRejected(ValueError):
+    pass
+
+
+Cost = namedtuple('Cost', ['cpus', 'memory', 'disk', 'input_bytes'])
+
+
+def node_cpus():
+    return multiprocessing.cpu_count()
+
+
+def node_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def disk_capacity(path):
+    st = os.statvfs(path)
+    return st.f_blocks * st.f_frsize
+
+
+def estimate_cost(input_sizes, compressed, threads, heap_bytes, copied=True, extra_memory=0, trimmers=1):
+    '''
+    Cost of a job reading input_sizes bytes with trimmers Trimmomatic
+    processes on this node (the local scatter workers of a sharded job),
+    each on threads threads and a heap of heap_bytes, 0 for the JVM default
+    (a quarter of the node's memory).  extra_memory is what optional stages
+    hold on top.
+    '''
+    heap = heap_bytes or node_memory() // 4
+    trimmers = max(int(trimmers), 1)
+    return Cost(cpus=max(int(threads), 1) * trimmers,
+                memory=int((heap + JVM_OVERHEAD) * trimmers + PROCESS_MEMORY + extra_memory),
+                disk=estimate_scratch_bytes(input_sizes, compressed, copied=copied),
+                input_bytes=int(sum(input_sizes)))
+
+
+class AdmissionController(object):
+    '''
+    ledger          -- JSON file shared by the processes of the node
+    cpus, memory,   -- budgets of all admitted jobs together, in CPUs and
+    disk               bytes
+    max_queue       -- waiting jobs beyond which new jobs are rejected, 0 for
+                       no limit
+    max_wait        -- seconds a job waits before it is rejected, 0 for no limit
+    small_job_bytes -- input size up to which a job waits ahead of larger ones
+    aging           -- seconds after which a waiting large job counts as small
+    lease           -- seconds an entry lives without being renewed by its job
+    enabled         -- False admits every job at once
+    '''
+
+    def __init__(self, ledger, cpus, memory, disk, max_queue=DEFAULT_MAX_QUEUE, max_wait=DEFAULT_MAX_WAIT,
+                 small_job_bytes=DEFAULT_SMALL_JOB_BYTES, aging=DEFAULT_AGING, poll=DEFAULT_POLL,
+                 lease=DEFAULT_LEASE, enabled=True):
+        self.ledger = ledger
+        self.lease = lease
+        self.budget = {'cpus': cpus, 'memory': memory, 'disk': disk}
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.small_job_bytes = small_job_bytes
+        self.aging = aging
+        self.poll = poll
+        self.enabled = enabled
+
+    def _update(self, change):
+        # change(ledger, now) under the lock; the ledger is written back when it returns True
+        directory = os.path.dirname(self.ledger)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        with open(self.ledger + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.ledger) as f:
+                    ledger = json.load(f)
+            except (IOError, OSError, ValueError):
+                ledger = {}
+            ledger.setdefault('running', {})
+            ledger.setdefault('waiting', {})
+            now = time.time()
+            pruned = False
+            for jobs in ledger.values():
+                for key, entry in list(jobs.items()):
+                    if now - entry.get('beat', 0) > self.lease:
+                        del jobs[key]
+                        pruned = True
+            result = change(ledger, now)
+            if result or pruned:
+                tmp_path = self.ledger + '.' + str(os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(ledger, f)
+                os.rename(tmp_path, self.ledger)
+            return result
+
+    def _fits(self, entry, running):
+        for resource, budget in self.budget.items():
+            if sum(job[resource] for job in running.values()) + entry[resource] > budget:
+                return False
+        return True
+
+    def _rank(self, entry, now):
+        aged = now - entry['since'] >= self.aging
+        small = entry['input_bytes'] <= self.small_job_bytes
+        return (0 if small or aged else 1, entry['since']), aged
+
+    def _key(self, job_id):
+        # job ids are only unique within the container that made them
+        return socket.gethostname() + '/' + job_id
+
+    def _try_admit(self, job_id, ledger, now):
+        # True when job_id may start now: it fits, and no job ranked ahead of
+        # it either fits too or has waited long enough to hold the rest back
+        running, waiting = ledger['running'], ledger['waiting']
+        key = self._key(job_id)
+        entry = waiting[key]
+        entry['beat'] = now
+        rank, _ = self._rank(entry, now)
+        for other_key, other in waiting.items():
+            if other_key == key:
+                continue
+            other_rank, aged = self._rank(other, now)
+            if other_rank < rank and (aged or self._fits(other, running)):
+                return False
+        if not self._fits(entry, running):
+            return False
+        running[key] = waiting.pop(key)
+        return True
+
+    def state(self):
+        '''Running and waiting jobs of the node and the share of the budgets in use.'''
+        summary = {}
+
+        def read(ledger, now):
+            summary['running'] = len(ledger['running'])
+            summary['waiting'] = len(ledger['waiting'])
+            for resource, budget in self.budget.items():
+                summary[resource + '_used'] = sum(job[resource] for job in ledger['running'].values())
+                summary[resource + '_budget'] = budget
+            return False
+
+        self._update(read)
+        return summary
+
+    def admit(self, job_id, cost, log=None):
+        '''
+        Wait until the job may start, and return the seconds it waited.
+        Raises AdmissionRejected when it is turned away.
+        '''
+        if not self.enabled:
+            return 0.0
+        for resource, budget in self.budget.items():
+            if getattr(cost, resource) > budget:
+                metrics.ADMISSIONS.inc(outcome='rejected')
+                raise AdmissionRejected(
+                    'This job needs more %s than this node has for all jobs together '
+                    '(%d needed, %d available)' % (resource, getattr(cost, resource), budget))
+        key = self._key(job_id)
+        now = time.time()
+        entry = dict(cost._asdict(), since=now, beat=now)
+        position = {}
+
+        def enqueue(ledger, now):
+            if self.max_queue and len(ledger['waiting']) >= self.max_queue:
+                position['rejected'] = len(ledger['waiting'])
+                return False
+            ledger['waiting'][key] = entry
+            if self._try_admit(job_id, ledger, now):
+                return True
+            position['ahead'] = len(ledger['waiting']) - 1
+            position['running'] = len(ledger['running'])
+            return True
+
+        self._update(enqueue)
+        if 'rejected' in position:
+            metrics.ADMISSIONS.inc(outcome='rejected')
+            raise AdmissionRejected('Too many jobs are waiting on this node (%d), try again later'
+                                    % position['rejected'])
+        if 'ahead' not in position:
+            metrics.ADMISSIONS.inc(outcome='admitted')
+            metrics.ADMISSION_WAIT.observe(0.0, outcome='admitted')
+            return 0.0
+
+        if log is not None:
+            log('Waiting for the %d running and %d queued jobs on this node to leave room for this one'
+                % (position['running'], position['ahead']))
+        state = {}
+
+        def attempt(ledger, now):
+            # the entry is renewed (put back, if its lease ran out) whether or not the job gets in
+            ledger['waiting'].setdefault(key, entry)
+            state['admitted'] = self._try_admit(job_id, ledger, now)
+            return True
+
+        metrics.ADMISSION_WAITING.inc()
+        admitted = False
+        try:
+            while True:
+                time.sleep(self.poll)
+                self._update(attempt)
+                if state['admitted']:
+                    admitted = True
+                    break
+                if self.max_wait and time.time() - entry['since'] >= self.max_wait:
+                    break
+        finally:
+            metrics.ADMISSION_WAITING.dec()
+            if not admitted:
+                self._update(lambda ledger, now: ledger['waiting'].pop(key, None) is not None)
+        waited = time.time() - entry['since']
+        if not admitted:
+            metrics.ADMISSIONS.inc(outcome='rejected')
+            metrics.ADMISSION_WAIT.observe(waited, outcome='rejected')
+            raise AdmissionRejected('This job waited %d s for room on this node, try again later' % waited)
+        metrics.ADMISSIONS.inc(outcome='admitted')
+        metrics.ADMISSION_WAIT.observe(waited, outcome='admitted')
+        if log is not None:
+            log('Admitted after waiting %.1f s' % waited)
+        return waited
+
+    def heartbeat(self, job_id):
+        '''Renew the entry of a running job.'''
+        key = self._key(job_id)
+
+        def renew(ledger, now):
+            entry = ledger['running'].get(key)
+            if entry is not None:
+                entry['beat'] = now
+            return entry is not None
+
+        if self.enabled:
+            self._update(renew)
+
+    def release(self, job_id):
+        key = self._key(job_id)
+        if self.enabled:
+            self._update(lambda ledger, now: ledger['running'].pop(key, None) is not None
+                         or ledger['waiting'].pop(key, None) is not None)
+
+    def slot(self, job_id):
+        return Slot(self, job_id)
+
+
+class Slot(object):
+    '''
+    A job's place with the controller, renewed while the job runs and
+    released when the block ends:
+
+        with controller.slot(job_id) as slot:
+            ... slot.admit(cost) ...
+    '''
+
+    def __init__(self, controller, job_id):
+        self.controller = controller
+        self.job_id = job_id
+        self.cost = None
+        self.waited = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def admit(self, cost, log=None):
+        self.cost = cost
+        self.waited = self.controller.admit(self.job_id, cost, log)
+        if self.controller.enabled:
+            self._thread = threading.Thread(target=self._beat, name='admission-heartbeat')
+            self._thread.daemon = True
+            self._thread.start()
+        return self.waited
+
+    def _beat(self):
+        while not self._stop.wait(self.controller.lease / 4.0):
+            try:
+                self.controller.heartbeat(self.job_id)
+            except Exception:
+                # a missed beat is retried; the lease outlasts several
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.cost is not None:
+            self.controller.release(self.job_id)
+        return False
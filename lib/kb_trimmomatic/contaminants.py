@@ -0,0 +1,186 @@
+"""
+Screening reads against a contaminant k-mer index.
+
+Spike-in PhiX and cloning vector reads survive trimming and then cost upload
+and assembly time.  The screen looks for them with an index of every
+canonical k-mer (the smaller 2-bit code of a k-mer and its reverse
+complement) of the contaminant FASTA files bundled with the module, the PhiX
+genome and UniVec_Core (see the Dockerfile).
+
+The index is built once, written to the index cache directory as a sorted
+array of uint64 codes with a bit mask of the FASTA files each k-mer occurs
+in, and memory mapped read-only, so every worker process on a node shares
+the same pages.  Reads are screened in batches: the k-mer codes of a whole
+batch are computed with NumPy and looked up with one searchsorted call.
+
+A read is a contaminant when at least min_fraction of its k-mers are in the
+index, which keeps reads that only end in a stretch of adapter (UniVec
+includes the common adapters) out of the contaminant output.
+"""
+import glob
+import hashlib
+import os
+
+import numpy as np
+
+DEFAULT_K = 31
+DEFAULT_MIN_FRACTION = 0.5
+FASTA_PATTERNS = ('*.fa', '*.fasta', '*.fna')
+
+# byte value -> 2-bit base code, 4 for anything that is not ACGT
+_BASE_CODE = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate('ACGT'):
+    _BASE_CODE[ord(_base)] = _code
+    _BASE_CODE[ord(_base.lower())] = _code
+
+_TWO = np.uint64(2)
+_THREE = np.uint64(3)
+
+_loaded = {}
+
+
+def fasta_paths(fasta_dir):
+    paths = set()
+    for pattern in FASTA_PATTERNS:
+        paths.update(glob.glob(os.path.join(fasta_dir, pattern)))
+    return sorted(paths)
+
+
+def read_fasta(path):
+    sequences = []
+    current = []
+    with open(path, 'rb') as fasta:
+        for line in fasta:
+            line = line.strip()
+            if line.startswith(b'>'):
+                if current:
+                    sequences.append(b''.join(current))
+                current = []
+            elif line:
+                current.append(line)
+    if current:
+        sequences.append(b''.join(current))
+    return sequences
+
+
+def kmer_codes(sequences, k):
+    '''
+    Canonical codes of all k-mers of sequences, in one pass over their
+    concatenation.  Returns (codes, valid, starts): the code of the k-mer
+    starting at every position of the concatenation, whether that k-mer is
+    made of ACGT only and lies within one sequence, and the position each
+    sequence starts at.
+    '''
+    joined = b'N'.join(sequences)
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(lengths + 1)[:-1])) if len(sequences) else lengths
+    windows = len(joined) - k + 1
+    if windows <= 0:
+        empty = np.zeros(0, dtype=np.uint64)
+        return empty, np.zeros(0, dtype=bool), starts
+    bases = _BASE_CODE[np.frombuffer(joined, dtype=np.uint8)]
+    invalid = np.concatenate(([0], np.cumsum(bases == 4)))
+    valid = invalid[k:] - invalid[:-k] == 0
+    codes = bases.astype(np.uint64) & _THREE
+    forward = np.zeros(windows, dtype=np.uint64)
+    reverse = np.zeros(windows, dtype=np.uint64)
+    for j in range(k):
+        window = codes[j:j + windows]
+        forward = (forward << _TWO) | window
+        reverse |= (_THREE - window) << np.uint64(2 * j)
+    return np.minimum(forward, reverse), valid, starts
+
+
+class ContaminantIndex(object):
+    '''
+    kmers   -- sorted canonical k-mer codes
+    sources -- for every k-mer a bit mask over names, the FASTA file names
+    '''
+
+    def __init__(self, names, kmers, sources, k, fingerprint):
+        self.names = names
+        self.kmers = kmers
+        self.sources = sources
+        self.k = k
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def fingerprint_dir(fasta_dir, k):
+        digest = hashlib.md5(str(k).encode('ascii'))
+        for path in fasta_paths(fasta_dir):
+            st = os.stat(path)
+            digest.update(('%s:%d:%d;' % (os.path.basename(path), st.st_size,
+                                          int(st.st_mtime))).encode('utf-8'))
+        return digest.hexdigest()
+
+    @classmethod
+    def build(cls, fasta_dir, k=DEFAULT_K):
+        paths = fasta_paths(fasta_dir)
+        if not paths:
+            raise ValueError('No contaminant FASTA files found in ' + fasta_dir)
+        if len(paths) > 8:
+            raise ValueError('At most 8 contaminant FASTA files are supported, found %d in %s'
+                             % (len(paths), fasta_dir))
+        all_codes = []
+        all_sources = []
+        for bit, path in enumerate(paths):
+            codes, valid, _ = kmer_codes(read_fasta(path), k)
+            codes = np.unique(codes[valid])
+            all_codes.append(codes)
+            all_sources.append(np.full(len(codes), 1 << bit, dtype=np.uint8))
+        codes = np.concatenate(all_codes)
+        kmers, inverse = np.unique(codes, return_inverse=True)
+        sources = np.zeros(len(kmers), dtype=np.uint8)
+        np.bitwise_or.at(sources, inverse, np.concatenate(all_sources))
+        return cls([os.path.basename(path) for path in paths], kmers, sources, k,
+                   cls.fingerprint_dir(fasta_dir, k))
+
+    @classmethod
+    def load(cls, fasta_dir, cache_dir, k=DEFAULT_K):
+        '''Return the index for fasta_dir, from memory, the memory mapped cache or built fresh.'''
+        fingerprint = cls.fingerprint_dir(fasta_dir, k)
+        if fingerprint in _loaded:
+            return _loaded[fingerprint]
+        base = os.path.join(cache_dir, 'contaminant_index_' + fingerprint)
+        if not (os.path.exists(base + '.kmers') and os.path.exists(base + '.sources')):
+            index = cls.build(fasta_dir, k)
+            # written under temporary names, so a concurrent loader never maps a partial file
+            for suffix, array in (('.sources', index.sources), ('.kmers', index.kmers)):
+                tmp_path = base + suffix + '.' + str(os.getpid())
+                array.astype(array.dtype.newbyteorder('<')).tofile(tmp_path)
+                os.rename(tmp_path, base + suffix)
+        names = [os.path.basename(path) for path in fasta_paths(fasta_dir)]
+        index = cls(names, np.memmap(base + '.kmers', dtype='<u8', mode='r'),
+                    np.memmap(base + '.sources', dtype=np.uint8, mode='r'), k, fingerprint)
+        _loaded[fingerprint] = index
+        return index
+
+    def matches(self, sequences, min_fraction=DEFAULT_MIN_FRACTION):
+        '''
+        For every sequence the bit mask over names of the contaminants it
+        matches, 0 for a clean sequence.
+        '''
+        masks = np.zeros(len(sequences), dtype=np.uint8)
+        codes, valid, starts = kmer_codes(sequences, self.k)
+        if not len(codes) or not len(self.kmers):
+            return masks.tolist()
+        positions = np.searchsorted(self.kmers, codes)
+        np.minimum(positions, len(self.kmers) - 1, out=positions)
+        hit = valid & (self.kmers[positions] == codes)
+        read = np.searchsorted(starts, np.arange(len(codes)), side='right') - 1
+        kmers_per_read = np.bincount(read[valid], minlength=len(sequences))
+        hits_per_read = np.bincount(read[hit], minlength=len(sequences))
+        contaminated = (hits_per_read > 0) & (hits_per_read >= min_fraction * kmers_per_read)
+        np.bitwise_or.at(masks, read[hit], self.sources[positions[hit]])
+        masks[~contaminated] = 0
+        return masks.tolist()
+
+
+def describe(result):
+    '''Report line for the checkpointed result of a read filter pass that screened for contaminants.'''
+    unit = 'read pairs' if result['paired'] else 'reads'
+    examined = result['reads'] - result.get('sampled_out', 0)
+    rate = 100.0 * result['contaminants'] / examined if examined else 0.0
+    parts = ['%s %d' % (name, count) for name, count in sorted(result['contaminant_sources'].items())]
+    return ('Contaminants removed: %d of %d %s (%.2f%%); %s'
+            % (result['contaminants'], examined, unit, rate, ', '.join(parts) or 'none'))
@@ -0,0 +1,77 @@
+"""
+Removal of exact duplicate reads before trimming.
+
+PCR heavy libraries carry many exact copies of the same fragment, and every
+copy costs Trimmomatic, the uploads and each assembler downstream.  With
+remove_duplicates, the read filter pass over the staged inputs (see
+readfilter.py) keeps the first occurrence of every read sequence.  Paired
+reads are hashed as a pair, forward and reverse sequence together, so a pair
+is only dropped when both mates repeat an earlier pair.
+
+Seen reads are remembered in a Bloom filter of fixed size, so memory stays
+within the configured cap whatever the size of the library.  The price is
+that a few unique reads are taken for duplicates: the filter is sized for
+the expected number of reads, and its estimated false positive rate is
+reported next to the duplicate rate.
+"""
+import hashlib
+import math
+import struct
+
+DEFAULT_ERROR_RATE = 1e-4
+MAX_HASHES = 16
+
+
+class BloomFilter(object):
+
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self.count = 0
+        self._array = bytearray((bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, max_bytes, error_rate=DEFAULT_ERROR_RATE):
+        '''
+        A filter for about capacity keys at error_rate, or the best one that
+        fits in max_bytes.
+        '''
+        capacity = max(int(capacity), 1)
+        bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        bits = max(min(bits, int(max_bytes) * 8), 64)
+        hashes = int(round(float(bits) / capacity * math.log(2)))
+        return cls(bits, min(max(hashes, 1), MAX_HASHES))
+
+    @property
+    def nbytes(self):
+        return len(self._array)
+
+    def add(self, key):
+        '''Add key; True if it was (probably) added before.'''
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        array = self._array
+        present = True
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) % self.bits
+            mask = 1 << (bit & 7)
+            if not array[bit >> 3] & mask:
+                present = False
+                array[bit >> 3] |= mask
+        if not present:
+            self.count += 1
+        return present
+
+    def false_positive_rate(self):
+        '''Estimated chance that a new key is taken for one already added.'''
+        return (1 - math.exp(-float(self.hashes) * self.count / self.bits)) ** self.hashes
+
+
+def describe(result):
+    '''Report line for the checkpointed result of a read filter pass that removed duplicates.'''
+    unit = 'read pairs' if result['paired'] else 'reads'
+    # the rate among the reads that were looked at, after sampling
+    examined = result['reads'] - result.get('sampled_out', 0)
+    rate = 100.0 * result['duplicates'] / examined if examined else 0.0
+    return ('Duplicates removed: %d of %d %s (%.1f%%); %.1f MB Bloom filter, estimated false positive rate %.2g'
+            % (result['duplicates'], examined, unit, rate, result['filter_bytes'] / 1048576.0,
+               result['false_positive_rate']))
@@ -0,0 +1,94 @@
+"""
+Resolution of staged read files on shared storage.
+
+On deployments where the worker nodes see a shared filesystem, reads that
+are already there can be given as staged_reads instead of being downloaded
+from Shock.  A location is either
+
+    file:///absolute/path/reads.fastq.gz
+    a path relative to the user's staging area, <staging-root>/<user>/...
+
+and is only accepted when, with symlinks resolved, it lies under one of the
+allow-listed roots of the deployment.  Anything under the staging root must
+also lie in the user's own staging area, whichever form it was given in, so
+neither '../other_user/reads.fastq' nor a file:// URL into another user's
+area reads someone else's files.  Resolved files are read in place by
+the sniffer, the read QC and Trimmomatic; they are never copied into, or
+deleted from, the job directory.
+
+A resolved file is represented like a Shock handle, as a dict, but with a
+'path' key instead of 'url' and 'id'.
+"""
+import os
+
+FILE_SCHEME = 'file://'
+
+
+def parse_roots(value):
+    '''Comma separated list of directories from the deployment config.'''
+    return [root.strip() for root in (value or '').split(',') if root.strip()]
+
+
+def _inside(path, root):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+class InputResolver(object):
+    '''
+    allowed_roots -- directories staged files may be read from
+    staging_root  -- directory holding one staging area per user name
+    '''
+
+    def __init__(self, allowed_roots, staging_root=None):
+        self.allowed_roots = [os.path.realpath(root) for root in allowed_roots]
+        self.staging_root = os.path.realpath(staging_root) if staging_root else None
+
+    @property
+    def enabled(self):
+        return bool(self.allowed_roots)
+
+    def resolve(self, location, user):
+        if not self.enabled:
+            raise ValueError('Staged input files are not enabled on this deployment')
+        if location.startswith(FILE_SCHEME):
+            path = location[len(FILE_SCHEME):]
+            if not os.path.isabs(path):
+                raise ValueError('Staged input ' + location + ' is not an absolute file:// URL')
+        else:
+            if self.staging_root is None or not user:
+                raise ValueError('Staged input ' + location + ' is not a file:// URL and there is '
+                                 'no staging area to resolve it in')
+            if os.path.isabs(location):
+                raise ValueError('Staging area path ' + location + ' must be relative')
+            path = os.path.join(self.staging_root, user, location)
+        path = os.path.realpath(path)
+        if not any(_inside(path, root) for root in self.allowed_roots):
+            raise ValueError('Staged input ' + location + ' is outside the allowed input directories')
+        if self.staging_root is not None and _inside(path, self.staging_root):
+            own_area = self.staging_area(user)
+            if own_area is None or not _inside(path, own_area):
+                raise ValueError('Staged input ' + location + ' is outside your staging area')
+        if not os.path.isfile(path):
+            raise ValueError('Staged input ' + location + ' does not exist')
+        return path
+
+    def staging_area(self, user):
+        '''The real path of the staging area of user, None for an unusable user name.'''
+        if not user or user in ('.', '..') or os.sep in user or (os.altsep and os.altsep in user):
+            return None
+        return os.path.realpath(os.path.join(self.staging_root, user))
+
+    def handles(self, locations, user):
+        '''Local handles for the staged_reads parameter: [forward] or [forward, reverse].'''
+        if not 1 <= len(locations) <= 2:
+            raise ValueError('staged_reads takes one file (single end or interleaved) or two '
+                             '(forward and reverse)')
+        handles = []
+        for location in locations:
+            path = self.resolve(location, user)
+            handles.append({'path': path, 'file_name': os.path.basename(path)})
+        return handles
+
+
+def is_local(handle):
+    return 'path' in handle
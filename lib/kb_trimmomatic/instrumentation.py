@@ -0,0 +1,203 @@
+"""
+Per-phase instrumentation for runTrimmomatic.
+
+A JobTrace collects one span per pipeline phase (download, deinterleave,
+trim, upload, report) with wall and CPU time, bytes moved, reads processed
+and the peak resident set size seen so far.  Every finished span is appended
+to a JSON-lines trace file so a slow job can be diagnosed after the fact, and
+the collected spans are summarised for the report and the provenance.
+"""
+import json
+import os
+import resource
+import time
+import uuid
+from contextlib import contextmanager
+
+
+def _cpu_seconds():
+    # children are included so the Java and ws-tools subprocesses are
+    # accounted for once they have been waited on
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _peak_rss_kb():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return max(own.ru_maxrss, children.ru_maxrss)
+
+
+def file_size(path):
+    # sizes of missing files count as zero so a failed step can still be
+    # recorded
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class PhaseSpan(object):
+    '''
+    Measurements for a single phase.  bytes_in, bytes_out and reads are
+    filled in by the code running the phase, everything else is measured.
+    '''
+
+    def __init__(self, job_id, name):
+        self.job_id = job_id
+        self.name = name
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.reads = 0
+        self.attributes = {}
+        self.status = 'ok'
+        self.start_time = time.time()
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_kb = 0
+        self._wall_start = self.start_time
+        self._cpu_start = _cpu_seconds()
+
+    def finish(self, status='ok'):
+        self.status = status
+        self.wall_seconds = time.time() - self._wall_start
+        self.cpu_seconds = _cpu_seconds() - self._cpu_start
+        self.peak_rss_kb = _peak_rss_kb()
+
+    def reads_per_second(self):
+        if self.wall_seconds <= 0:
+            return 0.0
+        return self.reads / self.wall_seconds
+
+    def to_dict(self):
+        return {'job_id': self.job_id,
+                'phase': self.name,
+                'status': self.status,
+                'start_time': self.start_time,
+                'wall_seconds': round(self.wall_seconds, 6),
+                'cpu_seconds': round(self.cpu_seconds, 6),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'reads': self.reads,
+                'reads_per_second': round(self.reads_per_second(), 2),
+                'peak_rss_kb': self.peak_rss_kb,
+                'attributes': self.attributes}
+
+
+class JobTrace(object):
+    '''
+    Collects the phase spans of one runTrimmomatic call.
+
+    trace_dir -- directory the JSON-lines trace (and any profile output) is
+                 written to; None disables the file output
+    profile   -- None, 'cprofile' or 'tracemalloc'
+    listeners -- callables invoked with every finished PhaseSpan
+    progress  -- progress.JobProgress told about every phase start and end,
+                 or None
+    '''
+
+    def __init__(self, trace_dir=None, profile=None, job_id=None, listeners=(), progress=None):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.listeners = list(listeners)
+        self.progress = progress
+        self.trace_dir = trace_dir
+        self.profile = profile if profile not in ('', 'none') else None
+        self.spans = []
+        self.start_time = time.time()
+        self.trace_path = None
+        self.profile_path = None
+        self._profiler = None
+        if self.trace_dir is not None:
+            if not os.path.exists(self.trace_dir):
+                os.makedirs(self.trace_dir)
+            self.trace_path = os.path.join(self.trace_dir,
+                                           'trimmomatic_trace_' + self.job_id + '.jsonl')
+
+    @contextmanager
+    def phase(self, name, **attributes):
+        span = PhaseSpan(self.job_id, name)
+        span.attributes.update(attributes)
+        if self.progress is not None:
+            self.progress.start_phase(name)
+        try:
+            yield span
+        except Exception:
+            span.finish('error')
+            self._record(span)
+            raise
+        span.finish()
+        self._record(span)
+
+    def _record(self, span):
+        self.spans.append(span)
+        for listener in self.listeners:
+            listener(span)
+        if self.progress is not None:
+            self.progress.end_phase(span)
+        if self.trace_path is not None:
+            with open(self.trace_path, 'a') as trace_file:
+                trace_file.write(json.dumps(span.to_dict(), sort_keys=True) + '\n')
+
+    def start_profiling(self):
+        if self.profile is None or self.trace_dir is None:
+            return
+        if self.profile == 'cprofile':
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+            self.profile_path = os.path.join(self.trace_dir,
+                                             'trimmomatic_profile_' + self.job_id + '.prof')
+        elif self.profile == 'tracemalloc':
+            try:
+                import tracemalloc
+            except ImportError:
+                # not available before python 3.4
+                self.profile = None
+                return
+            tracemalloc.start(25)
+            self.profile_path = os.path.join(self.trace_dir,
+                                             'trimmomatic_tracemalloc_' + self.job_id + '.txt')
+        else:
+            raise ValueError('profile must be one of none, cprofile or tracemalloc')
+
+    def stop_profiling(self):
+        if self.profile == 'cprofile' and self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+            self._profiler = None
+        elif self.profile == 'tracemalloc' and self.profile_path is not None:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                return
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            with open(self.profile_path, 'w') as profile_file:
+                for stat in snapshot.statistics('lineno')[:50]:
+                    profile_file.write(str(stat) + '\n')
+
+    def summary(self):
+        phases = [span.to_dict() for span in self.spans]
+        return {'job_id': self.job_id,
+                'wall_seconds': round(time.time() - self.start_time, 6),
+                'cpu_seconds': round(sum(span.cpu_seconds for span in self.spans), 6),
+                'peak_rss_kb': max([span.peak_rss_kb for span in self.spans] or [0]),
+                'trace_file': self.trace_path,
+                'profile_file': self.profile_path,
+                'phases': phases}
+
+    def format_table(self):
+        lines = ['Phase timings (job ' + self.job_id + '):',
+                 '%-28s %10s %10s %14s %14s %12s %12s' % ('phase', 'wall s', 'cpu s',
+                                                          'bytes in', 'bytes out',
+                                                          'reads/s', 'peak RSS KB')]
+        for span in self.spans:
+            lines.append('%-28s %10.2f %10.2f %14d %14d %12.0f %12d' % (
+                span.name, span.wall_seconds, span.cpu_seconds, span.bytes_in,
+                span.bytes_out, span.reads_per_second(), span.peak_rss_kb))
+        return '\n'.join(lines)
+
+    def provenance_description(self):
+        # provenance only has free text room, so keep this to one short line
+        return 'Trimmomatic phase wall seconds: ' + ', '.join(
+            '%s=%.1f' % (span.name, span.wall_seconds) for span in self.spans)
@@ -0,0 +1,218 @@
+"""
+Per-job working directories under the scratch area.
+
+Every runTrimmomatic call works in its own directory so concurrent jobs in
+one server process cannot overwrite each other's files, and the directory is
+removed when the job ends, whether it succeeded or not.
+
+Files in the directory have a tracked lifecycle: each one is registered with
+the phases that still read it and is deleted as soon as the last of them has
+finished, so a job holds the working set of its current phase instead of
+every intermediate it ever wrote.  Disk usage is sampled at the end of every
+phase to report the peak.
+
+Before anything is downloaded the job reserves the scratch space it expects
+to need.  Reservations are tracked per process: a job is only admitted when
+the free space on the scratch filesystem, minus what the other running jobs
+have reserved but not written yet, covers its estimate, and when the sum of
+all reservations stays within the optional scratch budget.
+
+A resumable job directory is named after the request rather than the
+attempt and survives a failed attempt, so the retry can pick up its
+checkpoints (see manifest.py).  An exclusive lock on the directory keeps two
+attempts of the same request from running in it at once, and
+remove_stale() deletes directories nobody has come back to.
+"""
+import fcntl
+import os
+import shutil
+import threading
+import time
+
+_lock = threading.Lock()
+# job id -> JobDirectory of every job holding a reservation
+_jobs = {}
+
+# decompressed FASTQ is typically this many times larger than its gzip
+DEFAULT_EXPANSION = 4.0
+
+
+LOCK_NAME = '.lock'
+
+
+class InsufficientScratchSpace(ValueError):
+    pass
+
+
+def _lock_directory(root):
+    # returns the open lock file, or None when another process holds the lock
+    lock_file = open(os.path.join(root, LOCK_NAME), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def remove_stale(scratch, max_age):
+    '''Delete job directories untouched for max_age seconds that no job holds.'''
+    if not os.path.isdir(scratch):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(scratch):
+        root = os.path.join(scratch, name)
+        if not name.startswith('job_') or not os.path.isdir(root):
+            continue
+        try:
+            if os.path.getmtime(root) > cutoff:
+                continue
+            lock_file = _lock_directory(root)
+        except (IOError, OSError):
+            continue
+        if lock_file is not None:
+            shutil.rmtree(root, ignore_errors=True)
+            lock_file.close()
+
+
+def free_bytes(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def reserved_bytes():
+    with _lock:
+        return sum(job.reserved for job in _jobs.values())
+
+
+def estimate_scratch_bytes(input_sizes, compressed, expansion=DEFAULT_EXPANSION, copied=True):
+    '''
+    Peak scratch use of a job whose intermediates are deleted once consumed:
+    either the downloads next to their decompressed or deinterleaved copies,
+    or those copies next to trimmed outputs of (at most) the same size.
+    copied is False for inputs read in place from shared storage.
+    '''
+    inputs = sum(input_sizes)
+    downloaded = inputs if copied else 0
+    uncompressed = inputs * (expansion if compressed else 1.0)
+    return int(max(downloaded + uncompressed, 2 * uncompressed))
+
+
+class JobDirectory(object):
+    '''
+        with JobDirectory(scratch, job_id) as job_dir:
+            trace.listeners.append(job_dir.record_span)
+            job_dir.reserve(estimate)
+            ... job_dir.path(file_name) ...
+            job_dir.track(path, ['trim'])   # deleted when the trim phase ends
+
+    budget    -- upper limit in bytes for the reservations of all jobs in
+                 this process, 0 for no limit besides the free space
+    resumable -- reuse an existing directory of the same job_id and keep the
+                 directory when the job fails
+    '''
+
+    def __init__(self, scratch, job_id, keep=False, budget=0, resumable=False):
+        self.scratch = scratch
+        self.job_id = job_id
+        self.root = os.path.join(scratch, 'job_' + job_id)
+        self.keep = keep
+        self.budget = budget
+        self.resumable = resumable
+        self.reserved = 0
+        self.usage_bytes = 0
+        self.peak_bytes = 0
+        self._files = {}
+        self._lock_file = None
+
+    def __enter__(self):
+        if not (self.resumable and os.path.isdir(self.root)):
+            os.makedirs(self.root)
+        self._lock_file = _lock_directory(self.root)
+        if self._lock_file is None:
+            raise ValueError('The same job is already running in ' + self.root)
+        return self
+
+    def path(self, name):
+        # file names come from workspace metadata; never let them escape the job directory
+        return os.path.join(self.root, os.path.basename(name))
+
+    def reserve(self, nbytes):
+        with _lock:
+            others = [job for job in _jobs.values() if job is not self]
+            # what the other jobs have already written is missing from the
+            # free space, only the rest of their reservations is subtracted
+            outstanding = sum(max(job.reserved - job.usage_bytes, 0) for job in others)
+            available = free_bytes(self.scratch) - outstanding
+            if self.budget:
+                available = min(available, self.budget - sum(job.reserved for job in others))
+            if nbytes > available:
+                raise InsufficientScratchSpace(
+                    'Not enough scratch space for this job: about %d MB needed, %d MB available '
+                    '(%d MB reserved by %d running jobs)'
+                    % (nbytes >> 20, max(available, 0) >> 20,
+                       sum(job.reserved for job in others) >> 20, len(others)))
+            self.reserved = nbytes
+            _jobs[self.job_id] = self
+
+    def release(self):
+        with _lock:
+            _jobs.pop(self.job_id, None)
+        self.reserved = 0
+
+    def track(self, path, consumers):
+        '''Delete path once every phase named in consumers has finished.'''
+        if os.path.dirname(path) != self.root:
+            # staged inputs on shared storage are not ours to delete
+            return
+        consumers = set(consumers)
+        if consumers:
+            self._files[path] = consumers
+        else:
+            self.remove(path)
+
+    def finished(self, phase):
+        for path, pending in list(self._files.items()):
+            pending.discard(phase)
+            if not pending:
+                self.remove(path)
+
+    def remove(self, path):
+        self._files.pop(path, None)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def usage(self):
+        total = 0
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                try:
+                    total += os.lstat(os.path.join(dirpath, name)).st_size
+                except OSError:
+                    pass
+        return total
+
+    def sample(self):
+        self.usage_bytes = self.usage()
+        self.peak_bytes = max(self.peak_bytes, self.usage_bytes)
+        return self.usage_bytes
+
+    def record_span(self, span):
+        '''
+        JobTrace listener: records the scratch usage at the end of the phase,
+        then deletes the files nobody needs after it.  Files of a failed phase
+        are left alone for the job directory cleanup.
+        '''
+        span.attributes['scratch_bytes'] = self.sample()
+        if span.status == 'ok':
+            self.finished(span.name)
+            self.usage_bytes = self.usage()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+        if not self.keep and not (self.resumable and exc_type is not None):
+            shutil.rmtree(self.root, ignore_errors=True)
+        self._lock_file.close()
+        return False
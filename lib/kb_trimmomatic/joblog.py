@@ -0,0 +1,165 @@
+"""
+Bounded, asynchronous job console.
+
+The job log used to be a list every message was appended to, with a print
+and a stdout flush per message, so a verbose Trimmomatic run grew the list
+without limit and spent its time flushing.  A JobConsole takes the messages
+instead (it has the append() of the list it replaces) and hands them to a
+writer thread, which writes them in batches, with one flush per batch:
+
+- every message goes to the full log file, the artifact attached to the
+  report;
+- the console (stdout) gets a thinned out copy: a run of identical messages
+  is shown once with a count, and beyond rate messages per second the
+  messages are only counted, and the count is shown once the rate allows;
+- the last capacity messages shown are kept in memory, in a ring buffer.
+
+summary() is the line the report carries instead of the log itself.
+"""
+import collections
+import os
+import sys
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+DEFAULT_CAPACITY = 1000
+DEFAULT_RATE = 50
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+
+_STOP = object()
+
+
+class JobConsole(object):
+    '''
+    path     -- file the full log is appended to, None for none
+    capacity -- number of recent console lines kept in memory
+    rate     -- console lines per second, on average, before lines are held back
+    stream   -- console stream, sys.stdout by default
+    '''
+
+    def __init__(self, path=None, capacity=DEFAULT_CAPACITY, rate=DEFAULT_RATE, stream=None):
+        self.path = path
+        self.lines = collections.deque(maxlen=capacity)
+        self.rate = rate
+        self.stream = stream if stream is not None else sys.stdout
+        self.messages = 0
+        self.repeated = 0
+        self.suppressed = 0
+        self._last = None
+        self._repeats = 0
+        self._held_back = 0
+        self._tokens = float(rate)
+        self._refilled = time.time()
+        self._file = None
+        if path is not None:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self._file = open(path, 'a')
+        # a full queue blocks the producer, rather than dropping messages
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, name='job-console')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, message):
+        self._queue.put(message if isinstance(message, str) else '%s' % (message,))
+
+    def flush(self):
+        '''Wait until every message appended so far is written.'''
+        self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def _show(self, message, now):
+        # console lines for message, after collapsing repeats and the rate limit
+        self.messages += 1
+        if message == self._last:
+            self._repeats += 1
+            self.repeated += 1
+            return []
+        shown = []
+        if self._repeats:
+            shown.append('(last message repeated %d more times)' % self._repeats)
+            self._repeats = 0
+        self._last = message
+        self._tokens = min(float(self.rate), self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self._tokens < 1:
+            self.suppressed += 1
+            self._held_back += 1
+            return shown
+        self._tokens -= 1
+        if self._held_back:
+            shown.append(self._held_back_note())
+            self._held_back = 0
+        shown.append(message)
+        return shown
+
+    def _held_back_note(self):
+        # the log file itself is gone once the job ends, the report keeps a copy
+        if self.path is None:
+            return '(%d messages not shown)' % self._held_back
+        return '(%d messages only in the job log attached to the report)' % self._held_back
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < BATCH_SIZE and batch[-1] is not _STOP:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = batch[-1] is _STOP
+            messages = batch[:-1] if stop else batch
+            try:
+                now = time.time()
+                shown = []
+                for message in messages:
+                    shown.extend(self._show(message, now))
+                if stop and self._repeats:
+                    shown.append('(last message repeated %d more times)' % self._repeats)
+                if stop and self._held_back:
+                    shown.append(self._held_back_note())
+                self.lines.extend(shown)
+                if shown:
+                    self.stream.write('\n'.join(shown) + '\n')
+                    self.stream.flush()
+                if self._file is not None and messages:
+                    self._file.write('\n'.join(messages) + '\n')
+                    self._file.flush()
+            except Exception:
+                # a log that cannot be written must not stop the job
+                pass
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def summary(self):
+        self.flush()
+        line = 'Job log: %d messages' % self.messages
+        if self.repeated or self.suppressed:
+            line += ', %d repeats collapsed and %d held back on the console' % (self.repeated, self.suppressed)
+        if self.path is not None:
+            line += '; full log: ' + os.path.basename(self.path)
+        return line
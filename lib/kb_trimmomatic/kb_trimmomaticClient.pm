@@ -127,7 +127,7 @@ TrimmomaticInput is a reference to a hash where the following keys are defined:
 	input_ws has a value which is a kb_trimmomatic.workspace_name
 	output_ws has a value which is a kb_trimmomatic.workspace_name
 	read_type has a value which is a string
-	input_read_library has a value which is a string
+	input_read_library has a value which is a reference to a list where each element is a string
 	adapterFa has a value which is a string
 	seed_mismatches has a value which is an int
 	palindrom_clip_threshold has a value which is an int
@@ -158,7 +158,7 @@ TrimmomaticInput is a reference to a hash where the following keys are defined:
 	input_ws has a value which is a kb_trimmomatic.workspace_name
 	output_ws has a value which is a kb_trimmomatic.workspace_name
 	read_type has a value which is a string
-	input_read_library has a value which is a string
+	input_read_library has a value which is a reference to a list where each element is a string
 	adapterFa has a value which is a string
 	seed_mismatches has a value which is an int
 	palindrom_clip_threshold has a value which is an int
@@ -343,7 +343,7 @@ a reference to a hash where the following keys are defined:
 input_ws has a value which is a kb_trimmomatic.workspace_name
 output_ws has a value which is a kb_trimmomatic.workspace_name
 read_type has a value which is a string
-input_read_library has a value which is a string
+input_read_library has a value which is a reference to a list where each element is a string
 adapterFa has a value which is a string
 seed_mismatches has a value which is an int
 palindrom_clip_threshold has a value which is an int
@@ -368,7 +368,7 @@ a reference to a hash where the following keys are defined:
 input_ws has a value which is a kb_trimmomatic.workspace_name
 output_ws has a value which is a kb_trimmomatic.workspace_name
 read_type has a value which is a string
-input_read_library has a value which is a string
+input_read_library has a value which is a reference to a list where each element is a string
 adapterFa has a value which is a string
 seed_mismatches has a value which is an int
 palindrom_clip_threshold has a value which is an int
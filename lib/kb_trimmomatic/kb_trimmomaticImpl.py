@@ -2,13 +2,60 @@
 import sys
 import traceback
 from biokbase.workspace.client import Workspace as workspaceService
+from biokbase.AbstractHandle.Client import AbstractHandle as HandleService
 import requests
 requests.packages.urllib3.disable_warnings()
 import subprocess
+import multiprocessing
 import os
 import re
+import shutil
 from pprint import pprint, pformat
 import uuid
+from collections import OrderedDict, deque
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from kb_trimmomatic.instrumentation import JobTrace, file_size
+from kb_trimmomatic import metrics
+from kb_trimmomatic import wscache
+from kb_trimmomatic.trimlog import TrimlogAggregator, TrimlogPipe
+from kb_trimmomatic.sniffer import SniffResult, fetch_head, read_head, check_plan, \
+    DEFAULT_SAMPLE_BYTES as SNIFF_BYTES
+from kb_trimmomatic.inputs import InputResolver, is_local, parse_roots
+from kb_trimmomatic.adapters import AdapterIndex, describe as describe_adapters
+from kb_trimmomatic import admission
+from kb_trimmomatic.admission import AdmissionController
+from kb_trimmomatic.jobdir import JobDirectory, remove_stale
+from kb_trimmomatic.manifest import Manifest, run_key
+from kb_trimmomatic.streaming import RecordCounter, ShockStreamUpload, UploadGroup, shock_handle
+from kb_trimmomatic.lanes import ConcatPipe, check_lanes, library_names
+from kb_trimmomatic import dedup, sampling
+from kb_trimmomatic.readfilter import filter_reads
+from kb_trimmomatic import scatter
+from kb_trimmomatic.scatter import Coordinator, WorkQueue, gather, split_shards
+from kb_trimmomatic import progress
+from kb_trimmomatic.joblog import JobConsole
+from kb_trimmomatic.progress import FileOffsets, JobProgress, state_path
+import importlib
+# read QC, the contaminant screen and quality binning need numpy; they are
+# imported by the first job asking for them (load_optional), so the jobs and
+# the async entry point that do not use them skip importing numpy
+readqc = contaminants = qualbin = None
+_optional_tried = set()
+
+
+def load_optional(name):
+    # the numpy backed module kb_trimmomatic.<name>, None without numpy
+    if name not in _optional_tried:
+        try:
+            globals()[name] = importlib.import_module('kb_trimmomatic.' + name)
+        except ImportError:
+            pass
+        _optional_tried.add(name)
+    return globals()[name]
 #END_HEADER
 
 
@@ -30,16 +77,134 @@ This sample module contains one small method - filter_contigs.
     #########################################
     #BEGIN_CLASS_HEADER
     workspaceURL = None
-    TRIMMOMATIC = 'java -jar /kb/module/Trimmomatic-0.33/trimmomatic-0.33.jar'
+    TRIMMOMATIC_JAR = '/kb/module/Trimmomatic-0.33/trimmomatic-0.33.jar'
     ADAPTER_DIR = '/kb/module/Trimmomatic-0.33/adapters/'
+    # trimmomatic output lines kept for its summary, the rest is only logged
+    OUTPUT_TAIL_LINES = 200
 
     def log(self, target, message):
+        if isinstance(target, JobConsole):
+            # printed by the console's writer thread
+            target.append(message)
+            return
         if target is not None:
             target.append(message)
         print(message)
         sys.stdout.flush()
 
 
+    def get_read_handles(self, data, read_type):
+        # returns forward handle, forward type suffix, reverse handle
+        # (empty if there is none) and reverse type suffix
+        fr_type = ''
+        rv_type = ''
+        reverse_reads = {}
+        if read_type == 'PE':
+            if 'lib1' in data:
+                forward_reads = data['lib1']['file']
+                # type is required if lib1 is present
+                fr_type = '.' + data['lib1']['type']
+            elif 'handle_1' in data:
+                forward_reads = data['handle_1']
+            if 'lib2' in data:
+                reverse_reads = data['lib2']['file']
+                # type is required if lib2 is present
+                rv_type = '.' + data['lib2']['type']
+            elif 'handle_2' in data:
+                reverse_reads = data['handle_2']
+        else:
+            if 'handle' in data:
+                forward_reads = data['handle']
+            elif 'lib' in data:
+                forward_reads = data['lib']['file']
+        return forward_reads, fr_type, reverse_reads, rv_type
+
+
+    def download_reads(self, handle, file_name, headers, progress=None):
+        # stream a shock node to file_name and return the number of bytes written
+        bytes_written = 0
+        reads_file = open(file_name, 'w', 0)
+        r = requests.get(handle['url']+'/node/'+handle['id']+'?download', stream=True, headers=headers)
+        if progress is not None:
+            progress.measure(int(r.headers.get('content-length') or 0), 'bytes')
+        for chunk in r.iter_content(1 << 16):
+            reads_file.write(chunk)
+            bytes_written += len(chunk)
+            if progress is not None:
+                progress.add(len(chunk), 'bytes_downloaded')
+        reads_file.close()
+        return bytes_written
+
+
+    def trimmomatic_command(self):
+        java = 'java'
+        if self.trimmomatic_heap:
+            java += ' -Xmx%dm' % (self.trimmomatic_heap >> 20)
+        return java + ' -jar ' + self.TRIMMOMATIC_JAR
+
+
+    def is_enabled(self, value):
+        # checkbox style parameters arrive as 0/1, strings or booleans
+        return str(value).lower() in ('1', 'true', 'yes')
+
+
+    def run_trimmomatic(self, console, cmdstring, pipes=(), cwd=None):
+        # run trimmomatic, echoing its output; returns the last output lines,
+        # which hold its summary, and raises ValueError when it fails. pipes
+        # are the named pipes (trim log, lane inputs) open while it runs
+        if pipes:
+            with pipes[0]:
+                return self.run_trimmomatic(console, cmdstring, pipes[1:], cwd=cwd)
+
+        cmdProcess = subprocess.Popen(cmdstring, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True, cwd=cwd)
+
+        outputlines = deque(maxlen=self.OUTPUT_TAIL_LINES)
+
+        while True:
+            line = cmdProcess.stdout.readline()
+            outputlines.append(line)
+            if not line: break
+            self.log(console, line.replace('\n', ''))
+
+        cmdProcess.stdout.close()
+        cmdProcess.wait()
+        self.log(console, 'return code: ' + str(cmdProcess.returncode) + '\n')
+        # a crash must fail the job before any counts are read; with the
+        # trim log the counts would otherwise be the aggregator's zeros
+        if cmdProcess.returncode != 0:
+            raise ValueError('Trimmomatic failed with return code ' + str(cmdProcess.returncode) + ':\n' +
+                             ''.join(list(outputlines)[-20:]))
+        return list(outputlines)
+
+
+    def trim_progress(self, trace, trimlog, staged_files, expected_reads):
+        # poll the progress of the trim phase from the reads in the trim log
+        # if there is one, otherwise from how far the staged files are read
+        if trimlog is not None:
+            trace.progress.measure(expected_reads, 'reads')
+            return trace.progress.poll(lambda: trimlog.aggregator.reads, 'reads_processed')
+        offsets = FileOffsets(staged_files)
+        trace.progress.measure(offsets.total(), 'bytes')
+        return trace.progress.poll(offsets)
+
+
+    def run_read_qc(self, console, streams, quality_encoding):
+        # streams is a list of (label, [fastq paths]); returns (label, summary) pairs
+        summaries = []
+        offset = 64 if quality_encoding == 'phred64' else 33
+        pool = multiprocessing.Pool(self.qc_processes) if self.qc_processes > 1 else None
+        try:
+            for label, paths in streams:
+                qc = readqc.qc_files(paths, phred_offset=offset, pool=pool)
+                summaries.append((label, qc.summary()))
+                self.log(console, 'Read QC ' + label + ': ' + str(qc.reads) + ' reads')
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        return summaries
+
+
     def parse_trimmomatic_steps(self, input_params):
         # validate input parameters and return string defining trimmomatic steps
 
@@ -109,29 +274,375 @@ This sample module contains one small method - filter_contigs.
 
         return parameter_string
 
-    #END_CLASS_HEADER
+    def shock_node_size(self, handle, headers):
+        # size of the file in a shock node, without downloading it; 0 if unknown
+        try:
+            r = requests.get(handle['url'] + '/node/' + handle['id'], headers=headers)
+            r.raise_for_status()
+            return int(r.json()['data']['file']['size'])
+        except Exception:
+            return 0
+
+
+    def read_head(self, handle, headers, max_bytes=SNIFF_BYTES):
+        # the first max_bytes of a reads file, staged or in shock
+        if is_local(handle):
+            return read_head(handle['path'], max_bytes)
+        return fetch_head(handle, headers, max_bytes)
+
+
+    def input_size(self, handle, headers):
+        if is_local(handle):
+            return file_size(handle['path'])
+        return self.shock_node_size(handle, headers)
+
+
+    def local_file_name(self, handle, type_suffix=''):
+        if 'file_name' in handle:
+            return handle['file_name']
+        return handle['id'] + type_suffix
+
+
+    def run_command(self, cmdstring, cwd, env=None):
+        # run a shell command in cwd, returns (return code, stdout, stderr)
+        cmdProcess = subprocess.Popen(cmdstring, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+                                      executable='/bin/bash', cwd=cwd, env=env)
+        stdout, stderr = cmdProcess.communicate()
+        return cmdProcess.returncode, stdout, stderr
+
+
+    def download_checkpointed(self, console, trace, manifest, phase, handle, file_name, headers):
+        # download unless an earlier attempt of the job already did
+        if manifest.intact(phase, [file_name]):
+            self.log(console, os.path.basename(file_name) + ' already downloaded, reusing it.')
+            return
+        with trace.phase(phase) as span:
+            span.bytes_out = self.download_reads(handle, file_name, headers, trace.progress)
+            span.bytes_in = span.bytes_out
+        manifest.done(phase, [file_name])
+
+
+    def stage_inputs(self, console, trace, job_dir, manifest, read_type, forward_reads, fr_type,
+                     reverse_reads, rv_type, interleaved, headers, lane=None, decompress=True):
+        # download the reads into the job directory and return the fastq files
+        # trimmomatic reads: [forward, reverse] for PE, [reads] for SE.
+        # staged files are read where they are.  Files and phases of a lane
+        # of a multi-lane run are numbered so the lanes do not collide; with
+        # decompress False gzip'd paired files are left for the lane pipes
+        tag = '' if lane is None else '_lane%d' % lane
+        prefix = '' if lane is None else 'lane%d_' % lane
+        local = is_local(forward_reads)
+        if local:
+            fr_file_name = forward_reads['path']
+        else:
+            fr_file_name = job_dir.path(prefix + self.local_file_name(forward_reads, fr_type))
 
-    # config contains contents of config file in a hash or None if it couldn't
-    # be found
-    def __init__(self, config):
-        #BEGIN_CONSTRUCTOR
-        self.workspaceURL = config['workspace-url']
-        self.shockURL = config['shock-url']
-        self.scratch = os.path.abspath(config['scratch'])
-        if not os.path.exists(self.scratch):
-            os.makedirs(self.scratch)
-        os.chdir(self.scratch)
-        #END_CONSTRUCTOR
-        pass
+        if read_type == 'SE':
+            if local:
+                self.log(console, 'Reading staged reads file ' + fr_file_name + ' in place.')
+                return [fr_file_name]
+            self.log(console, "Downloading Single End reads file...")
+            self.download_checkpointed(console, trace, manifest, 'download' + tag, forward_reads, fr_file_name, headers)
+            self.log(console, "done.\n")
+            return [fr_file_name]
 
-    def runTrimmomatic(self, ctx, input_params):
-        # ctx is the context object
-        # return variables are: output
-        #BEGIN runTrimmomatic
+        if interleaved:
+            forward_fastq = job_dir.path(prefix + 'forward.fastq')
+            reverse_fastq = job_dir.path(prefix + 'reverse.fastq')
+            if manifest.intact('deinterleave' + tag, [forward_fastq, reverse_fastq]):
+                self.log(console, 'Reads already deinterleaved, reusing them.')
+                return [forward_fastq, reverse_fastq]
 
-        console = []
-        self.log(console, 'Running Trimmomatic with paramseters: ')
+        if local:
+            self.log(console, 'Reading staged reads file ' + fr_file_name + ' in place.')
+        else:
+            self.log(console, "\nDownloading Paired End reads file...")
+            self.download_checkpointed(console, trace, manifest, 'download_forward' + tag, forward_reads, fr_file_name, headers)
+            self.log(console, 'done\n')
 
+        if interleaved:
+            if re.search('gz', fr_file_name, re.I):
+                bcmdstring = 'gunzip -c ' + quote(fr_file_name)
+                self.log(console, "Reads are gzip'd and interleaved, uncompressing and deinterleaving.")
+            else:
+                bcmdstring = 'cat ' + quote(fr_file_name)
+                self.log(console, "Reads are interleaved, deinterleaving.")
+
+            # the download is only needed until it is split
+            job_dir.track(fr_file_name, ['deinterleave' + tag])
+            # the forward half goes through a named pipe to a background job
+            # rather than a process substitution, whose exit status bash
+            # would drop; pipefail fails the command for any part of it
+            fifo = quote(job_dir.path(prefix + 'forward.fifo'))
+            cmdstring = ('set -o pipefail; rm -f ' + fifo + '; mkfifo ' + fifo + ' || exit 1; ' +
+                         '(cut -f 1-4 < ' + fifo + ' | tr "\t" "\n" > ' + quote(forward_fastq) + ') & ' +
+                         bcmdstring + ' | paste - - - - - - - - | tee ' + fifo + ' | cut -f 5-8 | tr "\t" "\n" > ' +
+                         quote(reverse_fastq) + '; status=$?; wait $! || status=1; rm -f ' + fifo + '; exit $status')
+            with trace.phase('deinterleave' + tag) as span:
+                span.bytes_in = file_size(fr_file_name)
+                returncode, stdout, stderr = self.run_command(cmdstring, job_dir.root)
+                if returncode != 0:
+                    raise ValueError('Deinterleaving ' + os.path.basename(fr_file_name) + ' failed: ' + stderr)
+                span.bytes_out = file_size(forward_fastq) + file_size(reverse_fastq)
+            manifest.done('deinterleave' + tag, [forward_fastq, reverse_fastq])
+            self.log(console, 'done\n')
+            return [forward_fastq, reverse_fastq]
+
+        if local:
+            # trimmomatic reads gzip'd files itself, nothing to prepare
+            self.log(console, 'Reading staged reads file ' + reverse_reads['path'] + ' in place.')
+            return [fr_file_name, reverse_reads['path']]
+
+        rev_file_name = job_dir.path(prefix + self.local_file_name(reverse_reads, rv_type))
+        compressed = decompress and re.search('gz', rev_file_name, re.I)
+        uncompressed = [re.sub(r'\.gz\Z', '', fr_file_name), re.sub(r'\.gz\Z', '', rev_file_name)]
+        if compressed and manifest.intact('gunzip' + tag, uncompressed):
+            self.log(console, 'Reads already uncompressed, reusing them.')
+            return uncompressed
+
+        self.log(console, 'Downloading reverse reads.')
+        self.download_checkpointed(console, trace, manifest, 'download_reverse' + tag, reverse_reads, rev_file_name, headers)
+        self.log(console, 'done\n')
+
+        if compressed:
+            bcmdstring = 'gunzip -f ' + quote(rev_file_name) + ' ' + quote(fr_file_name)
+            self.log(console, "Reads are compressed, uncompressing.")
+            with trace.phase('gunzip' + tag) as span:
+                span.bytes_in = file_size(rev_file_name) + file_size(fr_file_name)
+                returncode, stdout, stderr = self.run_command(bcmdstring, job_dir.root)
+                if returncode != 0:
+                    raise ValueError('Uncompressing the reads failed: ' + stderr)
+                self.log(console, "\n".join((stdout, stderr, "done")))
+                span.bytes_out = sum(file_size(path) for path in uncompressed)
+            manifest.done('gunzip' + tag, uncompressed)
+            return uncompressed
+        return [fr_file_name, rev_file_name]
+
+
+    def trim_outputs(self, job_dir, read_type, inputs):
+        # files trimmomatic writes, in command line order
+        if read_type == 'PE':
+            fr_file_name, rev_file_name = [os.path.basename(path) for path in inputs]
+            return OrderedDict((
+                ('forward_paired', job_dir.path('forward_paired_' + fr_file_name)),
+                ('forward_unpaired', job_dir.path('forward_unpaired_' + fr_file_name)),
+                ('reverse_paired', job_dir.path('reverse_paired_' + rev_file_name)),
+                ('reverse_unpaired', job_dir.path('reverse_unpaired_' + rev_file_name))))
+        return OrderedDict((('trimmed', job_dir.path('trimmed_' + os.path.basename(inputs[0]))),))
+
+
+    def parse_trimmomatic_counts(self, read_type, output):
+        # read counts from the summary trimmomatic prints, keyed like TrimlogAggregator.categories
+        if read_type == 'PE':
+            keys = ('input_read_pairs', 'both_surviving', 'forward_only_surviving', 'reverse_only_surviving', 'dropped')
+            match = re.search(r'Input Read Pairs: (\d+).*?Both Surviving: (\d+).*?Forward Only Surviving: (\d+).*?Reverse Only Surviving: (\d+).*?Dropped: (\d+)', output)
+        else:
+            keys = ('input_reads', 'surviving', 'dropped')
+            match = re.search(r'Input Reads: (\d+).*?Surviving: (\d+).*?Dropped: (\d+)', output)
+        if match is None:
+            raise ValueError('Trimmomatic did not report read counts, see the job log for errors')
+        return dict(zip(keys, [int(count) for count in match.groups()]))
+
+
+    def format_counts(self, read_type, counts):
+        if read_type == 'PE':
+            return "\n".join( ('Input Read Pairs: ' + str(counts['input_read_pairs']),
+                'Both Surviving: ' + str(counts['both_surviving']),
+                'Forward Only Surviving: ' + str(counts['forward_only_surviving']),
+                'Reverse Only Surviving: ' + str(counts['reverse_only_surviving']),
+                'Dropped: ' + str(counts['dropped'])) )
+        return "\n".join( ('Input Reads: ' + str(counts['input_reads']),
+            'Surviving: ' + str(counts['surviving']),
+            'Dropped: ' + str(counts['dropped'])) )
+
+
+    def output_libraries(self, read_type, outputs, counts):
+        # (object name suffix, files, read count, description) of every library to save
+        if read_type == 'PE':
+            return [('_paired', [outputs['forward_paired'], outputs['reverse_paired']],
+                     counts['both_surviving'], 'Trimmed Paired-End Reads'),
+                    ('_forward_unpaired', [outputs['forward_unpaired']],
+                     counts['forward_only_surviving'], 'Trimmed Unpaired Forward Reads'),
+                    ('_reverse_unpaired', [outputs['reverse_unpaired']],
+                     counts['reverse_only_surviving'], 'Trimmed Unpaired Reverse Reads')]
+        return [('', [outputs['trimmed']], counts['surviving'], 'Trimmed Reads')]
+
+
+    def contaminant_library(self, job_dir, filter_result):
+        # the library of contaminant reads kept by the read filter, as in
+        # output_libraries; empty when they were not kept or there are none
+        if not filter_result or not filter_result.get('screened_outputs') or not filter_result['contaminants']:
+            return []
+        return [('_contaminants', [job_dir.path(name) for name in filter_result['screened_outputs']],
+                 filter_result['contaminants'], 'Reads Matching the Contaminant Screen')]
+
+
+    def upload_reads(self, console, trace, job_dir, env, input_params, suffix, files, read_count, description):
+        # save one reads library with ws-tools, returns its objects_created entry
+        object_name = input_params['output_read_library'] + suffix
+        cmd = ['ws-tools fastX2reads --inputfile', quote(files[0])]
+        if len(files) > 1:
+            cmd += ['--inputfile2', quote(files[1])]
+        cmd += ['--wsurl', self.workspaceURL, '--shockurl', self.shockURL, '--outws', quote(input_params['output_ws']),
+                '--outobj', quote(object_name), '--readcount', str(read_count)]
+        cmdstring = " ".join(cmd)
+
+        self.log(console, '\nUploading ' + description[0].lower() + description[1:] + '.')
+        with trace.phase('upload' + suffix) as span:
+            span.bytes_in = sum(file_size(path) for path in files)
+            span.reads = read_count * len(files)
+            returncode, stdout, stderr = self.run_command(cmdstring, job_dir.root, env)
+        self.log(console, "cmdstring: " + cmdstring + " stdout: " + stdout + " stderr: " + stderr)
+        if returncode != 0:
+            raise ValueError('Uploading ' + object_name + ' failed: ' + stderr)
+        return {'ref': input_params['input_ws'] + '/' + object_name, 'description': description}
+
+
+    def trim_and_stream(self, console, trace, job_dir, read_type, inputs, outputs, cmdstring, trimlog, pipes,
+                        qc_encoding, headers, token, expected_reads=0):
+        # run trimmomatic with every output a named pipe that is uploaded to
+        # shock while it is written; returns the read counts, the persisted
+        # handles keyed by output file name and the output read QC (or None).
+        # inputs are the files read, pipes as for run_trimmomatic
+        offset = 64 if qc_encoding == 'phred64' else 33
+        uploads = OrderedDict(
+            (key, ShockStreamUpload(path, self.shockURL, headers, os.path.basename(path),
+                                    RecordCounter(readqc.ReadQC(phred_offset=offset) if qc_encoding else None)))
+            for key, path in outputs.items())
+
+        with trace.phase('trim_upload') as span:
+            span.bytes_in = sum(file_size(path) for path in inputs)
+            with UploadGroup(uploads.values()), self.trim_progress(trace, trimlog, inputs, expected_reads):
+                outputlines = self.run_trimmomatic(console, cmdstring, pipes, cwd=job_dir.root)
+
+            # input and dropped reads are only known to trimmomatic, what
+            # survived is what went through the pipes
+            if trimlog is not None:
+                counts = dict(trimlog.aggregator.categories)
+            else:
+                counts = self.parse_trimmomatic_counts(read_type, "".join(outputlines))
+            reads = dict((key, upload.counter.reads) for key, upload in uploads.items())
+            if read_type == 'PE':
+                if reads['forward_paired'] != reads['reverse_paired']:
+                    raise ValueError('Streamed paired outputs differ in length: %d forward, %d reverse reads'
+                                     % (reads['forward_paired'], reads['reverse_paired']))
+                counts['both_surviving'] = reads['forward_paired']
+                counts['forward_only_surviving'] = reads['forward_unpaired']
+                counts['reverse_only_surviving'] = reads['reverse_unpaired']
+                span.reads = 2 * counts['input_read_pairs']
+            else:
+                counts['surviving'] = reads['trimmed']
+                span.reads = counts['input_reads']
+            span.bytes_out = sum(upload.counter.bytes for upload in uploads.values())
+
+            handleService = HandleService(url=self.handleURL, token=token)
+            handles = {}
+            for upload in uploads.values():
+                handle = shock_handle(upload.node, self.shockURL)
+                handle['hid'] = handleService.persist_handle(handle)
+                handles[os.path.basename(upload.path)] = handle
+
+        output_summaries = None
+        if qc_encoding:
+            if read_type == 'PE':
+                output_summaries = [
+                    ('trimmed forward', uploads['forward_paired'].counter.qc.merge(uploads['forward_unpaired'].counter.qc).summary()),
+                    ('trimmed reverse', uploads['reverse_paired'].counter.qc.merge(uploads['reverse_unpaired'].counter.qc).summary())]
+            else:
+                output_summaries = [('trimmed', uploads['trimmed'].counter.qc.summary())]
+        return counts, handles, output_summaries
+
+
+    def scatter_trim(self, console, trace, read_type, streams, outputs, quality_encoding, trimmomatic_params,
+                     copy=None):
+        # trim shards of the reads through the scatter queue and gather their
+        # outputs into outputs (with copy, as scatter.gather); returns the
+        # read counts of all shards
+        queue = WorkQueue(self.scatter_queue, self.scatter_lease)
+        scatter_id = uuid.uuid4().hex
+        shard_dir = queue.shard_dir(scatter_id)
+        try:
+            with trace.phase('scatter') as span:
+                span.bytes_in = sum(file_size(path) for paths in streams for path in paths)
+                shards = split_shards(streams, shard_dir, self.scatter_shard_reads)
+                span.reads = sum(reads for _, reads in shards) * len(streams)
+                span.bytes_out = sum(file_size(path) for paths, _ in shards for path in paths)
+                span.attributes['shards'] = len(shards)
+            if not shards:
+                raise ValueError('The input files hold no reads')
+            self.log(console, 'Trimming %d shards through the queue in %s' % (len(shards), self.scatter_queue))
+            # the workers build the Trimmomatic command line from these
+            tasks = []
+            for number, (paths, _) in enumerate(shards):
+                tasks.append({'read_type': read_type, 'quality_encoding': quality_encoding,
+                              'threads': self.trimmomatic_threads, 'inputs': paths,
+                              'outputs': [os.path.join(shard_dir, 'shard_%05d_%s' % (number, os.path.basename(path)))
+                                          for path in outputs.values()],
+                              'steps': trimmomatic_params.split()})
+            with trace.phase('trim') as span:
+                span.bytes_in = sum(file_size(path) for paths, _ in shards for path in paths)
+                trace.progress.measure(len(shards), 'shards')
+                coordinator = Coordinator(queue, scatter_id, local_workers=self.scatter_local_workers,
+                                          timeout=self.scatter_timeout, jar=self.TRIMMOMATIC_JAR,
+                                          heap_mb=self.trimmomatic_heap >> 20)
+                results = coordinator.run(tasks, progress=trace.progress.set)
+                counts = {}
+                for number, result in enumerate(results):
+                    self.log(console, 'Shard %d trimmed by %s in %.1f s' % (number, result['worker'], result['seconds']))
+                    for key, count in self.parse_trimmomatic_counts(read_type, "\n".join(result['output'])).items():
+                        counts[key] = counts.get(key, 0) + count
+                # every shard's outputs as written by the attempt that finished it
+                gather([result['outputs'] for result in results], list(outputs.values()), copy)
+                span.reads = 2 * counts['input_read_pairs'] if read_type == 'PE' else counts['input_reads']
+                span.bytes_out = sum(file_size(path) for path in outputs.values())
+                span.attributes['shards'] = len(shards)
+        finally:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+        return counts
+
+
+    def attach_log(self, console, headers, token):
+        # the full job log as the file links of the report; a log that cannot
+        # be uploaded is left out of the report rather than failing the job
+        if console.path is None:
+            return []
+        console.flush()
+        name = os.path.basename(console.path)
+        try:
+            with open(console.path, 'rb') as log_file:
+                r = requests.post(self.shockURL + '/node', headers=headers, files={'upload': (name, log_file)})
+            r.raise_for_status()
+            handle = shock_handle(r.json()['data'], self.shockURL)
+            hid = HandleService(url=self.handleURL, token=token).persist_handle(handle)
+        except Exception as e:
+            self.log(console, 'Could not attach the job log to the report: ' + str(e))
+            return []
+        return [{'handle': hid, 'name': name, 'label': 'Job log',
+                 'description': 'Everything the job logged, including the Trimmomatic output'}]
+
+
+    def save_streamed_library(self, trace, wsClient, input_params, provenance, suffix, handles, read_count,
+                              description):
+        # save a reads library object for outputs trim_and_stream put in shock
+        object_name = input_params['output_read_library'] + suffix
+        if len(handles) == 2:
+            obj_type = 'KBaseAssembly.PairedEndLibrary'
+            data = {'handle_1': handles[0], 'handle_2': handles[1], 'interleaved': 0}
+        else:
+            obj_type = 'KBaseAssembly.SingleEndLibrary'
+            data = {'handle': handles[0]}
+        with trace.phase('upload' + suffix) as span:
+            span.reads = read_count * len(handles)
+            wsClient.save_objects({'workspace': input_params['output_ws'],
+                                   'objects': [{'type': obj_type,
+                                                'data': data,
+                                                'name': object_name,
+                                                'meta': {'read_count': str(read_count)},
+                                                'provenance': provenance}]})
+        return {'ref': input_params['input_ws'] + '/' + object_name, 'description': description}
+
+
+    def _run_trimmomatic(self, ctx, input_params, console, trace, job_dir, manifest, slot):
         token = ctx['token']
         wsClient = workspaceService(self.workspaceURL, token=token)
         headers = {'Authorization': 'OAuth '+token}
@@ -142,259 +653,584 @@ This sample module contains one small method - filter_contigs.
         provenance = [{}]
         if 'provenance' in ctx:
             provenance = ctx['provenance']
+        # a list of libraries is trimmed as the lanes of one run
+        lane_names = library_names(input_params['input_read_library'])
+        multi_lane = len(lane_names) > 1
         # add additional info to provenance here, in this case the input data object reference
-        provenance[0]['input_ws_objects']=[input_params['input_ws']+'/'+input_params['input_read_library']]
+        provenance[0]['input_ws_objects'] = [input_params['input_ws'] + '/' + name for name in lane_names]
 
         if ('output_ws' not in input_params or input_params['output_ws'] is None):
             input_params['output_ws'] = input_params['input_ws']
 
         trimmomatic_params  = self.parse_trimmomatic_steps(input_params)
-        trimmomatic_options = input_params['read_type'] + ' -' + input_params['quality_encoding']
-
-        self.log(console, pformat(trimmomatic_params))
-        self.log(console, pformat(trimmomatic_options))
+        read_type = input_params['read_type']
+
+        read_qc = self.is_enabled(input_params.get('read_qc'))
+        if read_qc and load_optional('readqc') is None:
+            self.log(console, 'Read QC requested but numpy is not available, skipping it.')
+            read_qc = False
+        screen_contaminants = self.is_enabled(input_params.get('screen_contaminants'))
+        if screen_contaminants and load_optional('contaminants') is None:
+            self.log(console, 'Contaminant screen requested but numpy is not available, skipping it.')
+            screen_contaminants = False
+        keep_contaminants = screen_contaminants and self.is_enabled(input_params.get('keep_contaminants'))
+        qc_summaries = []
+        remove_duplicates = self.is_enabled(input_params.get('remove_duplicates'))
+        binning = None
+        if input_params.get('quality_binning') not in (None, '', 'none'):
+            if load_optional('qualbin') is None:
+                self.log(console, 'Quality binning requested but numpy is not available, skipping it.')
+            else:
+                binning = qualbin.scheme_name(input_params['quality_binning'])
 
-        report = ''
         reportObj = {'objects_created':[], 
                      'text_message':''}
 
 
-        try:
-            readLibrary = wsClient.get_objects([{'name': input_params['input_read_library'], 
-                                                            'workspace' : input_params['input_ws']}])[0]
-            info = readLibrary['info']
-
-        except Exception as e:
-            raise ValueError('Unable to get read library object from workspace: (' + input_params['input_ws']+ '/' + input_params['input_read_library'] +')' + str(e))
-
-
-        if input_params['read_type'] == 'PE':
-
-            fr_type = ''
-            rv_type = ''
-            if 'lib1' in readLibrary['data']:
-                forward_reads = readLibrary['data']['lib1']['file']
-                # type is required if lib1 is present
-                fr_type = '.' + readLibrary['data']['lib1']['type']
-            elif 'handle_1' in readLibrary['data']:
-                forward_reads = readLibrary['data']['handle_1']
-            if 'lib2' in readLibrary['data']:
-                reverse_reads = readLibrary['data']['lib2']['file']
-                # type is required if lib2 is present
-                rv_type = '.' + readLibrary['data']['lib2']['type']
-            elif 'handle_2' in readLibrary['data']:
-                reverse_reads = readLibrary['data']['handle_2']
+        lanes = []
+        with trace.phase('get_read_library'):
+            for name in lane_names:
+                try:
+                    # only the handles and the interleaved flag are needed
+                    readLibrary = wscache.get_read_library(wsClient, self.library_cache, ctx.get('user_id'),
+                                                           input_params['input_ws'], name)
+                except Exception as e:
+                    raise ValueError('Unable to get read library object from workspace: (' + input_params['input_ws']+ '/' + name +')' + str(e))
+                lanes.append({'name': name, 'info': readLibrary['info'], 'data': readLibrary['data']})
+        info = lanes[0]['info']
+
+        # checkpoints of an earlier attempt only hold for the same library
+        # versions and staged files
+        staged = []
+        if input_params.get('staged_reads'):
+            if multi_lane:
+                raise ValueError('staged_reads replaces the files of a single read library, '
+                                 'it cannot be used with several input libraries')
+            staged = self.input_resolver.handles(input_params['staged_reads'], ctx.get('user_id'))
+            if read_type == 'SE' and len(staged) != 1:
+                raise ValueError('staged_reads takes a single file for single end reads')
+        source = ' '.join(wscache.object_ref(lane['info']) for lane in lanes)
+        for handle in staged:
+            st = os.stat(handle['path'])
+            source += ' %s:%d:%d' % (handle['path'], st.st_size, int(st.st_mtime))
+        checkpointed = manifest.check_source(source)
+        if checkpointed:
+            self.log(console, 'Resuming, phases finished by an earlier attempt: ' + ', '.join(checkpointed))
+        # an attempt that failed after saving its report
+        if manifest.get('save_report') is not None:
+            return manifest.data('save_report')
+
+        for lane in lanes:
+            lane['forward'], lane['fr_type'], lane['reverse'], lane['rv_type'] = \
+                self.get_read_handles(lane['data'], read_type)
+            lane['interleaved'] = bool(lane['data'].get('interleaved'))
+            lane['forward_sniff'] = lane['reverse_sniff'] = None
+        if staged:
+            # files on shared storage replace the library's shock nodes
+            lanes[0]['forward'] = staged[0]
+            lanes[0]['reverse'] = staged[1] if len(staged) > 1 else {}
+            lanes[0]['fr_type'] = lanes[0]['rv_type'] = ''
+            lanes[0]['interleaved'] = False
+
+        # check encoding and layout on the first few MB before downloading everything
+        preflight_notes = []
+        if self.sniff_bytes > 0:
+            with trace.phase('sniff') as span:
+                for lane in lanes:
+                    lane['forward_sniff'] = SniffResult(self.read_head(lane['forward'], headers, self.sniff_bytes))
+                    if read_type == 'PE' and not lane['interleaved'] and lane['reverse']:
+                        lane['reverse_sniff'] = SniffResult(self.read_head(lane['reverse'], headers, self.sniff_bytes))
+                sniffs = [sniff for lane in lanes for sniff in (lane['forward_sniff'], lane['reverse_sniff'])
+                          if sniff is not None]
+                span.bytes_in = sum(sniff.bytes_sampled for sniff in sniffs)
+                span.reads = sum(sniff.read_count for sniff in sniffs)
+                if multi_lane:
+                    check_lanes(lane_names, [lane['forward_sniff'] for lane in lanes])
+                for lane in lanes:
+                    notes = check_plan(input_params, lane['forward_sniff'], lane['reverse_sniff'],
+                                       lane['interleaved'])
+                    preflight_notes += [lane['name'] + ' ' + note for note in notes] if multi_lane else notes
+            for note in preflight_notes:
+                self.log(console, 'Pre-flight: ' + note)
+        for lane in lanes:
+            if read_type == 'PE' and not lane['reverse']:
+                # a paired library with a single file can only be interleaved
+                lane['interleaved'] = True
+
+        if input_params.get('adapterFa') == 'auto':
+            with trace.phase('detect_adapters') as span:
+                sample = []
+                for lane in lanes:
+                    if lane['forward_sniff'] is None:
+                        lane['forward_sniff'] = SniffResult(self.read_head(lane['forward'], headers))
+                    sample += [seq for _, seq, _ in lane['forward_sniff'].records]
+                    if lane['reverse_sniff'] is not None:
+                        sample += [seq for _, seq, _ in lane['reverse_sniff'].records]
+                span.reads = len(sample)
+                index = AdapterIndex.load(self.ADAPTER_DIR, self.adapter_index_cache)
+                adapter, evidence = index.detect(sample, read_type)
+            preflight_notes.append(describe_adapters(evidence))
+            self.log(console, 'Pre-flight: ' + preflight_notes[-1])
+            if adapter is not None:
+                input_params['adapterFa'] = adapter
             else:
-                reverse_reads={}
-
-            fr_file_name = forward_reads['id'] + fr_type
-            if 'file_name' in forward_reads:
-                fr_file_name = forward_reads['file_name']
+                # nothing to clip, run the remaining steps without ILLUMINACLIP
+                for param in ('adapterFa', 'seed_mismatches', 'palindrome_clip_threshold', 'simple_clip_threshold'):
+                    input_params[param] = None
+            trimmomatic_params = self.parse_trimmomatic_steps(input_params)
+
+        # wait for room on the node, then claim the scratch space the job
+        # will need, before downloading anything
+        for lane in lanes:
+            lane['sizes'] = [self.input_size(handle, headers) for handle in (lane['forward'], lane['reverse']) if handle]
+        compressed = any(re.search('gz', self.local_file_name(lane['forward'], lane['fr_type']), re.I) or
+                         (lane['forward_sniff'] is not None and lane['forward_sniff'].compression != 'none')
+                         for lane in lanes)
+        input_sizes = [size for lane in lanes for size in lane['sizes']]
+        # large inputs are trimmed in shards by the workers of the scatter
+        # queue, unless the trim log or the upload has to see one stream;
+        # the local workers are charged to the job
+        sharded = bool(self.scatter_queue) and not self.stream_uploads and \
+            not self.is_enabled(input_params.get('trimlog_stats')) and sum(input_sizes) >= self.scatter_min_bytes
+        cost = admission.estimate_cost(input_sizes, compressed,
+                                       self.trimmomatic_threads or 1, self.trimmomatic_heap,
+                                       copied=not is_local(lanes[0]['forward']),
+                                       extra_memory=self.dedup_memory if remove_duplicates else 0,
+                                       trimmers=self.scatter_local_workers if sharded else 1)
+        with trace.phase('admission') as span:
+            span.bytes_in = cost.input_bytes
+            span.attributes['wait_seconds'] = slot.admit(cost, log=lambda message: self.log(console, message))
+        job_dir.reserve(cost.disk)
+        # reads (pairs for PE) and bases per read (pair) the sniffed samples
+        # predict, to size the dedup filter and to aim the downsampling
+        expected_reads = 0
+        lane_bases = []
+        for lane in lanes:
+            sniff = lane['forward_sniff']
+            if sniff is None or not sniff.bytes_per_record:
+                continue
+            mates = 2 if read_type == 'PE' and lane['interleaved'] else 1
+            expected_reads += lane['sizes'][0] / sniff.bytes_per_record / mates
+            if read_type == 'SE':
+                lane_bases.append(sniff.length_mean)
+            elif lane['reverse_sniff'] is not None:
+                lane_bases.append(sniff.length_mean + lane['reverse_sniff'].length_mean)
+            else:
+                lane_bases.append(2 * sniff.length_mean)
+        bases_per_read = sum(lane_bases) / len(lane_bases) if lane_bases else 0
+        sample_fraction, sample_target = sampling.fraction(input_params, expected_reads, bases_per_read)
+        if sample_fraction is not None and sample_fraction >= 1:
+            self.log(console, 'The library holds no more reads than requested (about %d), not downsampling.'
+                     % expected_reads)
+            sample_fraction = None
+        filter_inputs = remove_duplicates or sample_fraction is not None or screen_contaminants
+        self.log(console, 'Reserved ' + str(job_dir.reserved >> 20) + ' MB of scratch space in ' + job_dir.root)
+
+        trimmomatic_options = read_type
+        if self.trimmomatic_threads:
+            trimmomatic_options += ' -threads %d' % self.trimmomatic_threads
+        trimmomatic_options += ' -' + input_params['quality_encoding']
+
+        trimlog = None
+        if self.is_enabled(input_params.get('trimlog_stats')):
+            # aggregate the per read trim log through a named pipe instead of
+            # parsing the summary Trimmomatic prints
+            trimlog = TrimlogPipe(job_dir.path('trimlog.fifo'),
+                                  TrimlogAggregator(paired=(read_type == 'PE')))
+            trimmomatic_options += ' -trimlog ' + quote(trimlog.path)
 
-            self.log(console, "\nDownloading Paired End reads file...")
-            forward_reads_file = open(fr_file_name, 'w', 0)
-            print("cwd: " + str(os.getcwd()) )
-            
-            r = requests.get(forward_reads['url']+'/node/'+forward_reads['id']+'?download', stream=True, headers=headers)
-            for chunk in r.iter_content(1024):
-                forward_reads_file.write(chunk)
-            forward_reads_file.close()
-            self.log(console, 'done\n')
+        self.log(console, pformat(trimmomatic_params))
+        self.log(console, pformat(trimmomatic_options))
 
-            if 'interleaved' in readLibrary['data'] and readLibrary['data']['interleaved']:
-                if re.search('gz', fr_file_name, re.I):
-                    bcmdstring = 'gunzip -c ' + fr_file_name
-                    self.log(console, "Reads are gzip'd and interleaved, uncompressing and deinterleaving.")
-                else:    
-                    bcmdstring = 'cat ' + fr_file_name 
-                    self.log(console, "Reads are interleaved, deinterleaving.")
-
-                
-                cmdstring = bcmdstring + '| (paste - - - - - - - -  | tee >(cut -f 1-4 | tr "\t" "\n" > forward.fastq) | cut -f 5-8 | tr "\t" "\n" > reverse.fastq )'
-                cmdProcess = subprocess.Popen(cmdstring, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, executable='/bin/bash')
-                stdout, stderr = cmdProcess.communicate()
-
-                # Check return status
-                report = "cmdstring: " + cmdstring + " stdout: " + stdout + " stderr: " + stderr
-                self.log(console, 'done\n')
-                fr_file_name='forward.fastq'
-                rev_file_name='reverse.fastq'
+        # an earlier attempt of this job may have trimmed the reads already;
+        # its outputs are only reused when every file still needed is intact
+        trim_data = manifest.data('trim')
+        resume_trim = False
+        filter_result = None
+        streamed_handles = None
+        output_summaries = None
+        binning_result = None
+        if trim_data is not None:
+            outputs = OrderedDict((key, job_dir.path(name)) for key, name in trim_data['outputs'])
+            counts = trim_data['counts']
+            if trim_data.get('handles') is not None:
+                # streamed outputs live in Shock already
+                resume_trim = True
+            elif read_qc and manifest.get('qc_output') is None:
+                resume_trim = manifest.intact('trim', list(outputs.values()))
             else:
-                self.log(console, 'Downloading reverse reads.')
-                rev_file_name = reverse_reads['id'] + rv_type
-                if 'file_name' in reverse_reads:
-                    rev_file_name = reverse_reads['file_name']
-                reverse_reads_file = open(rev_file_name, 'w', 0)
-
-                r = requests.get(reverse_reads['url']+'/node/'+reverse_reads['id']+'?download', stream=True, headers=headers)
-                for chunk in r.iter_content(1024):
-                    reverse_reads_file.write(chunk)
-                reverse_reads_file.close()
-                self.log(console, 'done\n')
-
-                if re.search('gz', rev_file_name, re.I):
-                    bcmdstring = 'gunzip ' + rev_file_name + ' ' + fr_file_name
-                    self.log(console, "Reads are compressed, uncompressing.")
-                    cmdProcess = subprocess.Popen(bcmdstring, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, executable='/bin/bash')
-                    stdout, stderr = cmdProcess.communicate()
-                    self.log(console, "\n".join(stdout, stderr, "done"))
-                    rev_file_name = re.sub(r'\.gz\Z', '', rev_file_name)
-                    fr_file_name = re.sub(r'\.gz\Z', '', fr_file_name)
-
-            cmdstring = " ".join( (self.TRIMMOMATIC, trimmomatic_options, 
-                            fr_file_name, 
-                            rev_file_name,
-                            'forward_paired_'   +fr_file_name,
-                            'forward_unpaired_' +fr_file_name,
-                            'reverse_paired_'   +rev_file_name,
-                            'reverse_unpaired_' +rev_file_name,
-                            trimmomatic_params) )
-
-            self.log(console, 'Starting Trimmomatic')
-            cmdProcess = subprocess.Popen(cmdstring, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-
-
-            outputlines = []
-
-            while True:
-                line = cmdProcess.stdout.readline()
-                outputlines.append(line)
-                if not line: break
-                self.log(console, line.replace('\n', ''))
-
-            cmdProcess.stdout.close()
-            cmdProcess.wait()
-            self.log(console, 'return code: ' + str(cmdProcess.returncode) + '\n')
-
-            report += "\n".join(outputlines)
-            #report += "cmdstring: " + cmdstring + " stdout: " + stdout + " stderr " + stderr
-
-
-            #get read counts
-            match = re.search(r'Input Read Pairs: (\d+).*?Both Surviving: (\d+).*?Forward Only Surviving: (\d+).*?Reverse Only Surviving: (\d+).*?Dropped: (\d+)', report)
-            input_read_count = match.group(1)
-            read_count_paired = match.group(2)
-            read_count_forward_only = match.group(3)
-            read_count_reverse_only = match.group(4)
-            read_count_dropped = match.group(5)
-
-            report = "\n".join( ('Input Read Pairs: '+ input_read_count, 
-                'Both Surviving: '+ read_count_paired, 
-                'Forward Only Surviving: '+ read_count_forward_only,
-                'Reverse Only Surviving: '+ read_count_reverse_only,
-                'Dropped: '+ read_count_dropped) )
-
-            #upload paired reads
-            self.log(console, 'Uploading trimmed paired reads.')
-            cmdstring = " ".join( ('ws-tools fastX2reads --inputfile', 'forward_paired_' + fr_file_name, 
-                                   '--inputfile2', 'reverse_paired_' + rev_file_name,
-                                   '--wsurl', self.workspaceURL, '--shockurl', self.shockURL, '--outws', input_params['output_ws'],
-                                   '--outobj', input_params['output_read_library'] + '_paired', '--readcount', read_count_paired ) )
-
-            cmdProcess = subprocess.Popen(cmdstring, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, env=env)
-            stdout, stderr = cmdProcess.communicate()
-            print("cmdstring: " + cmdstring + " stdout: " + stdout + " stderr: " + stderr)
-            #report += "cmdstring: " + cmdstring + " stdout: " + stdout + " stderr: " + stderr
-            reportObj['objects_created'].append({'ref':input_params['input_ws']+'/'+input_params['output_read_library']+'_paired', 
-                        'description':'Trimmed Paired-End Reads'})
-
-            #upload reads forward unpaired
-            self.log(console, '\nUploading trimmed unpaired forward reads.')
-            cmdstring = " ".join( ('ws-tools fastX2reads --inputfile', 'forward_unpaired_' + fr_file_name, 
-                                   '--wsurl', self.workspaceURL, '--shockurl', self.shockURL, '--outws', input_params['output_ws'],
-                                   '--outobj', input_params['output_read_library'] + '_forward_unpaired', '--readcount', read_count_forward_only ) )
-
-            cmdProcess = subprocess.Popen(cmdstring, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, env=env)
-            stdout, stderr = cmdProcess.communicate()
-            print("cmdstring: " + cmdstring + " stdout: " + stdout + " stderr: " + stderr)
-            #report += "cmdstring: " + cmdstring + " stdout: " + stdout + " stderr: " + stderr
-            reportObj['objects_created'].append({'ref':input_params['input_ws']+'/'+input_params['output_read_library']+'_forward_unpaired', 
-                        'description':'Trimmed Unpaired Forward Reads'})
-
-            #upload reads reverse unpaired
-            self.log(console, '\nUploading trimmed unpaired reverse reads.')
-            cmdstring = " ".join( ('ws-tools fastX2reads --inputfile', 'reverse_unpaired_' + rev_file_name, 
-                                   '--wsurl', self.workspaceURL, '--shockurl', self.shockURL, '--outws', input_params['output_ws'],
-                                   '--outobj', input_params['output_read_library'] + '_reverse_unpaired', '--readcount', read_count_reverse_only ) )
-
-            cmdProcess = subprocess.Popen(cmdstring, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, env=env)
-            stdout, stderr = cmdProcess.communicate()
-            print("cmdstring: " + cmdstring + " stdout: " + stdout + " stderr: " + stderr)
-            #report += "cmdstring: " + cmdstring + " stdout: " + stdout + " stderr: " + stderr
-            reportObj['objects_created'].append({'ref':input_params['input_ws']+'/'+input_params['output_read_library']+'_reverse_unpaired', 
-                        'description':'Trimmed Unpaired Reverse Reads'})
-
+                resume_trim = manifest.intact('trim', [path for suffix, files, _, _
+                                                       in self.output_libraries(read_type, outputs, counts)
+                                                       if manifest.get('upload' + suffix) is None
+                                                       for path in files])
+            # screened reads kept by the read filter are uploaded with the trimmed ones
+            screened = [path for suffix, files, _, _
+                        in self.contaminant_library(job_dir, manifest.data('filter_reads'))
+                        if manifest.get('upload' + suffix) is None
+                        for path in files]
+            if resume_trim and screened:
+                resume_trim = manifest.intact('filter_reads', screened)
+
+        if resume_trim:
+            self.log(console, 'Trimmed reads of an earlier attempt are intact, skipping download and trimming.')
+            trimlog_report = trim_data['trimlog_report']
+            binning_result = trim_data.get('binning')
+            streamed_handles = trim_data.get('handles')
+            filter_result = manifest.data('filter_reads')
+            if read_qc:
+                qc_summaries += manifest.data('qc_input') or []
         else:
-            self.log(console, "Downloading Single End reads file...")
-            fr_file_name = ''
-            if 'handle' in readLibrary['data']:
-                forward_reads = readLibrary['data']['handle']
-            elif 'lib' in readLibrary['data']:
-                forward_reads = readLibrary['data']['lib']['file']
-
-
-            fr_file_name = forward_reads['id']
-            if 'file_name' in forward_reads:
-                    fr_file_name = forward_reads['file_name']
-
-            reads_file = open(fr_file_name, 'w', 0)
-            r = requests.get(forward_reads['url']+'/node/'+forward_reads['id']+'?download', stream=True, headers=headers)
-            for chunk in r.iter_content(1024):
-                reads_file.write(chunk)
-            self.log(console, "done.\n")
-
-            cmdstring = " ".join( (self.TRIMMOMATIC, trimmomatic_options,
-                            fr_file_name,
-                            'trimmed_' + fr_file_name,
-                            trimmomatic_params) )
-
-            cmdProcess = subprocess.Popen(cmdstring, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-
-            #report += "cmdstring: " + cmdstring
+            streams = ['forward', 'reverse'] if read_type == 'PE' else ['']
+            trim_phase = 'trim_upload' if self.stream_uploads else 'trim'
+            filtered = [job_dir.path(('filtered_' + stream).rstrip('_') + '.fastq') for stream in streams]
+            screened = [job_dir.path(('contaminants_' + stream).rstrip('_') + '.fastq')
+                        for stream in streams] if keep_contaminants else []
+            if filter_inputs and manifest.intact('filter_reads', filtered + screened):
+                self.log(console, 'Reads were selected by an earlier attempt, reusing them.')
+                filter_result = manifest.data('filter_reads')
+                if read_qc:
+                    qc_summaries += manifest.data('qc_input') or []
+            else:
+                lane_inputs = []
+                for number, lane in enumerate(lanes, 1):
+                    if multi_lane:
+                        self.log(console, 'Staging lane %d of %d, %s' % (number, len(lanes), lane['name']))
+                    # the lane pipes and the read filter decompress on the fly
+                    lane_inputs.append(self.stage_inputs(console, trace, job_dir, manifest, read_type,
+                                                         lane['forward'], lane['fr_type'], lane['reverse'],
+                                                         lane['rv_type'], lane['interleaved'], headers,
+                                                         lane=number if multi_lane else None,
+                                                         decompress=not (multi_lane or filter_inputs)))
+                # the files of each read direction, in lane order
+                stream_files = [[files[i] for files in lane_inputs] for i in range(len(streams))]
+                staged_files = [path for files in stream_files for path in files]
+                for path in staged_files:
+                    job_dir.track(path, (['qc_input'] if read_qc else []) +
+                                        ['filter_reads' if filter_inputs else trim_phase])
+
+                if read_qc:
+                    with trace.phase('qc_input') as span:
+                        input_summaries = self.run_read_qc(console, [(('input ' + stream).strip(), paths)
+                                                                     for stream, paths in zip(streams, stream_files)],
+                                                           input_params['quality_encoding'])
+                        span.reads = sum(summary['reads'] for _, summary in input_summaries)
+                    manifest.done('qc_input', data=input_summaries)
+                    qc_summaries += input_summaries
+
+                if filter_inputs:
+                    bloom = sampler = screen = None
+                    if sample_fraction is not None:
+                        self.log(console, 'Downsampling the reads to a fraction of %.4g' % sample_fraction)
+                        sampler = sampling.HashSampler(sample_fraction)
+                    if remove_duplicates:
+                        # sized for the reads that pass the sampling; without
+                        # an estimate the filter fills its memory cap
+                        capacity = expected_reads * (sample_fraction or 1) or self.dedup_memory * 8 / 20
+                        bloom = dedup.BloomFilter.for_capacity(capacity, self.dedup_memory)
+                        self.log(console, 'Removing duplicate reads')
+                    with trace.phase('filter_reads') as span:
+                        span.bytes_in = sum(file_size(path) for path in staged_files)
+                        if screen_contaminants:
+                            screen = contaminants.ContaminantIndex.load(self.contaminant_dir, self.adapter_index_cache)
+                            self.log(console, 'Screening for contaminants: ' + ', '.join(screen.names))
+                        offsets = FileOffsets(staged_files)
+                        trace.progress.measure(offsets.total(), 'bytes')
+                        with trace.progress.poll(offsets):
+                            filter_result = filter_reads(stream_files, filtered, bloom, sampler, screen, screened)
+                        span.reads = filter_result['reads'] * len(streams)
+                        span.bytes_out = sum(file_size(path) for path in filtered)
+                        span.attributes['duplicates'] = filter_result['duplicates']
+                        span.attributes['sampled_out'] = filter_result['sampled_out']
+                        span.attributes['contaminants'] = filter_result['contaminants']
+                    filter_result['paired'] = read_type == 'PE'
+                    if sampler is not None:
+                        filter_result['fraction'] = sample_fraction
+                        filter_result['target'] = sample_target
+                    if bloom is not None:
+                        filter_result['filter_bytes'] = bloom.nbytes
+                        filter_result['false_positive_rate'] = bloom.false_positive_rate()
+                    if screen is not None:
+                        filter_result['screen'] = screen.names
+                        filter_result['screened_outputs'] = [os.path.basename(path) for path in screened]
+                    manifest.done('filter_reads', filtered + screened, data=filter_result)
+
+            pipes = [trimlog] if trimlog is not None else []
+            if filter_inputs:
+                # the read filter has merged the lanes already
+                inputs = staged_files = filtered
+                for path in filtered:
+                    job_dir.track(path, [trim_phase])
+            elif multi_lane:
+                # trimmomatic reads every direction as one stream of the lanes
+                inputs = [job_dir.path(('lanes_' + stream).rstrip('_') + '.fastq') for stream in streams]
+                pipes += [ConcatPipe(path, paths) for path, paths in zip(inputs, stream_files)]
+            else:
+                inputs = lane_inputs[0]
 
-            outputlines = []
+            outputs = self.trim_outputs(job_dir, read_type, inputs)
+            # trim log lines expected, one per read (mate)
+            if filter_result is not None:
+                expected_trimlog_reads = filter_result['kept'] * len(streams)
+            else:
+                expected_trimlog_reads = int(expected_reads * (2 if read_type == 'PE' else 1))
+
+            # Trimmomatic writes its outputs through pipes that bin the
+            # quality scores on the way to the output files (or uploads);
+            # shards are binned as they are gathered
+            targets = outputs
+            binning_stats = binning_copy = None
+            if binning is not None:
+                table = qualbin.lookup_table(binning, 64 if input_params['quality_encoding'] == 'phred64' else 33)
+                binning_stats = qualbin.BinningStats(binning)
+                if sharded:
+                    binning_copy = lambda source, output: qualbin.bin_stream(source, output, table, binning_stats)
+                else:
+                    targets = OrderedDict((key, job_dir.path('binning_' + os.path.basename(path)))
+                                          for key, path in outputs.items())
+                    pipes += [qualbin.BinningPipe(targets[key], path, table, binning_stats)
+                              for key, path in outputs.items()]
+            cmdstring = " ".join( [self.trimmomatic_command(), trimmomatic_options] +
+                                  [quote(path) for path in inputs + list(targets.values())] +
+                                  [trimmomatic_params] )
+
+            if self.stream_uploads:
+                self.log(console, 'Starting Trimmomatic, streaming its outputs to Shock')
+                counts, streamed_handles, output_summaries = self.trim_and_stream(
+                    console, trace, job_dir, read_type, staged_files, outputs, cmdstring, trimlog, pipes,
+                    input_params['quality_encoding'] if read_qc else None, headers, token, expected_trimlog_reads)
+            elif sharded:
+                self.log(console, 'Starting Trimmomatic on shards of the reads')
+                counts = self.scatter_trim(console, trace, read_type,
+                                           [[path] for path in filtered] if filter_inputs else stream_files,
+                                           outputs, input_params['quality_encoding'], trimmomatic_params,
+                                           binning_copy)
+            else:
+                self.log(console, 'Starting Trimmomatic')
+                with trace.phase('trim') as span:
+                    span.bytes_in = sum(file_size(path) for path in staged_files)
+                    with self.trim_progress(trace, trimlog, staged_files, expected_trimlog_reads):
+                        outputlines = self.run_trimmomatic(console, cmdstring, pipes, cwd=job_dir.root)
+
+                    #get read counts
+                    if trimlog is not None:
+                        counts = dict(trimlog.aggregator.categories)
+                    else:
+                        counts = self.parse_trimmomatic_counts(read_type, "".join(outputlines))
+
+                    span.reads = 2 * counts['input_read_pairs'] if read_type == 'PE' else counts['input_reads']
+                    span.bytes_out = sum(file_size(path) for path in outputs.values())
+
+            trimlog_report = trimlog.aggregator.format_report() if trimlog is not None else None
+            binning_result = binning_stats.to_dict() if binning_stats is not None else None
+            manifest.done('trim', [] if self.stream_uploads else outputs.values(),
+                          data={'outputs': [(key, os.path.basename(path)) for key, path in outputs.items()],
+                                'counts': counts,
+                                'handles': streamed_handles,
+                                'trimlog_report': trimlog_report,
+                                'binning': binning_result})
+            if output_summaries is not None:
+                manifest.done('qc_output', data=output_summaries)
+
+        libraries = self.output_libraries(read_type, outputs, counts) + \
+            self.contaminant_library(job_dir, filter_result)
+        if filter_result is not None and not self.contaminant_library(job_dir, filter_result):
+            # no contaminant found, nothing to upload
+            for name in filter_result.get('screened_outputs') or []:
+                job_dir.track(job_dir.path(name), [])
+        run_qc_output = read_qc and streamed_handles is None and manifest.get('qc_output') is None
+        for suffix, files, read_count, description in libraries:
+            # trimmed files go as soon as their upload has succeeded
+            pending = ['upload' + suffix] if manifest.get('upload' + suffix) is None else []
+            for path in files:
+                job_dir.track(path, (['qc_output'] if run_qc_output else []) + pending)
+
+        report = self.format_counts(read_type, counts)
+        if filter_result is not None:
+            notes = []
+            if filter_result.get('fraction') is not None:
+                notes.append(sampling.describe(filter_result))
+            if filter_result.get('screen') is not None:
+                notes.append(contaminants.describe(filter_result))
+            if filter_result.get('filter_bytes') is not None:
+                notes.append(dedup.describe(filter_result))
+            for note in notes:
+                self.log(console, note)
+            report = "\n".join(notes) + "\n\n" + report
+        if trimlog_report is not None:
+            report += "\n\n" + trimlog_report
+        if binning_result is not None and qualbin is not None:
+            binning_note = qualbin.describe(binning_result)
+            self.log(console, binning_note)
+            report += "\n\n" + binning_note
+
+        if read_qc:
+            if output_summaries is None:
+                output_summaries = manifest.data('qc_output')
+            if output_summaries is None:
+                if read_type == 'PE':
+                    output_streams = [('trimmed forward', [outputs['forward_paired'], outputs['forward_unpaired']]),
+                                      ('trimmed reverse', [outputs['reverse_paired'], outputs['reverse_unpaired']])]
+                else:
+                    output_streams = [('trimmed', [outputs['trimmed']])]
+                with trace.phase('qc_output') as span:
+                    output_summaries = self.run_read_qc(console, output_streams, input_params['quality_encoding'])
+                    span.reads = sum(summary['reads'] for _, summary in output_summaries)
+                manifest.done('qc_output', data=output_summaries)
+            qc_summaries += output_summaries
+
+        for suffix, files, read_count, description in libraries:
+            created = manifest.data('upload' + suffix)
+            if created is not None:
+                self.log(console, input_params['output_read_library'] + suffix + ' was uploaded by an earlier attempt.')
+            else:
+                if streamed_handles is not None and all(os.path.basename(path) in streamed_handles for path in files):
+                    created = self.save_streamed_library(trace, wsClient, input_params, provenance, suffix,
+                                                         [streamed_handles[os.path.basename(path)] for path in files],
+                                                         read_count, description)
+                else:
+                    created = self.upload_reads(console, trace, job_dir, env, input_params, suffix, files,
+                                                read_count, description)
+                manifest.done('upload' + suffix, data=created)
+            reportObj['objects_created'].append(created)
 
-            while True:
-                line = cmdProcess.stdout.readline()
-                outputlines.append(line)
-                if not line: break
-                self.log(console, line.replace('\n', ''))
+        # save report object
+        if multi_lane:
+            report = "Trimmed %d lanes as one run: %s\n\n" % (len(lane_names), ", ".join(lane_names)) + report
+        if preflight_notes:
+            report = "Pre-flight checks:\n" + "\n".join(preflight_notes) + "\n\n" + report
+        report += "\n\nPeak scratch usage: %d MB (%d MB reserved)" % (job_dir.peak_bytes >> 20, job_dir.reserved >> 20)
+        report += "\n" + console.summary()
+        reportObj['text_message'] = report + "\n\n" + trace.format_table()
+        reportObj['file_links'] = self.attach_log(console, headers, token)
+        if qc_summaries:
+            reportObj['direct_html'] = readqc.format_html(qc_summaries)
+        provenance[0]['description'] = trace.provenance_description()
+        reportName = 'trimmomatic_report_' + str(hex(uuid.getnode()))
+        with trace.phase('save_report'):
+            report_obj_info = wsClient.save_objects({
+                    'id':info[6],
+                    'objects':[
+                        {
+                            'type':'KBaseReport.Report',
+                            'data':reportObj,
+                            'name':reportName,
+                            'meta':{},
+                            'hidden':1,
+                            'provenance':provenance
+                        }
+                    ]
+                })[0]
+
+        self.log(console, 'Phase trace written to ' + str(trace.trace_path))
+        output = { 'report_name': reportName, 'report_ref': str(report_obj_info[6]) + '/' + str(report_obj_info[0]) + '/' + str(report_obj_info[4]) }
+        manifest.done('save_report', data=output)
 
-            report += "\n".join(outputlines)
+        return output
 
-            #get read count
-            match = re.search(r'Surviving: (\d+)', report)
-            readcount = match.group(1)
+    #END_CLASS_HEADER
 
-            #upload reads
-            cmdstring = " ".join( ('ws-tools fastX2reads --inputfile', 'trimmed_' + fr_file_name, 
-                                   '--wsurl', self.workspaceURL, '--shockurl', self.shockURL, '--outws', input_params['output_ws'],
-                                   '--outobj', input_params['output_read_library'], '--readcount', readcount ) )
+    # config contains contents of config file in a hash or None if it couldn't
+    # be found
+    def __init__(self, config):
+        #BEGIN_CONSTRUCTOR
+        self.workspaceURL = config['workspace-url']
+        self.shockURL = config['shock-url']
+        self.handleURL = config.get('handle-service-url')
+        self.input_resolver = InputResolver(parse_roots(config.get('staged-input-roots')),
+                                            config.get('staging-root') or None)
+        self.library_cache = wscache.TTLCache(int(config.get('workspace-cache-ttl', wscache.DEFAULT_TTL)))
+        self.scratch = os.path.abspath(config['scratch'])
+        if not os.path.exists(self.scratch):
+            os.makedirs(self.scratch)
+        self.trace_dir = config.get('trace-dir', self.scratch)
+        self.profile = config.get('profile', 'none')
+        metrics.register_disk_usage(self.scratch)
+        self.sniff_bytes = int(config.get('sniff-bytes', 4 * 1024 * 1024))
+        self.adapter_index_cache = config.get('adapter-index-cache', self.scratch)
+        self.contaminant_dir = config.get('contaminant-dir', '/kb/module/contaminants')
+        self.keep_job_dirs = self.is_enabled(config.get('keep-job-dirs', 'false'))
+        self.scratch_budget = int(config.get('scratch-budget', 0))
+        self.resume_jobs = self.is_enabled(config.get('resume-jobs', 'true'))
+        self.stream_uploads = self.is_enabled(config.get('stream-uploads', 'false'))
+        self.resume_max_age = int(config.get('resume-max-age', 86400))
+        self.dedup_memory = int(config.get('dedup-memory-mb', 512)) << 20
+        self.qc_processes = int(config.get('qc-processes', 1))
+        self.progress_dir = config.get('progress-dir') or os.path.join(self.scratch, 'progress')
+        self.console_rate = int(config.get('console-rate', 50))
+        self.trimmomatic_threads = int(config.get('trimmomatic-threads') or 0)
+        self.trimmomatic_heap = int(config.get('trimmomatic-heap-mb') or 0) << 20
+        self.admission = AdmissionController(
+            config.get('admission-ledger') or os.path.join(self.scratch, 'admission.json'),
+            cpus=int(config.get('admission-cpus', 0)) or admission.node_cpus(),
+            memory=(int(config.get('admission-memory-mb', 0)) << 20) or admission.node_memory() * 4 // 5,
+            disk=(int(config.get('admission-disk-mb', 0)) << 20) or admission.disk_capacity(self.scratch) * 9 // 10,
+            max_queue=int(config.get('admission-max-queue', admission.DEFAULT_MAX_QUEUE)),
+            max_wait=int(config.get('admission-max-wait', admission.DEFAULT_MAX_WAIT)),
+            small_job_bytes=int(config.get('admission-small-job-mb', 1024)) << 20,
+            aging=int(config.get('admission-aging', admission.DEFAULT_AGING)),
+            lease=int(config.get('admission-lease', admission.DEFAULT_LEASE)),
+            enabled=self.is_enabled(config.get('admission-control', 'false')))
+        self.scatter_queue = config.get('scatter-queue') or None
+        self.scatter_min_bytes = int(config.get('scatter-min-mb', 10240)) << 20
+        self.scatter_shard_reads = int(config.get('scatter-shard-reads', scatter.DEFAULT_SHARD_READS))
+        self.scatter_local_workers = int(config.get('scatter-local-workers', 2))
+        self.scatter_lease = int(config.get('scatter-lease', scatter.DEFAULT_LEASE))
+        self.scatter_timeout = int(config.get('scatter-timeout', 0))
+        remove_stale(self.scratch, self.resume_max_age)
+        progress.remove_stale(self.progress_dir, self.resume_max_age)
+        #END_CONSTRUCTOR
+        pass
 
-            cmdProcess = subprocess.Popen(cmdstring, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, env=env)
-            stdout, stderr = cmdProcess.communicate()
-            #report += "cmdstring: " + cmdstring + " stdout: " + stdout + " stderr: " + stderr
-            reportObj['objects_created'].append({'ref':input_params['input_ws']+'/'+input_params['output_read_library'], 
-                        'description':'Trimmed Reads'})
+    def runTrimmomatic(self, ctx, input_params):
+        # ctx is the context object
+        # return variables are: output
+        #BEGIN runTrimmomatic
 
-        # save report object
-        reportObj['text_message'] = report
-        reportName = 'trimmomatic_report_' + str(hex(uuid.getnode()))
-        report_obj_info = wsClient.save_objects({
-                'id':info[6],
-                'objects':[
-                    {
-                        'type':'KBaseReport.Report',
-                        'data':reportObj,
-                        'name':reportName,
-                        'meta':{},
-                        'hidden':1,
-                        'provenance':provenance
-                    }
-                ]
-            })[0]
+        job_id = uuid.uuid4().hex
+        console = JobConsole(os.path.join(self.trace_dir, 'trimmomatic_log_' + job_id + '.txt'),
+                             rate=self.console_rate)
+        self.log(console, 'Running Trimmomatic with paramseters: ')
 
-        output = { 'report_name': reportName, 'report_ref': str(report_obj_info[6]) + '/' + str(report_obj_info[0]) + '/' + str(report_obj_info[4]) }
+        # async jobs publish their progress under the run id the server
+        # gave them, for runTrimmomatic_check
+        run_id = (ctx.get('rpc_context') or {}).get('run_id')
+        if run_id is not None and not progress.run_recorded(self.progress_dir, run_id):
+            self.log(console, 'WARNING: the progress-dir ' + self.progress_dir + ' of this job has no record of ' +
+                     'its run; it is not on storage shared with the service that submitted the job, or the ' +
+                     'record expired.  The job runs without publishing its progress.')
+            run_id = None
+        job_progress = JobProgress(state_path(self.progress_dir, run_id),
+                                   log=lambda message: self.log(console, message))
+        trace = JobTrace(trace_dir=self.trace_dir, profile=self.profile, job_id=job_id,
+                         listeners=[metrics.record_span], progress=job_progress)
+        trace.start_profiling()
+        metrics.JOBS_IN_FLIGHT.inc()
+        status = 'error'
+        try:
+            # a retry of the same request finds the directory and checkpoints
+            # its failed attempt left behind
+            job_key = run_key(ctx.get('user_id'), input_params) if self.resume_jobs else trace.job_id
+            # the job's share of the node is given back after its directory is gone
+            with self.admission.slot(job_id) as slot, \
+                    JobDirectory(self.scratch, job_key, keep=self.keep_job_dirs,
+                                 budget=self.scratch_budget, resumable=self.resume_jobs) as job_dir:
+                trace.listeners.append(job_dir.record_span)
+                manifest = Manifest(job_dir.root, job_key, enabled=self.resume_jobs)
+                output = self._run_trimmomatic(ctx, input_params, console, trace, job_dir, manifest, slot)
+                manifest.finish()
+            metrics.JOB_SCRATCH_PEAK.observe(job_dir.peak_bytes)
+            status = 'finished'
+        finally:
+            job_progress.finish(status)
+            trace.stop_profiling()
+            metrics.JOBS_IN_FLIGHT.dec()
+            console.close()
+            # the report carries the log; kept with the job directories for debugging
+            if not self.keep_job_dirs:
+                try:
+                    os.remove(console.path)
+                except OSError:
+                    pass
 
         #END runTrimmomatic
 
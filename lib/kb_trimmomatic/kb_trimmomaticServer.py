@@ -1,21 +1,29 @@
 #!/usr/bin/env python
-from wsgiref.simple_server import make_server
+# Started from the kb-sdk server template, but maintained by hand: the build
+# no longer runs kb-sdk compile, which would regenerate this file without
+# the /metrics endpoint, the job progress plumbing and the lazy loading.
+#
+# The async job entry point runs this file once per job, so only what every
+# caller needs is imported and built when the module loads; the WSGI server,
+# the Globus auth client, the job service client, the Impl and the
+# Application are imported or built on first use.  The async CLI never builds
+# the Application: it validates the token with the shared auth client and
+# dispatches through the shared rpc service.
 import sys
 import json
 import traceback
 import datetime
-from multiprocessing import Process
-from getopt import getopt, GetoptError
+import threading
 from jsonrpcbase import JSONRPCService, InvalidParamsError, KeywordError,\
     JSONRPCError, ServerError, InvalidRequestError
 from os import environ
 from ConfigParser import ConfigParser
 from biokbase import log
-import biokbase.nexus
-import requests as _requests
-import urlparse as _urlparse
 import random as _random
 import os
+import time
+import uuid
+from kb_trimmomatic import metrics, progress
 
 DEPLOY = 'KB_DEPLOYMENT_CONFIG'
 SERVICE = 'KB_SERVICE_NAME'
@@ -42,8 +50,49 @@ def get_config():
 
 config = get_config()
 
-from kb_trimmomatic.kb_trimmomaticImpl import kb_trimmomatic
-impl_kb_trimmomatic = kb_trimmomatic(config)
+_init_lock = threading.RLock()
+_impl = None
+
+
+def get_impl():
+    '''The Impl instance, imported and constructed on first use.'''
+    global _impl
+    with _init_lock:
+        if _impl is None:
+            from kb_trimmomatic.kb_trimmomaticImpl import kb_trimmomatic
+            _impl = kb_trimmomatic(config)
+        return _impl
+
+
+_rpc_service = None
+_auth_client = None
+
+
+def get_rpc_service():
+    '''The JSON-RPC service of the Impl's methods, built on first use.'''
+    global _rpc_service
+    with _init_lock:
+        if _rpc_service is None:
+            rpc_service = JSONRPCServiceCustom()
+            rpc_service.add(get_impl().runTrimmomatic,
+                            name='kb_trimmomatic.runTrimmomatic',
+                            types=[dict])
+            _rpc_service = rpc_service
+        return _rpc_service
+
+
+def get_auth_client():
+    '''The Globus auth client, imported and built on the first token validation.'''
+    global _auth_client
+    with _init_lock:
+        if _auth_client is None:
+            import biokbase.nexus
+            _auth_client = biokbase.nexus.Client(
+                config={'server': 'nexus.api.globusonline.org',
+                        'verify_ssl': True,
+                        'client': None,
+                        'client_secret': None})
+        return _auth_client
 
 
 class JSONObjectEncoder(json.JSONEncoder):
@@ -68,6 +117,7 @@ class AsyncJobServiceClient(object):
 
     def __init__(self, timeout=30 * 60, token=None,
                  ignore_authrc=True, trust_all_ssl_certificates=False):
+        import urlparse as _urlparse
         url = environ.get('KB_JOB_SERVICE_URL', None)
         if url is None and config is not None:
             url = config.get('job-service-url')
@@ -88,6 +138,7 @@ class AsyncJobServiceClient(object):
             raise ValueError('Timeout value must be at least 1 second')
 
     def _call(self, method, params, json_rpc_call_context = None):
+        import requests as _requests
         arg_hash = {'method': method,
                     'params': params,
                     'version': '1.1',
@@ -295,6 +346,21 @@ class MethodContext(dict):
                                  self['method'], self['call_id'])
 
 
+class LazyUserLog(object):
+    '''The user log of the async CLI, opened when a method first logs.'''
+
+    def __init__(self):
+        self._log = None
+
+    def __getattr__(self, name):
+        with _init_lock:
+            if self._log is None:
+                self._log = log.log(
+                    get_service_name() or 'kb_trimmomatic', ip_address=True, authuser=True,
+                    module=True, method=True, call_id=True, config=get_config_file())
+        return getattr(self._log, name)
+
+
 def getIPAddress(environ):
     xFF = environ.get('HTTP_X_FORWARDED_FOR')
     realIP = environ.get('HTTP_X_REAL_IP')
@@ -332,19 +398,26 @@ class Application(object):
             submod, ip_address=True, authuser=True, module=True, method=True,
             call_id=True, logfile=self.userlog.get_log_file())
         self.serverlog.set_log_level(6)
-        self.rpc_service = JSONRPCServiceCustom()
+        self.rpc_service = get_rpc_service()
         self.method_authentication = dict()
-        self.rpc_service.add(impl_kb_trimmomatic.runTrimmomatic,
-                             name='kb_trimmomatic.runTrimmomatic',
-                             types=[dict])
         self.method_authentication['kb_trimmomatic.runTrimmomatic'] = 'required'
-        self.auth_client = biokbase.nexus.Client(
-            config={'server': 'nexus.api.globusonline.org',
-                    'verify_ssl': True,
-                    'client': None,
-                    'client_secret': None})
+        self._auth_client = None
+
+    @property
+    def auth_client(self):
+        # the shared client unless one was set on the application
+        return self._auth_client or get_auth_client()
+
+    @auth_client.setter
+    def auth_client(self, client):
+        self._auth_client = client
 
     def __call__(self, environ, start_response):
+        # every worker process shares its series from its first request on
+        metrics.share(config and config.get('metrics-dir'))
+        if environ.get('PATH_INFO', '').rstrip('/') == '/metrics':
+            return self.serve_metrics(environ, start_response)
+        start_time = time.time()
         # Context object, equivalent to the perl impl CallContext
         ctx = MethodContext(self.userlog)
         ctx['client_ip'] = getIPAddress(environ)
@@ -396,13 +469,18 @@ class Application(object):
                         elif token is None and auth_req == 'optional':
                             pass
                         else:
+                            auth_start = time.time()
                             try:
                                 user, _, _ = \
                                     self.auth_client.validate_token(token)
                                 ctx['user_id'] = user
                                 ctx['authenticated'] = 1
                                 ctx['token'] = token
+                                metrics.AUTH_LATENCY.observe(
+                                    time.time() - auth_start, outcome='valid')
                             except Exception, e:
+                                metrics.AUTH_LATENCY.observe(
+                                    time.time() - auth_start, outcome='invalid')
                                 if auth_req == 'required':
                                     err = ServerError()
                                     err.data = \
@@ -431,7 +509,23 @@ class Application(object):
                                 'params': req['params']}
                             if 'rpc_context' in ctx:
                                 run_job_params['rpc_context'] = ctx['rpc_context']
+                            # the job publishes its progress under the run id,
+                            # and fails when the progress-dir holds no record of it
+                            run_id = uuid.uuid4().hex
+                            try:
+                                progress.record_run(get_impl().progress_dir, run_id)
+                                if run_job_params.get('rpc_context') is None:
+                                    run_job_params['rpc_context'] = {}
+                                run_job_params['rpc_context']['run_id'] = run_id
+                            except (IOError, OSError, ValueError), e:
+                                self.log(log.ERR, ctx, 'No progress for this job, ' + str(e))
+                                run_id = None
                             job_id = job_service_client.run_job(run_job_params)
+                            if run_id is not None:
+                                try:
+                                    progress.record_job(get_impl().progress_dir, job_id, run_id)
+                                except (IOError, OSError, ValueError), e:
+                                    self.log(log.ERR, ctx, 'No progress for job ' + str(job_id) + ': ' + str(e))
                             respond = {'version': '1.1', 'result': [job_id], 'id': req['id']}
                             rpc_result = json.dumps(respond, cls=JSONObjectEncoder)
                             status = '200 OK'
@@ -443,6 +537,10 @@ class Application(object):
                                 err = {'error': job_state['error']}
                                 rpc_result = self.process_error(err, ctx, req, None)
                             else:
+                                if finished == 0:
+                                    job_progress = progress.job_state(get_impl().progress_dir, job_id)
+                                    if job_progress is not None:
+                                        job_state['progress'] = job_progress
                                 respond = {'version': '1.1', 'result': [job_state], 'id': req['id']}
                                 rpc_result = json.dumps(respond, cls=JSONObjectEncoder)
                                 status = '200 OK'
@@ -491,6 +589,20 @@ class Application(object):
             ('content-type', 'application/json'),
             ('content-length', str(len(response_body)))]
         start_response(status, response_headers)
+        method_label = ctx['module'] + '.' + ctx['method'] if ctx['method'] else 'unknown'
+        metrics.REQUEST_LATENCY.observe(time.time() - start_time, method=method_label)
+        metrics.REQUESTS.inc(method=method_label, status=status.split(' ')[0])
+        return [response_body]
+
+    def serve_metrics(self, environ, start_response):
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Allow', 'GET, HEAD')])
+            return ['']
+        response_body = metrics.render()
+        start_response('200 OK', [('content-type', metrics.CONTENT_TYPE),
+                                  ('content-length', str(len(response_body)))])
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return ['']
         return [response_body]
 
     def process_error(self, error, context, request, trace=None):
@@ -518,7 +630,33 @@ class Application(object):
         hh,mm = divmod((delta.days * 24*60*60 + delta.seconds + 30) // 60, 60)
         return "%s%+02d:%02d" % (dtnow.isoformat(), hh, mm)
 
-application = Application()
+class LazyApplication(object):
+    '''
+    Stands in for the Application until it is first used: the WSGI
+    container, the async CLI and tests get the same object, but the
+    Application and the Impl behind it are only built by the first request
+    or attribute access.
+    '''
+
+    def __init__(self):
+        self.__dict__['_application'] = None
+
+    def get(self):
+        with _init_lock:
+            if self._application is None:
+                self.__dict__['_application'] = Application()
+            return self._application
+
+    def __call__(self, environ, start_response):
+        return self.get()(environ, start_response)
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get(), name, value)
+
+application = LazyApplication()
 
 # This is the uwsgi application dictionary. On startup uwsgi will look
 # for this dict and pull its configuration from here.
@@ -544,6 +682,8 @@ try:
         print "Monkeypatching std libraries for async"
         from gevent import monkey
         monkey.patch_all()
+    # build it before uwsgi forks its workers, not in the first request
+    application.get()
     uwsgi.applications = {
         '': application
         }
@@ -563,8 +703,11 @@ def start_server(host='localhost', port=0, newprocess=False):
     will also allow returning of the port number.'''
 
     global _proc
+    from wsgiref.simple_server import make_server
+    from multiprocessing import Process
     if _proc:
         raise RuntimeError('server is already running')
+    application.get()
     httpd = make_server(host, port, application)
     port = httpd.server_address[1]
     print "Listening on port %s" % port
@@ -590,9 +733,12 @@ def process_async_cli(input_file_path, output_file_path, token):
         req['version'] = '1.1'
     if 'id' not in req: 
         req['id'] = str(_random.random())[2:]
-    ctx = MethodContext(application.userlog)
+    # the job series of this process reach /metrics through the shared directory
+    metrics.share(config and config.get('metrics-dir'))
+    # the Application (its logs, its method table) is not built for one call
+    ctx = MethodContext(LazyUserLog())
     if token:
-        user, _, _ = application.auth_client.validate_token(token)
+        user, _, _ = get_auth_client().validate_token(token)
         ctx['user_id'] = user
         ctx['authenticated'] = 1
         ctx['token'] = token
@@ -605,7 +751,7 @@ def process_async_cli(input_file_path, output_file_path, token):
     ctx['provenance'] = [prov_action]
     resp = None
     try:
-        resp = application.rpc_service.call_py(ctx, req)
+        resp = get_rpc_service().call_py(ctx, req)
     except JSONRPCError as jre:
         trace = jre.trace if hasattr(jre, 'trace') else None
         resp = {'id': req['id'],
@@ -640,6 +786,7 @@ if __name__ == "__main__":
             else:
                 token = sys.argv[3]
         sys.exit(process_async_cli(sys.argv[1], sys.argv[2], token))
+    from getopt import getopt, GetoptError
     try:
         opts, args = getopt(sys.argv[1:], "", ["port=", "host="])
     except GetoptError as err:
@@ -0,0 +1,96 @@
+"""
+Trimming several lane level read libraries as one.
+
+A sequencing run often arrives as one read library per lane.  When
+input_read_library is a list, every lane is staged on its own (downloaded,
+and deinterleaved where needed) and Trimmomatic reads all of them through
+one named pipe per read direction.  The pipe is fed by gzip -dcf with the
+lane files one after the other, decompressing the gzip'd ones on the way, so
+a single JVM trims every lane into one set of outputs and no merged copy of
+the inputs is ever written.
+
+The forward and the reverse pipe of a paired run are fed the lanes in the
+same order, which keeps the mates in step.
+"""
+import os
+import subprocess
+import time
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+
+def library_names(value):
+    '''input_read_library, a name or a list of lane library names, as a list.'''
+    names = list(value) if isinstance(value, (list, tuple)) else [value]
+    names = [name for name in names if name]
+    if not names:
+        raise ValueError('input_read_library is empty')
+    if len(set(names)) != len(names):
+        raise ValueError('input_read_library lists the same library more than once')
+    return names
+
+
+def check_lanes(names, sniffs):
+    '''
+    Lanes are trimmed with one quality encoding; raise ValueError when the
+    sampled reads of the lanes disagree on it.  sniffs holds the forward
+    SniffResult of every lane, in the order of names.
+    '''
+    offsets = {}
+    for name, sniff in zip(names, sniffs):
+        if sniff is not None and sniff.quality_offset is not None:
+            offsets.setdefault(sniff.quality_offset, []).append(name)
+    if len(offsets) > 1:
+        raise ValueError('The lanes use different quality encodings (' +
+                         '; '.join('phred%d: %s' % (offset, ', '.join(lane_names))
+                                   for offset, lane_names in sorted(offsets.items())) +
+                         ') and cannot be trimmed together')
+
+
+class ConcatPipe(object):
+    '''
+    A named pipe that reads as the concatenation of sources, each one
+    decompressed if it is gzip'd.
+
+        with ConcatPipe(path, ['lane1.fastq.gz', 'lane2.fastq']) as pipe:
+            run trimmomatic reading pipe.path
+    '''
+
+    def __init__(self, path, sources):
+        self.path = path
+        self.sources = list(sources)
+        self._process = None
+
+    def __enter__(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.mkfifo(self.path)
+        # the shell opens the pipe, so it is gzip that waits for the reader
+        cmdstring = ('exec gzip -dcf ' + ' '.join(quote(source) for source in self.sources) +
+                     ' > ' + quote(self.path))
+        self._process = subprocess.Popen(cmdstring, shell=True, stderr=subprocess.PIPE)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        deadline = time.time() + 1
+        while self._process.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if self._process.poll() is None:
+            # the reader never opened the pipe (e.g. Trimmomatic failed on
+            # startup) or stopped reading; opening the read end without
+            # blocking releases the writer, which then fails on a broken pipe
+            try:
+                fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                pass
+        stderr = self._process.communicate()[1]
+        os.remove(self.path)
+        if exc_type is None and self._process.returncode != 0:
+            # a truncated lane would otherwise pass as a shorter input
+            raise ValueError('Reading the lanes ' + ', '.join(os.path.basename(source) for source in self.sources) +
+                             ' failed: ' + stderr.decode('utf-8', 'replace').strip())
+        return False
@@ -0,0 +1,117 @@
+"""
+Checkpoint manifest of a resumable job.
+
+A resumable job runs in a job directory named after run_key(), a digest of
+the user and the method parameters, so a retry of the same request finds the
+directory its previous attempt left behind.  The manifest in that directory
+records every finished phase with the size and modification time of the
+files it produced (and any small results the later phases need, such as read
+counts); the outputs are many GB, and reading them all back to hash them
+would cost every job more than resuming saves the few that fail.  A retry
+skips each phase whose outputs are still intact and continues from the first
+one that is not.
+
+A job that succeeded marks its manifest finished, and a finished manifest
+holds no checkpoints: the same request made again (with keep-job-dirs, the
+directory is still there) runs again rather than returning the old report.
+
+Checkpoints are only trusted for the version of the input library they were
+written for; check_source() drops them when the library has changed.
+"""
+import hashlib
+import json
+import os
+import time
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def run_key(*parts):
+    '''Stable digest of JSON serialisable request parts.'''
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _stat(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
+class Manifest(object):
+    '''
+    enabled -- when False nothing is recorded and no phase counts as
+               finished, for jobs that are not resumable
+    '''
+
+    def __init__(self, directory, key, enabled=True):
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.key = key
+        self.enabled = enabled
+        self.source = None
+        self.phases = {}
+        if enabled and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    record = json.load(f)
+                if record.get('key') == key and not record.get('finished'):
+                    self.source = record.get('source')
+                    self.phases = record.get('phases', {})
+            except (IOError, ValueError):
+                # a torn or foreign manifest, start over
+                pass
+
+    def check_source(self, source):
+        '''
+        Forget the checkpoints when they were written for a different input
+        library version.  Returns the names of the phases that are kept.
+        '''
+        if not self.enabled:
+            return []
+        if self.source is not None and self.source != source:
+            self.phases = {}
+        self.source = source
+        self._save()
+        return sorted(self.phases)
+
+    def done(self, phase, outputs=(), data=None):
+        if not self.enabled:
+            return
+        self.phases[phase] = {'finished': time.time(),
+                              'outputs': dict((os.path.basename(path), _stat(path)) for path in outputs),
+                              'data': data}
+        self._save()
+
+    def get(self, phase):
+        return self.phases.get(phase)
+
+    def data(self, phase):
+        record = self.phases.get(phase)
+        return record['data'] if record is not None else None
+
+    def intact(self, phase, paths):
+        '''True when phase finished earlier and each of paths is still the file it wrote.'''
+        record = self.phases.get(phase)
+        if record is None:
+            return False
+        for path in paths:
+            expected = record['outputs'].get(os.path.basename(path))
+            if expected is None:
+                return False
+            try:
+                if _stat(path) != expected:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def finish(self):
+        '''Mark the job done; its checkpoints are not resumed from again.'''
+        if not self.enabled:
+            return
+        self._save(finished=True)
+
+    def _save(self, finished=False):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': self.key, 'source': self.source, 'phases': self.phases, 'finished': finished},
+                      f, sort_keys=True, indent=1)
+        os.rename(tmp_path, self.path)
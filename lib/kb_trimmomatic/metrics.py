@@ -0,0 +1,516 @@
+"""
+Metrics registry rendered in the Prometheus text exposition format.
+
+The server exposes REGISTRY on the /metrics path next to the JSON-RPC handler.
+Every process records into a REGISTRY of its own: each uwsgi worker of the
+server, and each async job process, which is where the job series (jobs in
+flight, bytes moved, trim throughput, scratch peak) are recorded.  share()
+makes them one set of series: every process writes a snapshot of its
+registry to a directory shared by the server and the async job containers,
+every interval seconds and when it exits, and render() merges the snapshots,
+whichever worker a scrape reaches:
+
+    counters, histograms  summed over all snapshots; the snapshots of
+                          processes that stopped writing them are folded
+                          into an archive, so totals never go back
+    gauges                summed over the processes still writing
+                          snapshots; gauges evaluated at scrape time are
+                          the scraped worker's own
+
+Without share() a process renders its own series alone.
+"""
+import atexit
+import bisect
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+DEFAULT_SNAPSHOT_INTERVAL = 15.0
+# snapshots not rewritten for this many intervals belong to processes that are gone
+STALE_INTERVALS = 4
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value)
+
+
+class _Metric(object):
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('%s expects labels %s, got %s' %
+                             (self.name, list(self.labelnames), sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self, values=None):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.metric_type)]
+        lines.extend(self._samples(values))
+        return lines
+
+    def snapshot(self):
+        '''The values as JSON: a list of [label values, value] pairs.'''
+        with self._lock:
+            return [[list(key), value] for key, value in sorted(self._values.items())]
+
+    def merge(self, snapshots):
+        '''The values of the snapshots() of several processes, summed.'''
+        values = {}
+        for snapshot in snapshots:
+            for key, value in snapshot:
+                key = tuple(key)
+                values[key] = self._add(values.get(key), value)
+        return values
+
+    def since(self, snapshot, base):
+        '''snapshot less the values of the earlier snapshot base.'''
+        base = dict((tuple(key), value) for key, value in base)
+        return [[key, self._subtract(value, base.get(tuple(key)))] for key, value in snapshot]
+
+    def _add(self, total, value):
+        return value if total is None else total + value
+
+    def _subtract(self, value, base):
+        return value if base is None else value - base
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super(Counter, self).__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError('Counters can only be incremented')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self, values=None):
+        with self._lock:
+            items = sorted((self._values if values is None else values).items())
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, key), _format_value(value))
+                for key, value in items]
+
+
+class Gauge(_Metric):
+    '''
+    A gauge is either set explicitly or, when callback is given, evaluated at
+    scrape time (the callback returns a number).
+    '''
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self._values = {}
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def snapshot(self):
+        # gauges evaluated at scrape time are not shared
+        return [] if self.callback is not None else super(Gauge, self).snapshot()
+
+    def _subtract(self, value, base):
+        # a gauge is its current value, whatever it was before
+        return value
+
+    def _samples(self, values=None):
+        if self.callback is not None:
+            try:
+                value = self.callback()
+            except Exception:
+                # a failing probe must not break the whole scrape
+                return []
+            if value is None:
+                return []
+            return ['%s %s' % (self.name, _format_value(value))]
+        with self._lock:
+            items = sorted((self._values if values is None else values).items())
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, key), _format_value(value))
+                for key, value in items]
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state is not None else 0
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), [list(state[0]), state[1], state[2]]]
+                    for key, state in sorted(self._values.items())]
+
+    def _add(self, total, value):
+        if total is None:
+            return [list(value[0]), value[1], value[2]]
+        return [[a + b for a, b in zip(total[0], value[0])], total[1] + value[1], total[2] + value[2]]
+
+    def _subtract(self, value, base):
+        if base is None:
+            return value
+        return [[a - b for a, b in zip(value[0], base[0])], value[1] - base[1], value[2] - base[2]]
+
+    def _samples(self, values=None):
+        with self._lock:
+            items = sorted((key, (list(state[0]), state[1], state[2]))
+                           for key, state in (self._values if values is None else values).items())
+        lines = []
+        for key, (bucket_counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (self.name,
+                             _format_labels(self.labelnames, key, ('le', _format_value(float(bound)))),
+                             cumulative))
+            labels = _format_labels(self.labelnames, key)
+            lines.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if any(m.name == metric.name for m in self._metrics):
+                raise ValueError('Metric ' + metric.name + ' is already registered')
+            self._metrics.append(metric)
+        return metric
+
+    def get(self, name):
+        for metric in self._metrics:
+            if metric.name == name:
+                return metric
+        return None
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def metrics(self):
+        return list(self._metrics)
+
+    def snapshot(self):
+        '''The values of every metric as JSON, for merging with other processes.'''
+        return dict((metric.name, metric.snapshot()) for metric in self.metrics())
+
+    def since(self, snapshot, base):
+        '''What was recorded between the snapshot() base and snapshot.'''
+        return dict((metric.name, metric.since(snapshot.get(metric.name, []), base.get(metric.name, [])))
+                    for metric in self.metrics())
+
+    def render(self, snapshots=None):
+        '''
+        The exposition text, of this registry's values or, given snapshots
+        (dicts from snapshot(), from several processes), of their sums.
+        '''
+        lines = []
+        for metric in self.metrics():
+            values = None
+            if snapshots is not None:
+                values = metric.merge([snapshot.get(metric.name, []) for snapshot in snapshots])
+            lines.extend(metric.render(values))
+        return '\n'.join(lines) + '\n'
+
+
+class SharedMetrics(object):
+    '''
+    The snapshots of the registries of all processes writing to directory.
+
+    registry  -- this process's registry
+    directory -- shared by the server workers and the async job processes
+    interval  -- seconds between the snapshots of this process
+    '''
+
+    def __init__(self, registry, directory, interval=DEFAULT_SNAPSHOT_INTERVAL):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self.pid = os.getpid()
+        self.path = os.path.join(directory, 'snapshot_%s_%d_%s.json'
+                                 % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]))
+        self._archive = os.path.join(directory, 'archive.json')
+        self._thread = None
+        # the snapshot written last, and the one up to which this process's
+        # values are in the archive already: a snapshot not rewritten for a
+        # while (the process was stalled, not gone) is folded in all the same
+        self._written = None
+        self._folded = {}
+
+    def start(self):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        self.write()
+        self._thread = threading.Thread(target=self._run, name='metrics-snapshots')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self._exit)
+        return self
+
+    def _exit(self):
+        if self.pid == os.getpid():
+            self.write()
+
+    def _run(self):
+        while self.pid == os.getpid():
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except Exception:
+                # metrics never fail the process; the next snapshot tries again
+                pass
+
+    def _locked(self):
+        lock_file = open(os.path.join(self.directory, 'archive.lock'), 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def write(self):
+        snapshot = self.registry.snapshot()
+        with self._locked():
+            if self._written is not None and not os.path.exists(self.path):
+                self._folded = self._written
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'updated': time.time(), 'metrics': self.registry.since(snapshot, self._folded)}, f)
+            os.rename(tmp_path, self.path)
+            self._written = snapshot
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def collect(self):
+        '''
+        The snapshots to merge: the archive and those of the live processes.
+        Stale snapshots are folded into the archive first, without their
+        gauges.
+        '''
+        cutoff = time.time() - STALE_INTERVALS * self.interval
+        with self._locked():
+            archive = (self._read(self._archive) or {}).get('metrics', {})
+            live = []
+            stale = []
+            for name in os.listdir(self.directory):
+                if not (name.startswith('snapshot_') and name.endswith('.json')):
+                    continue
+                path = os.path.join(self.directory, name)
+                snapshot = self._read(path)
+                if snapshot is None:
+                    continue
+                if snapshot['updated'] < cutoff and path != self.path:
+                    stale.append((path, snapshot['metrics']))
+                else:
+                    live.append(snapshot['metrics'])
+            if stale:
+                merged = {}
+                for metric in self.registry.metrics():
+                    if metric.metric_type == 'gauge':
+                        continue
+                    values = metric.merge([archive.get(metric.name, [])] +
+                                          [metrics.get(metric.name, []) for _, metrics in stale])
+                    merged[metric.name] = [[list(key), value] for key, value in sorted(values.items())]
+                tmp_path = self._archive + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump({'updated': time.time(), 'metrics': merged}, f)
+                os.rename(tmp_path, self._archive)
+                for path, _ in stale:
+                    os.remove(path)
+                archive = merged
+        return [archive] + live
+
+    def render(self):
+        if self.pid == os.getpid():
+            self.write()
+        return self.registry.render(self.collect())
+
+
+REGISTRY = Registry()
+_shared = None
+
+
+def share(directory, interval=DEFAULT_SNAPSHOT_INTERVAL):
+    '''
+    Share REGISTRY through directory with the other processes writing to it.
+    Only the first call of a process starts sharing; a process forked from
+    one sharing already (a uwsgi worker) starts on its first call too.
+    '''
+    global _shared
+    if directory and (_shared is None or _shared.pid != os.getpid()):
+        _shared = SharedMetrics(REGISTRY, directory, interval).start()
+    return _shared
+
+
+def render():
+    '''The exposition text for /metrics: the series of every sharing process, or of this one.'''
+    if _shared is not None:
+        return _shared.render()
+    return REGISTRY.render()
+
+
+REQUEST_LATENCY = REGISTRY.histogram(
+    'kb_trimmomatic_request_latency_seconds',
+    'JSON-RPC request latency per method.', ('method',))
+REQUESTS = REGISTRY.counter(
+    'kb_trimmomatic_requests_total',
+    'JSON-RPC requests per method and outcome.', ('method', 'status'))
+AUTH_LATENCY = REGISTRY.histogram(
+    'kb_trimmomatic_auth_latency_seconds',
+    'Token validation latency.', ('outcome',))
+JOBS_IN_FLIGHT = REGISTRY.gauge(
+    'kb_trimmomatic_jobs_in_flight',
+    'runTrimmomatic calls currently executing.')
+BYTES_DOWNLOADED = REGISTRY.counter(
+    'kb_trimmomatic_downloaded_bytes_total',
+    'Bytes of read data downloaded from Shock.')
+BYTES_UPLOADED = REGISTRY.counter(
+    'kb_trimmomatic_uploaded_bytes_total',
+    'Bytes of trimmed read data handed to the uploader.')
+PHASE_SECONDS = REGISTRY.histogram(
+    'kb_trimmomatic_phase_seconds',
+    'Wall time of runTrimmomatic phases.', ('phase',))
+TRIM_THROUGHPUT = REGISTRY.histogram(
+    'kb_trimmomatic_trim_reads_per_second',
+    'Trimmomatic throughput per job.',
+    buckets=(1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7))
+WORKSPACE_CACHE = REGISTRY.counter(
+    'kb_trimmomatic_workspace_cache_total',
+    'Read library lookups answered from the cache or the workspace.', ('kind', 'result'))
+JOB_SCRATCH_PEAK = REGISTRY.histogram(
+    'kb_trimmomatic_job_scratch_peak_bytes',
+    'Peak scratch usage per job, sampled at phase boundaries.',
+    buckets=(1 << 20, 1 << 24, 1 << 27, 1 << 30, 1 << 32, 1 << 34, 1 << 36, 1 << 38))
+ADMISSION_WAITING = REGISTRY.gauge(
+    'kb_trimmomatic_admission_waiting_jobs',
+    'runTrimmomatic calls waiting for admission.')
+ADMISSION_WAIT = REGISTRY.histogram(
+    'kb_trimmomatic_admission_wait_seconds',
+    'Time jobs waited for admission, per outcome.', ('outcome',))
+ADMISSIONS = REGISTRY.counter(
+    'kb_trimmomatic_admissions_total',
+    'Admission decisions per outcome.', ('outcome',))
+
+
+def register_disk_usage(path):
+    '''
+    Export the used and free bytes of the filesystem holding path (the
+    scratch directory) and the space reserved by running jobs, evaluated at
+    scrape time.  Only the first call registers the gauges.
+    '''
+    from kb_trimmomatic.jobdir import reserved_bytes
+
+    def used():
+        st = os.statvfs(path)
+        return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+    def free():
+        st = os.statvfs(path)
+        return st.f_bavail * st.f_frsize
+
+    if REGISTRY.get('kb_trimmomatic_scratch_used_bytes') is None:
+        REGISTRY.gauge('kb_trimmomatic_scratch_used_bytes',
+                       'Used bytes on the scratch filesystem.', callback=used)
+        REGISTRY.gauge('kb_trimmomatic_scratch_free_bytes',
+                       'Bytes available to the service on the scratch filesystem.', callback=free)
+        REGISTRY.gauge('kb_trimmomatic_scratch_reserved_bytes',
+                       'Scratch bytes reserved by running jobs.', callback=reserved_bytes)
+
+
+def record_span(span):
+    '''JobTrace listener feeding finished phase spans into the registry.'''
+    PHASE_SECONDS.observe(span.wall_seconds, phase=span.name)
+    if span.name.startswith('download'):
+        BYTES_DOWNLOADED.inc(span.bytes_out)
+    elif span.name.startswith('upload'):
+        BYTES_UPLOADED.inc(span.bytes_in)
+    elif span.name == 'trim_upload':
+        # outputs streamed to Shock while trimming
+        BYTES_UPLOADED.inc(span.bytes_out)
+    if span.name in ('trim', 'trim_upload') and span.status == 'ok' and span.reads:
+        TRIM_THROUGHPUT.observe(span.reads_per_second())
@@ -0,0 +1,335 @@
+"""
+Live progress of a running job.
+
+An async runTrimmomatic job runs for hours on a large library, and
+runTrimmomatic_check used to report nothing but whether it had finished.
+JobProgress follows a job through its phases (the JobTrace reports every
+phase start and end) and is fed counts from inside the long phases:
+
+    download      bytes received, against the size Shock reports
+    filter_reads  offsets of the staged files, against their sizes
+    trim          reads in the trim log when -trimlog statistics are on,
+                  otherwise the offsets of the files Trimmomatic (or the
+                  lane pipes feeding it) reads, against their sizes
+
+Offsets are read from /proc/<pid>/fdinfo of this process and its children,
+so nothing in the data path has to count for them.  From the counts and the
+time the phase has run so far the remaining time of the phase is estimated.
+
+Updates are cheap and throttled: the state is written (atomically) to a JSON
+file at most every interval seconds and logged at most every log_interval
+seconds.  The state file is keyed by the run_id of the RPC context; the
+server sets the run_id of the async jobs it submits and records which job id
+it belongs to, so runTrimmomatic_check can merge the state into the job
+state it returns.
+
+This only works when the server and the async job containers see the same
+progress directory, on storage shared between their nodes.  The server
+records every run_id in it before it submits the job (record_run); a job
+with a run_id that finds no record of it (run_recorded) logs a warning and
+publishes no progress, as nobody would read it.  Like everything else here,
+that never fails the job.
+"""
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_INTERVAL = 5.0
+DEFAULT_LOG_INTERVAL = 60.0
+
+
+def state_path(progress_dir, run_id):
+    '''The state file of run_id, None unless run_id is a plain file name part.'''
+    if not run_id or not re.match(r'^[\w.-]+$', run_id) or run_id.startswith('.'):
+        return None
+    return os.path.join(progress_dir, 'progress_' + run_id + '.json')
+
+
+def _job_path(progress_dir, job_id):
+    return os.path.join(progress_dir, 'job_' + job_id)
+
+
+def _run_path(progress_dir, run_id):
+    return os.path.join(progress_dir, 'run_' + run_id)
+
+
+def _ensure_dir(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _write_atomic(path, text):
+    tmp_path = path + '.' + str(os.getpid()) + '.' + str(threading.current_thread().ident)
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.rename(tmp_path, path)
+
+
+def record_run(progress_dir, run_id):
+    '''Note, before submitting it, that the server gave an async job run_id.'''
+    if state_path(progress_dir, run_id) is None:
+        raise ValueError('Unexpected run id ' + repr(run_id))
+    _ensure_dir(progress_dir)
+    _write_atomic(_run_path(progress_dir, run_id), run_id)
+
+
+def run_recorded(progress_dir, run_id):
+    '''Whether the server that submitted the job of run_id shares progress_dir with it.'''
+    return state_path(progress_dir, run_id) is not None and os.path.isfile(_run_path(progress_dir, run_id))
+
+
+def record_job(progress_dir, job_id, run_id):
+    '''Remember the run_id of an async job, for job_state().'''
+    if state_path(progress_dir, job_id) is None:
+        raise ValueError('Unexpected job id ' + repr(job_id))
+    _ensure_dir(progress_dir)
+    _write_atomic(_job_path(progress_dir, job_id), run_id)
+
+
+def job_state(progress_dir, job_id):
+    '''The last progress state the job with job_id published, or None.'''
+    if state_path(progress_dir, job_id) is None:
+        return None
+    try:
+        with open(_job_path(progress_dir, job_id)) as f:
+            run_id = f.read().strip()
+        with open(state_path(progress_dir, run_id)) as f:
+            return json.load(f)
+    except (IOError, OSError, TypeError, ValueError):
+        return None
+
+
+def remove_stale(progress_dir, max_age):
+    '''Delete the state and job id files not updated for max_age seconds.'''
+    if not os.path.isdir(progress_dir):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(progress_dir):
+        path = os.path.join(progress_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            continue
+
+
+def _descendants(pid):
+    # pid and all processes below it, from the parent ids in /proc/*/stat
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/' + name + '/stat') as f:
+                stat = f.read()
+        except (IOError, OSError):
+            continue
+        # the command name in parentheses may contain spaces
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    found = [pid]
+    for parent in found:
+        found.extend(children.get(parent, []))
+    return found
+
+
+def _open_offsets(paths, pid):
+    # offset of every path some process under pid has open, the largest if
+    # it is open more than once
+    offsets = {}
+    for process in _descendants(pid):
+        fd_dir = '/proc/%d/fd' % process
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(os.path.join(fd_dir, fd))
+                if target not in paths:
+                    continue
+                with open('/proc/%d/fdinfo/%s' % (process, fd)) as info:
+                    for line in info:
+                        if line.startswith('pos:'):
+                            offsets[target] = max(offsets.get(target, 0), int(line.split()[1]))
+                            break
+            except (IOError, OSError, ValueError):
+                continue
+    return offsets
+
+
+class FileOffsets(object):
+    '''
+    Callable measuring how far the files in paths have been read by this
+    process and its children: the sum of the open offsets, where a file that
+    was open before and is closed now counts as read to its end.
+    '''
+
+    def __init__(self, paths, pid=None):
+        self.paths = [os.path.realpath(path) for path in paths]
+        self.pid = pid or os.getpid()
+        self.sizes = dict((path, os.path.getsize(path)) for path in self.paths if os.path.isfile(path))
+        self.seen = {}
+
+    def total(self):
+        return sum(self.sizes.values())
+
+    def __call__(self):
+        offsets = _open_offsets(self.sizes, self.pid)
+        for path in self.seen:
+            if path not in offsets:
+                self.seen[path] = self.sizes[path]
+        self.seen.update(offsets)
+        return sum(self.seen.values())
+
+
+class JobProgress(object):
+    '''
+    Progress of one job.
+
+    path         -- JSON file the state is published to, None to only log it
+    log          -- callable for the progress lines, or None
+    interval     -- least seconds between two writes of the state file
+    log_interval -- least seconds between two progress lines
+    '''
+
+    def __init__(self, path=None, log=None, interval=DEFAULT_INTERVAL, log_interval=DEFAULT_LOG_INTERVAL):
+        self.path = path
+        self.log = log
+        self.interval = interval
+        self.log_interval = log_interval
+        self.start_time = time.time()
+        self.phase = None
+        self.phase_start = self.start_time
+        self.phases_done = []
+        self.done = 0
+        self.total = 0
+        self.unit = None
+        self.bytes_downloaded = 0
+        self.reads_processed = 0
+        self.status = 'running'
+        self._published = 0
+        self._logged = self.start_time
+        self._lock = threading.Lock()
+        if path is not None:
+            try:
+                _ensure_dir(os.path.dirname(path))
+            except OSError:
+                # progress is best effort, it never fails the job
+                self.path = None
+
+    def start_phase(self, name):
+        with self._lock:
+            self.phase = name
+            self.phase_start = time.time()
+            self.done = self.total = 0
+            self.unit = None
+        self.publish(force=True)
+
+    def end_phase(self, span):
+        with self._lock:
+            self.phases_done.append(span.name)
+            self.phase = None
+        self.publish(force=True)
+
+    def measure(self, total, unit):
+        '''The amount of work of the current phase, in unit (bytes or reads).'''
+        with self._lock:
+            self.total = total
+            self.unit = unit
+
+    def add(self, amount, counter=None):
+        '''amount more work of the current phase done, also added to counter if given.'''
+        self.done += amount
+        if counter is not None:
+            setattr(self, counter, getattr(self, counter) + amount)
+        if time.time() - self._published >= self.interval:
+            self.publish()
+
+    def set(self, done, counter=None):
+        '''Work of the current phase done so far, from a polled measure.'''
+        if counter is not None:
+            setattr(self, counter, getattr(self, counter) + done - self.done)
+        self.done = done
+        if time.time() - self._published >= self.interval:
+            self.publish()
+
+    @contextmanager
+    def poll(self, sample, counter=None, interval=None):
+        '''Call sample() for the work done every interval seconds while the block runs.'''
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval or self.interval):
+                try:
+                    self.set(sample(), counter)
+                except Exception:
+                    # progress is best effort, it never fails the job
+                    pass
+
+        thread = threading.Thread(target=run, name='progress-poll')
+        thread.daemon = True
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+
+    def finish(self, status):
+        self.status = status
+        self.publish(force=True)
+
+    def state(self):
+        now = time.time()
+        elapsed = now - self.phase_start
+        state = {'status': self.status,
+                 'phase': self.phase,
+                 'phases_done': list(self.phases_done),
+                 'elapsed_seconds': round(now - self.start_time, 1),
+                 'phase_elapsed_seconds': round(elapsed, 1),
+                 'bytes_downloaded': self.bytes_downloaded,
+                 'reads_processed': self.reads_processed,
+                 'updated': now}
+        if self.unit is not None:
+            state.update({'done': self.done, 'total': self.total, 'unit': self.unit})
+            if self.total:
+                state['percent'] = round(min(100.0 * self.done / self.total, 100.0), 1)
+            if self.done and elapsed > 0:
+                rate = self.done / elapsed
+                state['rate_per_second'] = round(rate, 1)
+                if self.total:
+                    state['phase_eta_seconds'] = round(max(self.total - self.done, 0) / rate, 1)
+        return state
+
+    def describe(self, state):
+        line = 'Progress: ' + (state['phase'] or 'between phases')
+        if 'percent' in state:
+            line += ', %.1f%% of %d %s' % (state['percent'], state['total'], state['unit'])
+        elif 'done' in state:
+            line += ', %d %s' % (state['done'], state['unit'])
+        if 'phase_eta_seconds' in state:
+            line += ', about %d s left in this phase' % state['phase_eta_seconds']
+        return line
+
+    def publish(self, force=False):
+        now = time.time()
+        with self._lock:
+            if not force and now - self._published < self.interval:
+                return
+            self._published = now
+            state = self.state()
+            if self.path is not None:
+                try:
+                    _write_atomic(self.path, json.dumps(state, sort_keys=True))
+                except (IOError, OSError):
+                    pass
+            if self.log is not None and state['phase'] is not None and now - self._logged >= self.log_interval:
+                self._logged = now
+                self.log(self.describe(state))
@@ -0,0 +1,241 @@
+"""
+Lossy binning of the quality scores of the trimmed reads.
+
+Full resolution quality scores are close to random to gzip and make up
+most of the compressed size of the trimmed reads.  Binning them to a few
+levels, as recent Illumina instruments do themselves, shrinks the uploads
+and the stored libraries considerably and barely changes downstream
+results.  The schemes:
+
+    illumina8   2-9 -> 6, 10-19 -> 15, 20-24 -> 22, 25-29 -> 27,
+                30-34 -> 33, 35-39 -> 37, 40 and up -> 40
+                (0 and 1, no-calls, are kept)
+    illumina4   0-2 -> 2, 3-14 -> 12, 15-30 -> 23, 31 and up -> 37
+
+A BinningPipe is a named pipe Trimmomatic writes an output to; a background
+thread reads it as ReadBatches and writes every batch to the real output
+with its quality buffer passed through a 256 entry lookup table, one NumPy
+indexing operation per batch.  The output may itself be a pipe, such as the
+one a streamed upload reads.
+
+Trimmomatic gzips an output whose name ends in .gz, which the pipes keep,
+so bin_stream checks the first bytes: gzip'd reads are decompressed as they
+are read and compressed again (at GZIP_LEVEL) as they are written.
+
+To report the gain, the first SAMPLE_BYTES of every output are compressed
+as gzip does (zlib, level 6) both before and after binning.
+"""
+import gzip
+import os
+import threading
+import zlib
+
+import numpy as np
+
+from kb_trimmomatic.readbatch import DEFAULT_BLOCK_SIZE, read_batches
+
+# (lowest score of a bin, score written for it), in ascending order
+SCHEMES = {
+    'illumina8': ((2, 6), (10, 15), (20, 22), (25, 27), (30, 33), (35, 37), (40, 40)),
+    'illumina4': ((0, 2), (3, 12), (15, 23), (31, 37)),
+}
+
+LABELS = {
+    'illumina8': 'Illumina 8-level',
+    'illumina4': 'Illumina 4-level',
+}
+
+# highest printable character, the highest quality byte of any encoding
+_MAX_QUALITY_BYTE = ord('~')
+
+GZIP_LEVEL = 6
+SAMPLE_BYTES = 1 << 20
+
+
+def scheme_name(value):
+    '''The binning scheme asked for by a quality_binning parameter, None for no binning.'''
+    if value in (None, '', 'none'):
+        return None
+    if value not in SCHEMES:
+        raise ValueError('quality_binning must be one of ' + ', '.join(['none'] + sorted(SCHEMES)))
+    return value
+
+
+def lookup_table(scheme, phred_offset=33):
+    '''uint8 array mapping every quality byte to the byte of its bin.'''
+    table = np.arange(256, dtype=np.uint8)
+    for low, value in SCHEMES[scheme]:
+        # later, higher bins overwrite the top of the earlier ones
+        table[phred_offset + low:_MAX_QUALITY_BYTE + 1] = phred_offset + value
+    return table
+
+
+class BinningStats(object):
+
+    def __init__(self, scheme):
+        self.scheme = scheme
+        self.reads = 0
+        self.bases = 0
+        self.sample_bytes = 0
+        self.sample_gzip_before = 0
+        self.sample_gzip_after = 0
+        self._lock = threading.Lock()
+
+    def add(self, reads, bases):
+        with self._lock:
+            self.reads += reads
+            self.bases += bases
+
+    def add_sample(self, before, after):
+        gzip_before = len(zlib.compress(before, GZIP_LEVEL))
+        gzip_after = len(zlib.compress(after, GZIP_LEVEL))
+        with self._lock:
+            self.sample_bytes += len(before)
+            self.sample_gzip_before += gzip_before
+            self.sample_gzip_after += gzip_after
+
+    def to_dict(self):
+        return {'scheme': self.scheme, 'reads': self.reads, 'bases': self.bases,
+                'sample_bytes': self.sample_bytes, 'sample_gzip_before': self.sample_gzip_before,
+                'sample_gzip_after': self.sample_gzip_after}
+
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_READ_SIZE = 1 << 20
+
+
+class _Prefixed(object):
+    # read() of a file object whose first bytes have been read already
+    def __init__(self, f, head):
+        self.f = f
+        self.head = head
+
+    def read(self, size):
+        if self.head:
+            data, self.head = self.head[:size], self.head[size:]
+            return data
+        return self.f.read(size)
+
+
+class _Gunzip(object):
+    # read() of the decompressed data of a gzip'd file object that need not be
+    # seekable (GzipFile seeks on Python 2); members are read one after another
+    def __init__(self, f):
+        self.f = f
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = b''
+
+    def read(self, size):
+        pieces = [self._buffer]
+        buffered = len(self._buffer)
+        while buffered < size:
+            data = self.f.read(_READ_SIZE)
+            if not data:
+                break
+            while data:
+                piece = self._decompressor.decompress(data)
+                pieces.append(piece)
+                buffered += len(piece)
+                data = self._decompressor.unused_data
+                if data:
+                    self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = b''.join(pieces)
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def bin_stream(source, output, table, stats, block_size=DEFAULT_BLOCK_SIZE):
+    '''
+    Copy the FASTQ file object source to output with its qualities binned;
+    gzip'd reads are written gzip'd.
+    '''
+    head = source.read(len(_GZIP_MAGIC))
+    compressed = head == _GZIP_MAGIC
+    if compressed:
+        source = _Gunzip(_Prefixed(source, head))
+        output = gzip.GzipFile(fileobj=output, mode='wb', compresslevel=GZIP_LEVEL)
+    else:
+        source = _Prefixed(source, head)
+    first = True
+    for batch in read_batches(source, block_size):
+        before = batch.tofastq() if first else b''
+        batch.qualities = table[batch.qualities]
+        data = batch.tofastq()
+        if first:
+            stats.add_sample(before[:SAMPLE_BYTES], data[:SAMPLE_BYTES])
+            first = False
+        output.write(data)
+        stats.add(len(batch), len(batch.qualities))
+    if compressed:
+        # writes the gzip trailer, leaves the output itself open
+        output.close()
+
+
+def describe(stats):
+    '''The report line for the binning of a job, from BinningStats.to_dict().'''
+    line = 'Quality scores of %d reads binned to the %s scheme' % (stats['reads'], LABELS[stats['scheme']])
+    if stats['sample_gzip_before']:
+        saved = 100.0 * (1 - float(stats['sample_gzip_after']) / stats['sample_gzip_before'])
+        line += ('; gzip\'d, the first %.1f MB of the outputs shrink from %.1f MB to %.1f MB (%.0f%% smaller)'
+                 % (stats['sample_bytes'] / 1048576.0, stats['sample_gzip_before'] / 1048576.0,
+                    stats['sample_gzip_after'] / 1048576.0, saved))
+    return line
+
+
+class BinningPipe(object):
+    '''
+    A named pipe Trimmomatic writes an output to, copied to output with
+    binned qualities by a background thread.
+
+        with BinningPipe(path, output, lookup_table('illumina8'), stats) as pipe:
+            run trimmomatic writing to pipe.path
+    '''
+
+    def __init__(self, path, output, table, stats, block_size=DEFAULT_BLOCK_SIZE):
+        self.path = path
+        self.output = output
+        self.table = table
+        self.stats = stats
+        self.block_size = block_size
+        self.error = None
+        self._thread = None
+
+    def __enter__(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.mkfifo(self.path)
+        self._thread = threading.Thread(target=self._copy, name='quality-binning')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _copy(self):
+        try:
+            with open(self.path, 'rb') as pipe:
+                try:
+                    with open(self.output, 'wb') as output:
+                        bin_stream(pipe, output, self.table, self.stats, self.block_size)
+                except Exception as e:
+                    self.error = e
+                    # keep reading, a writer blocked on a full pipe would never finish
+                    while pipe.read(1 << 20):
+                        pass
+        except Exception as e:
+            self.error = e
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._thread.join(1)
+        if self._thread.is_alive():
+            # the writer never opened the pipe (e.g. Trimmomatic failed on
+            # startup) or is about to close it; opening the write end without
+            # blocking releases a reader stuck in open()
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                pass
+            self._thread.join()
+        os.remove(self.path)
+        if exc_type is None and self.error is not None:
+            raise self.error
+        return False
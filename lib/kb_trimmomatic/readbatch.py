@@ -0,0 +1,347 @@
+"""
+Columnar batches of FASTQ records.
+
+Stages that look at every read in Python (read QC, the read filter) spend
+most of their time turning FASTQ into one string per line.  A ReadBatch
+keeps a block of records as three concatenated byte buffers, names,
+sequences and qualities, each with an offset array, so whole batches can be
+handled with NumPy:
+
+    names[name_offsets[i]:name_offsets[i + 1]]    name of record i (no '@')
+
+parse_block() turns a block of FASTQ text into a batch with a handful of
+vectorised passes over the block (newline positions, one gather per field),
+and ReadBatch.tofastq() writes one back the same way; read_batches() walks a
+file block by block and aligned() lines up the batches of mates read from
+the files of two read directions.
+
+A batch can be handed to worker processes without pickling its buffers:
+share() copies it into one file in /dev/shm (memory backed, like
+multiprocessing.shared_memory on Linux, which Python 2 does not have) and
+returns a small SharedBatch handle; attach() maps that file read-only in the
+worker.  map_shared() runs a function over a stream of batches in a
+multiprocessing pool that way, with a bounded number of batches in flight.
+"""
+import collections
+import os
+import tempfile
+
+import numpy as np
+
+DEFAULT_BLOCK_SIZE = 8 << 20
+SHM_DIR = '/dev/shm'
+
+_NEWLINE = ord('\n')
+_CR = ord('\r')
+_AT = ord('@')
+_PLUS = ord('+')
+
+_EMPTY_BYTES = np.zeros(0, dtype=np.uint8)
+_NO_OFFSETS = np.zeros(1, dtype=np.int64)
+
+
+def _piece_mask(size, starts, ends):
+    # True for the bytes of the pieces [starts[i], ends[i]), which are in
+    # order and do not overlap: one np.repeat of alternating gap and piece
+    # flags over the gap and piece lengths
+    bounds = np.empty(2 * len(starts) + 2, dtype=np.int64)
+    bounds[0] = 0
+    bounds[1:-1:2] = starts
+    bounds[2:-1:2] = ends
+    bounds[-1] = size
+    flags = np.zeros(len(bounds) - 1, dtype=np.bool_)
+    flags[1::2] = True
+    return np.repeat(flags, np.diff(bounds))
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _gather(data, starts, ends):
+    # concatenation of data[starts[i]:ends[i]] for all i, and its offsets
+    return data[_piece_mask(len(data), starts, ends)], _offsets(ends - starts)
+
+
+def _split(buffer, offsets):
+    # the pieces of buffer as byte strings, slicing one bytes object is far
+    # cheaper than converting every piece of the array
+    data = buffer.tobytes()
+    bounds = offsets.tolist()
+    return [data[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+
+def _scatter(out, starts, buffer, offsets):
+    # inverse of _gather: copy the pieces of buffer to out[starts[i]:...]
+    out[_piece_mask(len(out), starts, starts + np.diff(offsets))] = buffer
+
+
+class ReadBatch(object):
+    '''
+    names, sequences, qualities -- uint8 arrays of the concatenated fields
+    *_offsets                   -- int64 arrays, one entry per record plus one
+    '''
+    __slots__ = ('names', 'name_offsets', 'sequences', 'sequence_offsets', 'qualities', 'quality_offsets')
+
+    def __init__(self, names, name_offsets, sequences, sequence_offsets, qualities, quality_offsets):
+        self.names = names
+        self.name_offsets = name_offsets
+        self.sequences = sequences
+        self.sequence_offsets = sequence_offsets
+        self.qualities = qualities
+        self.quality_offsets = quality_offsets
+
+    @classmethod
+    def empty(cls):
+        return cls(_EMPTY_BYTES, _NO_OFFSETS, _EMPTY_BYTES, _NO_OFFSETS, _EMPTY_BYTES, _NO_OFFSETS)
+
+    @classmethod
+    def from_records(cls, records):
+        '''Batch of (name, sequence, quality) byte strings.'''
+        columns = []
+        for field in range(3):
+            values = [record[field] for record in records]
+            offsets = _offsets(np.array([len(value) for value in values], dtype=np.int64))
+            columns += [np.frombuffer(b''.join(values), dtype=np.uint8).copy(), offsets]
+        return cls(*columns)
+
+    def __len__(self):
+        return len(self.sequence_offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.sequence_offsets)
+
+    def name(self, i):
+        return self.names[self.name_offsets[i]:self.name_offsets[i + 1]].tobytes()
+
+    def sequence(self, i):
+        return self.sequences[self.sequence_offsets[i]:self.sequence_offsets[i + 1]].tobytes()
+
+    def quality(self, i):
+        return self.qualities[self.quality_offsets[i]:self.quality_offsets[i + 1]].tobytes()
+
+    def records(self):
+        for i in range(len(self)):
+            yield self.name(i), self.sequence(i), self.quality(i)
+
+    def name_list(self):
+        return _split(self.names, self.name_offsets)
+
+    def sequence_list(self):
+        return _split(self.sequences, self.sequence_offsets)
+
+    def slice(self, start, stop):
+        '''Records start to stop, as a batch of views into this one.'''
+        columns = []
+        for buffer, offsets in ((self.names, self.name_offsets),
+                                (self.sequences, self.sequence_offsets),
+                                (self.qualities, self.quality_offsets)):
+            columns += [buffer[offsets[start]:offsets[stop]], offsets[start:stop + 1] - offsets[start]]
+        return ReadBatch(*columns)
+
+    def take(self, mask):
+        '''The records where the boolean array mask is true, as a new batch.'''
+        mask = np.asarray(mask, dtype=np.bool_)
+        columns = []
+        for buffer, offsets in ((self.names, self.name_offsets),
+                                (self.sequences, self.sequence_offsets),
+                                (self.qualities, self.quality_offsets)):
+            columns += _gather(buffer, offsets[:-1][mask], offsets[1:][mask])
+        return ReadBatch(*columns)
+
+    def tofastq(self):
+        '''The batch as FASTQ text, '+' lines left empty.'''
+        name_lengths = np.diff(self.name_offsets)
+        sequence_lengths = self.lengths()
+        quality_lengths = np.diff(self.quality_offsets)
+        # @name\n sequence\n +\n quality\n
+        record_lengths = name_lengths + sequence_lengths + quality_lengths + 6
+        starts = _offsets(record_lengths)[:-1]
+        out = np.empty(int(record_lengths.sum()), dtype=np.uint8)
+        out[starts] = _AT
+        _scatter(out, starts + 1, self.names, self.name_offsets)
+        name_end = starts + 1 + name_lengths
+        out[name_end] = _NEWLINE
+        _scatter(out, name_end + 1, self.sequences, self.sequence_offsets)
+        sequence_end = name_end + 1 + sequence_lengths
+        out[sequence_end] = _NEWLINE
+        out[sequence_end + 1] = _PLUS
+        out[sequence_end + 2] = _NEWLINE
+        _scatter(out, sequence_end + 3, self.qualities, self.quality_offsets)
+        out[sequence_end + 3 + quality_lengths] = _NEWLINE
+        return out.tobytes()
+
+    def write(self, f):
+        f.write(self.tofastq())
+
+
+def parse_block(block):
+    '''
+    Parse the complete records at the start of block (bytes).  Returns the
+    ReadBatch and the number of bytes it was parsed from; the rest of the
+    block is the start of a record continuing in the next block.
+    '''
+    data = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(data == _NEWLINE)
+    lines = len(ends) - len(ends) % 4
+    if lines == 0:
+        return ReadBatch.empty(), 0
+    ends = ends[:lines]
+    consumed = int(ends[-1]) + 1
+    starts = np.zeros(lines, dtype=np.int64)
+    starts[1:] = ends[:-1] + 1
+    # lines without their \r\n
+    ends = ends - ((ends > starts) & (data[ends - 1] == _CR))
+    if not (data[starts[0::4]] == _AT).all() or not (data[starts[2::4]] == _PLUS).all():
+        bad = int(np.flatnonzero((data[starts[0::4]] != _AT) | (data[starts[2::4]] != _PLUS))[0])
+        raise ValueError('Not a FASTQ record: ' + repr(block[starts[4 * bad]:starts[4 * bad] + 60]))
+    names, name_offsets = _gather(data, starts[0::4] + 1, ends[0::4])
+    sequences, sequence_offsets = _gather(data, starts[1::4], ends[1::4])
+    qualities, quality_offsets = _gather(data, starts[3::4], ends[3::4])
+    if not np.array_equal(np.diff(sequence_offsets), np.diff(quality_offsets)):
+        bad = int(np.flatnonzero(np.diff(sequence_offsets) != np.diff(quality_offsets))[0])
+        raise ValueError('Malformed FASTQ record ' + repr(block[starts[4 * bad]:ends[4 * bad]]) +
+                         ': sequence and quality lengths differ')
+    batch = ReadBatch(names, name_offsets, sequences, sequence_offsets, qualities, quality_offsets)
+    return batch, consumed
+
+
+def read_batches(f, block_size=DEFAULT_BLOCK_SIZE):
+    '''ReadBatches of the FASTQ file object f, one per block_size bytes read.'''
+    rest = b''
+    while True:
+        chunk = f.read(block_size)
+        if not chunk:
+            break
+        block = rest + chunk
+        batch, consumed = parse_block(block)
+        rest = block[consumed:]
+        if len(batch):
+            yield batch
+    if rest.strip():
+        # the last record may lack its final newline
+        batch, consumed = parse_block(rest if rest.endswith(b'\n') else rest + b'\n')
+        if consumed < len(rest):
+            raise ValueError('Truncated FASTQ record at the end of the file: ' + repr(rest[:60]))
+        yield batch
+
+
+def aligned(sources, name='the read directions'):
+    '''
+    The batches of mates from sources, one iterator of ReadBatches per read
+    direction, as lists of one batch per direction that all hold the same
+    records.  Raises ValueError when the directions hold different numbers
+    of reads; name names them in the message.
+    '''
+    sources = [iter(source) for source in sources]
+    pending = [ReadBatch.empty() for _ in sources]
+    exhausted = [False] * len(sources)
+    while True:
+        for i, source in enumerate(sources):
+            while not len(pending[i]) and not exhausted[i]:
+                try:
+                    pending[i] = next(source)
+                except StopIteration:
+                    exhausted[i] = True
+        count = min(len(batch) for batch in pending)
+        if not count:
+            if any(len(batch) for batch in pending):
+                raise ValueError('The read files of ' + name + ' hold different numbers of reads')
+            return
+        yield [batch.slice(0, count) for batch in pending]
+        pending = [batch.slice(count, len(batch)) for batch in pending]
+
+
+class SharedBatch(object):
+    '''Picklable handle of a ReadBatch copied into a shared memory file by share().'''
+    __slots__ = ('path', 'sizes')
+
+    def __init__(self, path, sizes):
+        self.path = path
+        self.sizes = sizes
+
+    def __getstate__(self):
+        return self.path, self.sizes
+
+    def __setstate__(self, state):
+        self.path, self.sizes = state
+
+
+def _fields(batch):
+    # offsets first, they need the 8 byte alignment of the start of the file
+    return [batch.name_offsets, batch.sequence_offsets, batch.quality_offsets,
+            batch.names, batch.sequences, batch.qualities]
+
+
+def share(batch, directory=None):
+    '''Copy batch into a new file in /dev/shm (or the temp directory) and return its handle.'''
+    if directory is None:
+        directory = SHM_DIR if os.path.isdir(SHM_DIR) else tempfile.gettempdir()
+    fd, path = tempfile.mkstemp(prefix='readbatch_', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for array in _fields(batch):
+                f.write(np.ascontiguousarray(array).tobytes())
+    except Exception:
+        os.remove(path)
+        raise
+    return SharedBatch(path, [int(array.nbytes) for array in _fields(batch)])
+
+
+def attach(handle):
+    '''The ReadBatch of a SharedBatch handle, read-only views of the mapped file.'''
+    if not sum(handle.sizes):
+        return ReadBatch.empty()
+    data = np.memmap(handle.path, dtype=np.uint8, mode='r')
+    views = []
+    position = 0
+    for i, size in enumerate(handle.sizes):
+        view = data[position:position + size]
+        views.append(view.view(np.int64) if i < 3 else view)
+        position += size
+    name_offsets, sequence_offsets, quality_offsets, names, sequences, qualities = views
+    return ReadBatch(names, name_offsets, sequences, sequence_offsets, qualities, quality_offsets)
+
+
+def release(handle):
+    try:
+        os.remove(handle.path)
+    except OSError:
+        pass
+
+
+def _call_shared(func, handle):
+    return func(attach(handle))
+
+
+def map_shared(pool, func, batches, in_flight=None):
+    '''
+    Yield func(batch) for every batch, in order, computed in the processes
+    of a multiprocessing pool.  func must be picklable (a module level
+    function or an instance of a module level class); at most in_flight
+    batches (default: twice the pool size) are in shared memory at a time.
+    '''
+    if in_flight is None:
+        in_flight = 2 * max(getattr(pool, '_processes', 1) or 1, 1)
+    pending = collections.deque()
+    try:
+        for batch in batches:
+            handle = share(batch)
+            pending.append((handle, pool.apply_async(_call_shared, (func, handle))))
+            while len(pending) >= in_flight:
+                handle, result = pending.popleft()
+                try:
+                    yield result.get()
+                finally:
+                    release(handle)
+        while pending:
+            handle, result = pending.popleft()
+            try:
+                yield result.get()
+            finally:
+                release(handle)
+    finally:
+        for handle, _ in pending:
+            release(handle)
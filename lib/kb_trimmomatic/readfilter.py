@@ -0,0 +1,171 @@
+"""
+Read selection in one streaming pass over the staged inputs.
+
+Before trimming, the staged files of every read direction can be streamed
+once through a filter that drops reads Trimmomatic and the uploads would
+otherwise have to carry: reads outside a downsampled subset (sampling.py),
+contaminant reads (contaminants.py) and exact duplicates (dedup.py).  The
+files of one direction are read one after the other, so the pass also merges
+the lanes of a multi-lane run, and gzip'd inputs are decompressed on the
+way.  Paired reads are always kept or dropped as a pair.
+
+With NumPy the files are parsed and the kept reads written as ReadBatches
+(readbatch.py), a block at a time; without it, one line at a time.
+"""
+import gzip
+
+try:
+    from itertools import izip_longest as zip_longest
+except ImportError:
+    from itertools import zip_longest
+
+
+def open_fastq(path):
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_records(f, name=''):
+    # yields every FASTQ record as its four lines
+    while True:
+        header = f.readline()
+        if not header:
+            return
+        sequence = f.readline()
+        plus = f.readline()
+        quality = f.readline()
+        if not quality:
+            raise ValueError('Truncated FASTQ record at the end of ' + name)
+        yield header, sequence, plus, quality
+
+
+def load_readbatch():
+    '''The readbatch module, None without NumPy; imported when first needed.'''
+    try:
+        from kb_trimmomatic import readbatch
+    except ImportError:
+        return None
+    return readbatch
+
+
+def filter_reads(streams, outputs, bloom=None, sampler=None, screen=None, screened_outputs=None,
+                 batch_size=10000):
+    '''
+    streams  -- the input files of every read direction, [forward files,
+                reverse files] or [files]; the files of a direction are
+                read one after the other, like the lanes of one run
+    outputs  -- one (uncompressed) output file per read direction
+    bloom    -- dedup.BloomFilter to drop reads already seen, or None
+    sampler  -- sampling.HashSampler to keep a subset of the reads, or None
+    screen   -- contaminants.ContaminantIndex to drop contaminant reads, or None
+    screened_outputs -- files per read direction the contaminant reads are
+                written to, None to discard them
+
+    Returns a dict of the reads read, the reads sampled out, the
+    contaminants (in total and per contaminant) and duplicates dropped, and
+    the reads written, counting pairs for paired reads.  Reads are sampled
+    first and screened before duplicates are looked for, so the Bloom filter
+    only holds reads that are kept.  batch_size is the number of reads
+    screened at a time without NumPy.
+    '''
+    counts = {'reads': 0, 'sampled_out': 0, 'contaminants': 0, 'contaminant_sources': {},
+              'duplicates': 0, 'kept': 0}
+    writers = [open(path, 'wb') for path in outputs]
+    screened = [open(path, 'wb') for path in screened_outputs or []]
+    readbatch = load_readbatch()
+    batch = []
+
+    def count_contaminant(mask):
+        counts['contaminants'] += 1
+        for bit, name in enumerate(screen.names):
+            if mask & (1 << bit):
+                counts['contaminant_sources'][name] = counts['contaminant_sources'].get(name, 0) + 1
+
+    def filter_batches(mates):
+        # one ReadBatch per direction, holding the same reads
+        reads = len(mates[0])
+        counts['reads'] += reads
+        if sampler is not None:
+            keep = [sampler.keep_name(name) for name in mates[0].name_list()]
+            counts['sampled_out'] += keep.count(False)
+        else:
+            keep = [True] * reads
+        sequences = [batch.sequence_list() for batch in mates]
+        masks = [0] * reads
+        if screen is not None:
+            candidates = [i for i in range(reads) if keep[i]]
+            for direction in sequences:
+                found = screen.matches([direction[i] for i in candidates])
+                for i, hit in zip(candidates, found):
+                    masks[i] |= hit
+        contaminant = [False] * reads
+        for i in range(reads):
+            if not keep[i]:
+                continue
+            if masks[i]:
+                count_contaminant(masks[i])
+                keep[i] = False
+                contaminant[i] = True
+            elif bloom is not None and bloom.add(b'\t'.join(direction[i] for direction in sequences)):
+                counts['duplicates'] += 1
+                keep[i] = False
+            else:
+                counts['kept'] += 1
+        for writer, mate in zip(writers, mates):
+            mate.take(keep).write(writer)
+        for writer, mate in zip(screened, mates):
+            mate.take(contaminant).write(writer)
+
+    def flush():
+        masks = [0] * len(batch)
+        if screen is not None:
+            # a pair is a contaminant when either mate is
+            for direction in range(len(writers)):
+                found = screen.matches([mates[direction][1].rstrip() for mates in batch])
+                masks = [mask | hit for mask, hit in zip(masks, found)]
+        for mates, mask in zip(batch, masks):
+            if mask:
+                count_contaminant(mask)
+                for writer, record in zip(screened, mates):
+                    writer.writelines(record)
+                continue
+            if bloom is not None and bloom.add(b'\t'.join(record[1].rstrip() for record in mates)):
+                counts['duplicates'] += 1
+                continue
+            counts['kept'] += 1
+            for writer, record in zip(writers, mates):
+                writer.writelines(record)
+        del batch[:]
+
+    try:
+        for lane in zip(*streams):
+            readers = [open_fastq(path) for path in lane]
+            try:
+                if readbatch is not None:
+                    for mates in readbatch.aligned([readbatch.read_batches(reader) for reader in readers],
+                                                   ', '.join(lane)):
+                        filter_batches(mates)
+                    continue
+                records = [read_records(reader, path) for reader, path in zip(readers, lane)]
+                for mates in zip_longest(*records):
+                    if None in mates:
+                        raise ValueError('Forward and reverse reads files of ' + ', '.join(lane) +
+                                         ' hold different numbers of reads')
+                    counts['reads'] += 1
+                    if sampler is not None and not sampler.keep(mates[0][0]):
+                        counts['sampled_out'] += 1
+                        continue
+                    batch.append(mates)
+                    if len(batch) >= batch_size:
+                        flush()
+            finally:
+                for reader in readers:
+                    reader.close()
+        flush()
+    finally:
+        for writer in writers + screened:
+            writer.close()
+    return counts
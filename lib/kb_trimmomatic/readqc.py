@@ -0,0 +1,198 @@
+"""
+Single pass read QC with vectorised NumPy accumulators.
+
+ReadQC walks a FASTQ file (plain or gzip'd) once, in batches of reads, and
+accumulates fixed size count arrays:
+
+    quality    positions x 94   phred score counts per read position
+    bases      positions x 5    A/C/G/T/N counts per read position
+    lengths    positions + 1    read length distribution
+
+Positions beyond max_length are folded into the last position, so memory is
+bounded by max_length regardless of the library size.  Per-position quality
+quantiles are derived from the count matrix at the end.
+
+Files are parsed into columnar readbatch.ReadBatch blocks; qc_files() can
+spread the blocks of large files over a multiprocessing pool and merge the
+counts.
+"""
+import gzip
+import json
+
+import numpy as np
+
+from kb_trimmomatic.readbatch import DEFAULT_BLOCK_SIZE, map_shared, read_batches
+
+PHRED_LEVELS = 94
+BASES = 'ACGTN'
+QUANTILES = (0.10, 0.25, 0.50, 0.75, 0.90)
+
+# byte value -> column in the base composition matrix, anything unknown is N
+_BASE_CODE = np.full(256, 4, dtype=np.int64)
+for _code, _base in enumerate('ACGT'):
+    _BASE_CODE[ord(_base)] = _code
+    _BASE_CODE[ord(_base.lower())] = _code
+
+
+def open_fastq(path):
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+class ReadQC(object):
+
+    def __init__(self, max_length=500, phred_offset=33):
+        self.max_length = max_length
+        self.phred_offset = phred_offset
+        self.reads = 0
+        self.quality = np.zeros((max_length, PHRED_LEVELS), dtype=np.int64)
+        self.bases = np.zeros((max_length, len(BASES)), dtype=np.int64)
+        self.lengths = np.zeros(max_length + 1, dtype=np.int64)
+
+    def add_batch(self, sequences, qualities):
+        '''Accumulate a batch of sequence and quality strings (no newlines).'''
+        if not sequences:
+            return
+        lengths = np.fromiter((len(s) for s in sequences), dtype=np.int64, count=len(sequences))
+        self._accumulate(lengths, np.frombuffer(b''.join(sequences), dtype=np.uint8),
+                         np.frombuffer(b''.join(qualities), dtype=np.uint8))
+
+    def add_read_batch(self, batch):
+        '''Accumulate a readbatch.ReadBatch, straight from its buffers.'''
+        if len(batch):
+            self._accumulate(batch.lengths(), batch.sequences, batch.qualities)
+        return self
+
+    def _accumulate(self, lengths, seq, qual):
+        total = int(lengths.sum())
+        self.reads += len(lengths)
+        self.lengths += np.bincount(np.minimum(lengths, self.max_length),
+                                    minlength=self.max_length + 1)
+        if total == 0:
+            return
+        # position of every base within its read, from one flat arange
+        starts = np.cumsum(lengths) - lengths
+        positions = np.arange(total, dtype=np.int64) - np.repeat(starts, lengths)
+        np.minimum(positions, self.max_length - 1, out=positions)
+
+        codes = _BASE_CODE[seq]
+        self.bases += np.bincount(positions * len(BASES) + codes,
+                                  minlength=self.max_length * len(BASES)
+                                  ).reshape(self.max_length, len(BASES))
+
+        qual = qual.astype(np.int64)
+        qual -= self.phred_offset
+        np.clip(qual, 0, PHRED_LEVELS - 1, out=qual)
+        self.quality += np.bincount(positions * PHRED_LEVELS + qual,
+                                    minlength=self.max_length * PHRED_LEVELS
+                                    ).reshape(self.max_length, PHRED_LEVELS)
+
+    def merge(self, other):
+        '''Add the counts of another ReadQC with the same max_length.'''
+        self.reads += other.reads
+        self.quality += other.quality
+        self.bases += other.bases
+        self.lengths += other.lengths
+        return self
+
+    def add_file(self, path, block_size=DEFAULT_BLOCK_SIZE):
+        with open_fastq(path) as handle:
+            for batch in read_batches(handle, block_size):
+                self.add_read_batch(batch)
+        return self
+
+    def summary(self):
+        observed = int(self.lengths.nonzero()[0].max()) if self.lengths.any() else 0
+        positions = min(observed, self.max_length)
+        quality = self.quality[:positions]
+        bases = self.bases[:positions]
+        depth = quality.sum(axis=1)
+        cumulative = np.cumsum(quality, axis=1)
+        quantiles = {}
+        for q in QUANTILES:
+            # first score whose cumulative count reaches the quantile
+            threshold = np.maximum(np.ceil(depth * q), 1)[:, None]
+            quantiles['p%02d' % int(q * 100)] = (cumulative < threshold).sum(axis=1).tolist()
+        safe_depth = np.maximum(depth, 1)
+        mean_quality = (quality * np.arange(PHRED_LEVELS)).sum(axis=1) / safe_depth
+        composition = bases / safe_depth[:, None].astype(float)
+        base_totals = self.bases.sum(axis=0)
+        total_bases = int(base_totals.sum())
+        lengths = self.lengths[:observed + 1] if observed else self.lengths[:1]
+        return {'reads': self.reads,
+                'bases': total_bases,
+                'mean_length': round(float(total_bases) / self.reads, 2) if self.reads else 0,
+                'gc_fraction': round(float(base_totals[1] + base_totals[2]) / total_bases, 4)
+                if total_bases else 0,
+                'n_fraction': round(float(base_totals[4]) / total_bases, 6) if total_bases else 0,
+                'length_histogram': lengths.tolist(),
+                'quality_quantiles': quantiles,
+                'mean_quality': [round(v, 2) for v in mean_quality.tolist()],
+                'base_composition': dict((base, [round(v, 4) for v in composition[:, i].tolist()])
+                                         for i, base in enumerate(BASES))}
+
+
+class _BatchQC(object):
+    # picklable per-batch task for qc_files
+
+    def __init__(self, max_length, phred_offset):
+        self.max_length = max_length
+        self.phred_offset = phred_offset
+
+    def __call__(self, batch):
+        return ReadQC(self.max_length, self.phred_offset).add_read_batch(batch)
+
+
+def qc_files(paths, phred_offset=33, max_length=500, pool=None):
+    '''
+    ReadQC of all paths.  With a multiprocessing pool the read batches are
+    counted in its processes, passed through shared memory, while this
+    process parses the next blocks.
+    '''
+    qc = ReadQC(max_length, phred_offset)
+    for path in paths:
+        if pool is None:
+            qc.add_file(path)
+            continue
+        with open_fastq(path) as handle:
+            for part in map_shared(pool, _BatchQC(max_length, phred_offset), read_batches(handle)):
+                qc.merge(part)
+    return qc
+
+
+def format_html(summaries, step=10):
+    '''
+    Compact HTML for the report: one overview table and a per-position
+    quality table (every step-th position) for each summary, followed by the
+    full summaries as embedded JSON.
+
+    summaries -- list of (label, ReadQC.summary()) pairs
+    '''
+    html = ['<h3>Read QC</h3>',
+            '<table border="1" cellpadding="3"><tr><th>stream</th><th>reads</th>'
+            '<th>bases</th><th>mean length</th><th>GC</th><th>N</th></tr>']
+    for label, s in summaries:
+        html.append('<tr><td>%s</td><td>%d</td><td>%d</td><td>%.1f</td><td>%.2f%%</td><td>%.4f%%</td></tr>'
+                    % (label, s['reads'], s['bases'], s['mean_length'],
+                       100 * s['gc_fraction'], 100 * s['n_fraction']))
+    html.append('</table>')
+    for label, s in summaries:
+        q = s['quality_quantiles']
+        if not s['mean_quality']:
+            continue
+        html.append('<h4>%s: quality by position (p10 / p50 / p90, mean)</h4>' % label)
+        html.append('<table border="1" cellpadding="2"><tr><th>position</th>' +
+                    ''.join('<td>%d</td>' % (i + 1) for i in range(0, len(s['mean_quality']), step)) +
+                    '</tr>')
+        for name, values in (('p10', q['p10']), ('p50', q['p50']), ('p90', q['p90']),
+                             ('mean', s['mean_quality'])):
+            html.append('<tr><th>%s</th>' % name +
+                        ''.join('<td>%s</td>' % values[i] for i in range(0, len(values), step)) +
+                        '</tr>')
+        html.append('</table>')
+    html.append('<script type="application/json" id="read-qc">%s</script>'
+                % json.dumps(dict(summaries), separators=(',', ':')).replace('</', '<\\/'))
+    return '\n'.join(html)
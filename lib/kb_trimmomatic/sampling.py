@@ -0,0 +1,104 @@
+"""
+Deterministic downsampling of the input reads.
+
+Many downstream apps need about 100x coverage, but libraries are often
+sequenced far deeper.  With one of downsample_reads, downsample_fraction or
+downsample_coverage (with genome_size) the read filter pass over the staged
+inputs (see readfilter.py) keeps a subset of the reads, so the dropped reads
+never reach Trimmomatic or the uploads.
+
+A read is kept when a hash of its name falls below fraction * 2^64.  Mates
+share their name, so pairs stay together, the same input always gives the
+same subset, and the subset for a smaller fraction is contained in the one
+for a larger fraction.  A target read count or coverage is turned into a
+fraction with the number of reads the pre-flight sample predicts, so the
+subset comes close to the target rather than hitting it exactly; the report
+gives the number actually kept.
+"""
+import hashlib
+import re
+import struct
+
+HASH_RANGE = 1 << 64
+
+_MATE_SUFFIX = re.compile(br'/[12]$')
+
+
+def read_name(header):
+    '''Name of a FASTQ header line without its comment and /1 /2 mate suffix.'''
+    return _mate_name(header[1:])
+
+
+def _mate_name(text):
+    fields = text.split()
+    return _MATE_SUFFIX.sub(b'', fields[0]) if fields else b''
+
+
+class HashSampler(object):
+
+    def __init__(self, fraction):
+        self.fraction = fraction
+        self.threshold = int(fraction * HASH_RANGE)
+
+    def keep(self, header):
+        return self.keep_name(header[1:])
+
+    def keep_name(self, name):
+        '''keep() for the header without its '@', as a ReadBatch holds the names.'''
+        digest = hashlib.md5(_mate_name(name)).digest()
+        return struct.unpack('<Q', digest[:8])[0] < self.threshold
+
+
+def _positive(input_params, name, kind):
+    value = input_params.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        value = kind(value)
+    except (TypeError, ValueError):
+        raise ValueError(name + ' must be a number')
+    if value <= 0:
+        raise ValueError(name + ' must be positive')
+    return value
+
+
+def fraction(input_params, expected_reads, bases_per_read):
+    '''
+    The fraction of the reads to keep for the downsampling parameters in
+    input_params and the read count it aims at, (None, None) when no
+    downsampling is requested.  For paired reads expected_reads counts
+    pairs and bases_per_read the bases of both mates.
+    '''
+    reads = _positive(input_params, 'downsample_reads', int)
+    share = _positive(input_params, 'downsample_fraction', float)
+    coverage = _positive(input_params, 'downsample_coverage', float)
+    genome_size = _positive(input_params, 'genome_size', int)
+    if len([value for value in (reads, share, coverage) if value is not None]) > 1:
+        raise ValueError('Give only one of downsample_reads, downsample_fraction and downsample_coverage')
+    if share is not None:
+        if share > 1:
+            raise ValueError('downsample_fraction must not be above 1')
+        return share, None
+    if coverage is not None:
+        if genome_size is None:
+            raise ValueError('downsample_coverage needs genome_size')
+        if not bases_per_read:
+            raise ValueError('Downsampling to a coverage needs the read lengths of the pre-flight check, '
+                             'which is disabled on this deployment')
+        reads = int(coverage * genome_size / bases_per_read)
+    if reads is None:
+        return None, None
+    if not expected_reads:
+        raise ValueError('Downsampling to a read count or coverage needs the read count estimate of the '
+                         'pre-flight check, which is disabled on this deployment')
+    return min(float(reads) / expected_reads, 1.0), reads
+
+
+def describe(result):
+    '''Report line for the checkpointed result of a read filter pass that downsampled.'''
+    unit = 'read pairs' if result['paired'] else 'reads'
+    line = ('Downsampled to %d of %d %s (fraction %.4g)'
+            % (result['reads'] - result['sampled_out'], result['reads'], unit, result['fraction']))
+    if result.get('target') is not None:
+        line += ', aiming at %d' % result['target']
+    return line
@@ -0,0 +1,507 @@
+"""
+Scatter/gather trimming through a work queue on shared storage.
+
+One node limits the size of the libraries a job can trim in reasonable
+time.  In scatter mode the job (the coordinator) splits its reads into
+shards of whole records (pairs for paired reads) on shared storage,
+publishes one task per shard to a queue directory, and waits while worker
+processes, on this node or any node that mounts the same storage, trim the
+shards.  It then concatenates the outputs of the shards in shard order, so
+the gathered files hold the reads in the order a single run would have
+written them, and adds up the read counts of every shard.
+
+The queue is a directory:
+
+    tasks/<job>-<shard>.json     published, waiting for a worker
+    claimed/<job>-<shard>.json   taken by a worker, which touches it while
+                                 the shard is trimmed
+    done/<job>-<shard>.json      the result: return code and output tail
+    shards/<job>/                the shard inputs and outputs
+
+A worker claims a task by renaming it from tasks/ to claimed/.  The rename
+is atomic on a single filesystem (NFS included), so of several workers
+racing for a task exactly one gets it.  The lease is kept on the
+coordinator's clock alone: a claimed task whose modification time the
+coordinator has not seen change for lease seconds belonged to a worker
+that died and is published again, up to max_attempts times.  The clocks of
+the worker nodes and of the file server never enter it.  Every attempt
+writes outputs of its own (retry<attempt>_<name> after the first), so a
+worker thought dead that finishes after all cannot overwrite the outputs of
+the attempt that replaced it; the result names the outputs it wrote.
+
+The coordinator starts local_workers worker processes itself, so the mode
+works on a single machine; on other nodes workers are started with
+
+    python -m kb_trimmomatic.scatter /shared/scatter-queue
+
+A task describes the trimming, not how to run it: the read type, the quality
+encoding, the threads, the shard inputs and outputs and the Trimmomatic
+steps.  The worker checks them, builds the Trimmomatic argument list itself
+and runs it without a shell; it only reads and writes files under shards/.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+from kb_trimmomatic.readfilter import load_readbatch, open_fastq, read_records
+
+try:
+    from itertools import izip_longest as zip_longest
+except ImportError:
+    from itertools import zip_longest
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+DEFAULT_SHARD_READS = 4000000
+DEFAULT_LEASE = 120
+DEFAULT_POLL = 1.0
+DEFAULT_MAX_ATTEMPTS = 3
+OUTPUT_TAIL_LINES = 200
+TRIMMOMATIC_JAR = '/kb/module/Trimmomatic-0.33/trimmomatic-0.33.jar'
+
+# a Trimmomatic step, NAME:arg:arg...; never an option or a second word
+_STEP = re.compile(r'\A[A-Z]+(:[^\s:]+)*\Z')
+_FILES = {'PE': (2, 4), 'SE': (1, 1)}
+
+
+class ShardFailed(ValueError):
+    pass
+
+
+def _ensure_dir(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _write_atomic(path, data):
+    tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.' + str(os.getpid()))
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def task_id(job, shard):
+    return '%s-%05d' % (job, shard)
+
+
+class WorkQueue(object):
+    '''
+    root  -- queue directory on storage shared by the coordinator and the workers
+    lease -- seconds after its last heartbeat a claimed task is considered lost
+    '''
+
+    def __init__(self, root, lease=DEFAULT_LEASE):
+        self.root = root
+        self.lease = lease
+        # claimed task -> (modification time last seen, local time it was first seen)
+        self._seen = {}
+        for state in ('tasks', 'claimed', 'done', 'shards'):
+            _ensure_dir(os.path.join(root, state))
+
+    def shard_dir(self, job):
+        return os.path.join(self.root, 'shards', job)
+
+    def _path(self, state, name):
+        return os.path.join(self.root, state, name + '.json')
+
+    def _names(self, state, job=None):
+        names = []
+        for file_name in os.listdir(os.path.join(self.root, state)):
+            if file_name.startswith('.') or not file_name.endswith('.json'):
+                continue
+            name = file_name[:-len('.json')]
+            if job is None or name.startswith(job + '-'):
+                names.append(name)
+        return sorted(names)
+
+    def publish(self, task):
+        _write_atomic(self._path('tasks', task['id']), task)
+
+    def pending(self, job=None):
+        '''Ids of the tasks published and not yet claimed.'''
+        return self._names('tasks', job)
+
+    def claim(self, job=None):
+        '''The task this worker now owns, None when there is none to take.'''
+        for name in self.pending(job):
+            claimed = self._path('claimed', name)
+            try:
+                os.rename(self._path('tasks', name), claimed)
+            except OSError:
+                # another worker was faster
+                continue
+            # the lease starts when the coordinator sees the claim, so
+            # nothing here depends on the claim still being in place
+            task = _read(claimed)
+            if task is not None:
+                return task
+        return None
+
+    def heartbeat(self, task):
+        try:
+            os.utime(self._path('claimed', task['id']), None)
+        except OSError:
+            pass
+
+    def complete(self, task, result):
+        _write_atomic(self._path('done', task['id']), result)
+        try:
+            os.remove(self._path('claimed', task['id']))
+        except OSError:
+            pass
+
+    def results(self, job):
+        '''Results of the finished tasks of job, by task id.'''
+        found = {}
+        for name in self._names('done', job):
+            result = _read(self._path('done', name))
+            if result is not None:
+                found[name] = result
+        return found
+
+    def requeue_stale(self, job, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        '''
+        Publish again the claimed tasks of job whose worker stopped touching
+        them; returns the ids of those that have used up their attempts.
+        Only the coordinator calls this, on its own clock: a heartbeat is any
+        change of the claim's modification time between two calls.
+        '''
+        exhausted = []
+        now = time.time()
+        finished = set(self._names('done', job))
+        claimed_names = self._names('claimed', job)
+        for name in list(self._seen):
+            if name.startswith(job + '-') and name not in claimed_names:
+                del self._seen[name]
+        for name in claimed_names:
+            claimed = self._path('claimed', name)
+            try:
+                mtime = os.path.getmtime(claimed)
+            except OSError:
+                continue
+            seen = self._seen.get(name)
+            if seen is None or seen[0] != mtime:
+                self._seen[name] = seen = (mtime, now)
+            if now - seen[1] < self.lease:
+                continue
+            task = _read(claimed)
+            if task is None or name in finished:
+                continue
+            task['attempt'] = task.get('attempt', 1) + 1
+            if task['attempt'] > max_attempts:
+                exhausted.append(name)
+                continue
+            self.publish(task)
+            del self._seen[name]
+            try:
+                os.remove(claimed)
+            except OSError:
+                pass
+        return exhausted
+
+    def discard(self, job):
+        for state in ('tasks', 'claimed', 'done'):
+            for name in self._names(state, job):
+                try:
+                    os.remove(self._path(state, name))
+                except OSError:
+                    pass
+                self._seen.pop(name, None)
+
+
+def split_shards(streams, directory, reads_per_shard=DEFAULT_SHARD_READS):
+    '''
+    Split the reads into shards of at most reads_per_shard records (pairs)
+    under directory.  streams holds the files of each read direction, read
+    one after the other and decompressed if gzip'd.  Returns the input files
+    and the read count of every shard, in order.
+    '''
+    _ensure_dir(directory)
+    readbatch = load_readbatch()
+    shards = []
+    files = []
+
+    def next_shard():
+        for f in files:
+            f.close()
+        paths = [os.path.join(directory, 'shard_%05d_%d.fastq' % (len(shards), number))
+                 for number in range(len(streams))]
+        files[:] = [open(path, 'wb') for path in paths]
+        shards.append([paths, 0])
+
+    try:
+        if readbatch is not None:
+            sources = [_chain(paths, readbatch.read_batches) for paths in streams]
+            for mates in readbatch.aligned(sources, 'the two directions'):
+                start = 0
+                while start < len(mates[0]):
+                    if not files or shards[-1][1] == reads_per_shard:
+                        next_shard()
+                    stop = min(len(mates[0]), start + reads_per_shard - shards[-1][1])
+                    for f, batch in zip(files, mates):
+                        batch.slice(start, stop).write(f)
+                    shards[-1][1] += stop - start
+                    start = stop
+        else:
+            sources = [_chain(paths) for paths in streams]
+            for records in zip_longest(*sources):
+                if any(record is None for record in records):
+                    raise ValueError('The read files of the two directions hold different numbers of reads')
+                if not files or shards[-1][1] == reads_per_shard:
+                    next_shard()
+                for f, record in zip(files, records):
+                    f.write(b''.join(record))
+                shards[-1][1] += 1
+    finally:
+        for f in files:
+            f.close()
+    return [(paths, count) for paths, count in shards]
+
+
+def _chain(paths, read_batches=None):
+    # the records of the files one after the other, or their batches
+    for path in paths:
+        f = open_fastq(path)
+        try:
+            items = read_batches(f) if read_batches else read_records(f, os.path.basename(path))
+            for item in items:
+                yield item
+        finally:
+            f.close()
+
+
+def _copy(source, output):
+    shutil.copyfileobj(source, output, 1 << 20)
+
+
+def gather(shard_outputs, outputs, copy=None):
+    '''
+    Concatenate the outputs of every shard, in shard order, into outputs.
+    copy(source, output) copies one open shard output to the open output,
+    by default unchanged.
+    '''
+    copy = copy or _copy
+    for number, path in enumerate(outputs):
+        with open(path, 'wb') as out:
+            for files in shard_outputs:
+                with open(files[number], 'rb') as f:
+                    copy(f, out)
+
+
+def _inside(path, directory):
+    path = os.path.realpath(path)
+    return path.startswith(os.path.join(os.path.realpath(directory), ''))
+
+
+def attempt_path(path, attempt):
+    '''Where an attempt writes the output path, so no two attempts share a file.'''
+    if attempt <= 1:
+        return path
+    return os.path.join(os.path.dirname(path), 'retry%d_%s' % (attempt, os.path.basename(path)))
+
+
+def trimmomatic_args(queue, task, jar=TRIMMOMATIC_JAR, heap_mb=0):
+    '''
+    The Trimmomatic argument list of a task and the outputs it writes; raises
+    ValueError for a task that is not a well formed trimming of files under
+    the shards directory of the queue.
+    '''
+    read_type = task.get('read_type')
+    if read_type not in _FILES:
+        raise ValueError('Unknown read type %r' % (read_type,))
+    if task.get('quality_encoding') not in ('phred33', 'phred64'):
+        raise ValueError('Unknown quality encoding %r' % (task.get('quality_encoding'),))
+    # 0 leaves the thread count to Trimmomatic
+    threads = task.get('threads', 0)
+    if not isinstance(threads, int) or isinstance(threads, bool) or threads < 0:
+        raise ValueError('Bad thread count %r' % (threads,))
+    inputs, outputs, steps = task.get('inputs'), task.get('outputs'), task.get('steps')
+    if not isinstance(inputs, list) or not isinstance(outputs, list) or \
+            (len(inputs), len(outputs)) != _FILES[read_type]:
+        raise ValueError('%s trimming needs %d inputs and %d outputs' % ((read_type,) + _FILES[read_type]))
+    outputs = [attempt_path(path, task.get('attempt', 1)) for path in outputs]
+    shards = os.path.join(queue.root, 'shards')
+    for path in inputs + outputs:
+        if not isinstance(path, string_types) or not _inside(path, shards):
+            raise ValueError('%r is not a file of the scatter queue' % (path,))
+    if not isinstance(steps, list) or not steps or \
+            not all(isinstance(step, string_types) and _STEP.match(step) for step in steps):
+        raise ValueError('Bad trimming steps %r' % (steps,))
+    args = ['java'] + (['-Xmx%dm' % heap_mb] if heap_mb else []) + ['-jar', jar, read_type] + \
+        (['-threads', str(threads)] if threads else []) + ['-' + task['quality_encoding']]
+    return args + inputs + outputs + steps, outputs
+
+
+def run_task(queue, task, jar=TRIMMOMATIC_JAR, heap_mb=0):
+    '''Trim one shard, touching the claim while Trimmomatic runs.'''
+    args, outputs = trimmomatic_args(queue, task, jar, heap_mb)
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(queue.lease / 4.0):
+            queue.heartbeat(task)
+
+    thread = threading.Thread(target=beat, name='scatter-heartbeat')
+    thread.daemon = True
+    thread.start()
+    start = time.time()
+    try:
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   cwd=os.path.dirname(outputs[0]))
+        tail = deque(maxlen=OUTPUT_TAIL_LINES)
+        for line in iter(process.stdout.readline, b''):
+            tail.append(line.decode('utf-8', 'replace').rstrip('\n'))
+        process.stdout.close()
+        returncode = process.wait()
+    finally:
+        stop.set()
+        thread.join()
+    return {'id': task['id'],
+            'attempt': task.get('attempt', 1),
+            'returncode': returncode,
+            'output': list(tail),
+            'outputs': outputs,
+            'seconds': round(time.time() - start, 3),
+            'worker': '%s:%d' % (socket.gethostname(), os.getpid())}
+
+
+def run_worker(root, job=None, poll=DEFAULT_POLL, lease=DEFAULT_LEASE, exit_when_idle=False,
+               jar=TRIMMOMATIC_JAR, heap_mb=0):
+    '''
+    Claim and trim tasks until stopped, or, with exit_when_idle, until no
+    task (of job, if given) is waiting.  Returns the number of tasks run.
+    jar and heap_mb (0 for the JVM default) set how Trimmomatic is started.
+    '''
+    queue = WorkQueue(root, lease)
+    done = 0
+    while True:
+        task = queue.claim(job)
+        if task is None:
+            if exit_when_idle:
+                return done
+            time.sleep(poll)
+            continue
+        try:
+            result = run_task(queue, task, jar, heap_mb)
+        except Exception as e:
+            result = {'id': task['id'], 'attempt': task.get('attempt', 1), 'returncode': -1,
+                      'output': ['%s' % (e,)], 'outputs': [], 'seconds': 0}
+        queue.complete(task, result)
+        done += 1
+
+
+class Coordinator(object):
+    '''
+    Runs the shards of one job through the queue:
+
+        coordinator = Coordinator(queue, job_id, local_workers=4)
+        results = coordinator.run(tasks, progress=...)
+
+    tasks describe the trimming of the shards, in shard order: read_type,
+    quality_encoding, threads, inputs, outputs and steps, as
+    trimmomatic_args takes them.  The results come back in the same order,
+    with the outputs each shard was written to.  timeout bounds the wait, 0
+    for none; jar and heap_mb are passed to the local workers.
+    '''
+
+    def __init__(self, queue, job, local_workers=1, poll=DEFAULT_POLL, timeout=0,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, jar=TRIMMOMATIC_JAR, heap_mb=0):
+        self.queue = queue
+        self.job = job
+        self.local_workers = local_workers
+        self.jar = jar
+        self.heap_mb = heap_mb
+        self.poll = poll
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+
+    def _start_workers(self):
+        workers = []
+        for _ in range(self.local_workers):
+            worker = multiprocessing.Process(target=run_worker, args=(self.queue.root,),
+                                             kwargs={'job': self.job, 'poll': self.poll,
+                                                     'lease': self.queue.lease, 'exit_when_idle': True,
+                                                     'jar': self.jar, 'heap_mb': self.heap_mb})
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        return workers
+
+    def run(self, tasks, progress=None):
+        ids = [task_id(self.job, shard) for shard in range(len(tasks))]
+        workers = []
+        start = time.time()
+        try:
+            for shard, (name, task) in enumerate(zip(ids, tasks)):
+                self.queue.publish(dict(task, id=name, job=self.job, shard=shard, attempt=1))
+            workers = self._start_workers()
+            while True:
+                results = self.queue.results(self.job)
+                if progress is not None:
+                    progress(len(results))
+                if len(results) == len(ids):
+                    break
+                exhausted = self.queue.requeue_stale(self.job, self.max_attempts)
+                if exhausted:
+                    raise ShardFailed('Shard %s was lost %d times, giving up' % (exhausted[0], self.max_attempts))
+                if self.timeout and time.time() - start > self.timeout:
+                    raise ShardFailed('%d of %d shards were not trimmed within %d s'
+                                      % (len(ids) - len(results), len(ids), self.timeout))
+                if self.local_workers and not any(worker.is_alive() for worker in workers) \
+                        and self.queue.pending(self.job):
+                    # tasks requeued after the local workers ran out of work
+                    workers = self._start_workers()
+                time.sleep(self.poll)
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+            self.queue.discard(self.job)
+        ordered = [results[name] for name in ids]
+        for result in ordered:
+            if result['returncode'] != 0:
+                raise ShardFailed('Trimming shard %s failed with return code %d:\n%s'
+                                  % (result['id'], result['returncode'], '\n'.join(result['output'][-20:])))
+        return ordered
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='kb_trimmomatic scatter worker')
+    parser.add_argument('queue', help='queue directory shared with the coordinators')
+    parser.add_argument('--poll', type=float, default=DEFAULT_POLL, help='seconds between looks for new tasks')
+    parser.add_argument('--lease', type=float, default=DEFAULT_LEASE,
+                        help='seconds without a heartbeat after which a claimed task is lost')
+    parser.add_argument('--exit-when-idle', action='store_true', help='stop once no task is waiting')
+    parser.add_argument('--jar', default=TRIMMOMATIC_JAR, help='the Trimmomatic jar')
+    parser.add_argument('--heap-mb', type=int, default=0, help='Java heap of Trimmomatic, 0 for the JVM default')
+    args = parser.parse_args(argv)
+    run_worker(args.queue, poll=args.poll, lease=args.lease, exit_when_idle=args.exit_when_idle,
+               jar=args.jar, heap_mb=args.heap_mb)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+Pre-flight inspection of read files before any bulk transfer.
+
+Only the first few MB of a Shock node are fetched (with a Range request, the
+download is cut short if the server ignores it).  From that sample the
+compression, the quality score offset, whether the file is interleaved and
+the read length distribution are determined, so a mislabelled library can be
+corrected or rejected before it is downloaded and trimmed in full.
+"""
+import bz2
+import re
+import zlib
+
+import requests
+
+DEFAULT_SAMPLE_BYTES = 4 * 1024 * 1024
+
+# Illumina 1.8+ comments (" 1:N:0:ATCACG") and old style /1 /2 mate suffixes
+_MATE_SUFFIX = re.compile(r'(/[12])$')
+
+
+def fetch_head(handle, headers, max_bytes=DEFAULT_SAMPLE_BYTES):
+    '''Return at most max_bytes from the start of a Shock node.'''
+    request_headers = dict(headers)
+    request_headers['Range'] = 'bytes=0-%d' % (max_bytes - 1)
+    r = requests.get(handle['url'] + '/node/' + handle['id'] + '?download',
+                     stream=True, headers=request_headers)
+    try:
+        r.raise_for_status()
+        chunks = []
+        received = 0
+        for chunk in r.iter_content(64 * 1024):
+            chunks.append(chunk)
+            received += len(chunk)
+            if received >= max_bytes:
+                break
+    finally:
+        r.close()
+    return b''.join(chunks)[:max_bytes]
+
+
+def read_head(path, max_bytes=DEFAULT_SAMPLE_BYTES):
+    with open(path, 'rb') as f:
+        return f.read(max_bytes)
+
+
+def decompress_head(data):
+    '''Return (compression, decompressed prefix) for a possibly truncated sample.'''
+    if data[:2] == b'\x1f\x8b':
+        return 'gzip', zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+    if data[:3] == b'BZh':
+        try:
+            return 'bzip2', bz2.BZ2Decompressor().decompress(data)
+        except (IOError, EOFError, ValueError):
+            return 'bzip2', b''
+    return 'none', data
+
+
+def base_name(name):
+    name = name.split()[0] if name.split() else name
+    return _MATE_SUFFIX.sub('', name)
+
+
+def parse_records(text, limit=None):
+    '''Complete FASTQ records (name, sequence, quality) from a sample.'''
+    lines = text.split(b'\n')
+    # the last line may be cut in the middle
+    lines = lines[:-1] if lines else lines
+    records = []
+    for i in range(0, len(lines) - 3, 4):
+        header, seq, plus, qual = lines[i:i + 4]
+        if not header.startswith(b'@') or not plus.startswith(b'+'):
+            raise ValueError('Not a FASTQ file: unexpected line ' + repr(header[:60]))
+        seq = seq.rstrip(b'\r')
+        qual = qual.rstrip(b'\r')
+        if len(seq) != len(qual):
+            raise ValueError('Malformed FASTQ record ' + repr(header[:60]) +
+                             ': sequence and quality lengths differ')
+        records.append((header[1:].rstrip(b'\r').decode('ascii', 'replace'), seq, qual))
+        if limit is not None and len(records) >= limit:
+            break
+    return records
+
+
+def quality_offset(records):
+    '''33, 64 or None when the sample does not tell them apart.'''
+    low, high = 255, 0
+    for _, _, qual in records:
+        if qual:
+            values = bytearray(qual)
+            low = min(low, min(values))
+            high = max(high, max(values))
+    if high == 0:
+        return None
+    if low < 59:
+        return 33
+    if low >= 64 and high > 75:
+        return 64
+    return None
+
+
+def is_interleaved(records):
+    '''
+    True when consecutive records are mates of the same fragment, False when
+    they are not, None when the sample is too small to tell.
+    '''
+    if len(records) < 4:
+        return None
+    names = [base_name(name) for name, _, _ in records]
+    pairs = len(names) // 2
+    mates = sum(1 for i in range(pairs) if names[2 * i] == names[2 * i + 1])
+    return mates == pairs and names[0] != names[2]
+
+
+def pairs_consistent(forward_records, reverse_records):
+    '''Whether the leading records of two mate files carry the same read names.'''
+    count = min(len(forward_records), len(reverse_records))
+    if count == 0:
+        return None
+    return all(base_name(forward_records[i][0]) == base_name(reverse_records[i][0])
+               for i in range(count))
+
+
+class SniffResult(object):
+
+    def __init__(self, sample):
+        self.bytes_sampled = len(sample)
+        self.compression, text = decompress_head(sample)
+        self.records = parse_records(text)
+        self.quality_offset = quality_offset(self.records)
+        self.interleaved = is_interleaved(self.records)
+        lengths = [len(seq) for _, seq, _ in self.records]
+        self.read_count = len(lengths)
+        self.length_min = min(lengths) if lengths else 0
+        self.length_max = max(lengths) if lengths else 0
+        self.length_mean = float(sum(lengths)) / len(lengths) if lengths else 0.0
+        # compressed bytes per record, to estimate the size of the whole file
+        self.bytes_per_record = float(self.bytes_sampled) / len(lengths) if lengths else 0.0
+
+    def to_dict(self):
+        return {'bytes_sampled': self.bytes_sampled,
+                'compression': self.compression,
+                'quality_offset': self.quality_offset,
+                'interleaved': self.interleaved,
+                'reads_sampled': self.read_count,
+                'length_min': self.length_min,
+                'length_max': self.length_max,
+                'length_mean': round(self.length_mean, 2)}
+
+    def describe(self):
+        return ('%s, %d reads sampled, length %d-%d (mean %.1f), phred offset %s, interleaved %s'
+                % (self.compression, self.read_count, self.length_min, self.length_max,
+                   self.length_mean, self.quality_offset, self.interleaved))
+
+
+def check_plan(input_params, forward, reverse=None, library_interleaved=False):
+    '''
+    Validate the trimming plan against the sniffed files.
+
+    Corrects input_params['quality_encoding'] when the sample is unambiguous
+    and raises ValueError for layouts that cannot produce a sensible result.
+    Returns a list of notes describing what was found or changed.
+    '''
+    notes = ['forward reads: ' + forward.describe()]
+    if reverse is not None:
+        notes.append('reverse reads: ' + reverse.describe())
+    if forward.read_count == 0:
+        raise ValueError('No complete FASTQ record in the first %d bytes of the reads file'
+                         % forward.bytes_sampled)
+
+    offsets = set(r.quality_offset for r in (forward, reverse) if r is not None) - set([None])
+    if len(offsets) > 1:
+        raise ValueError('Forward and reverse reads use different quality encodings')
+    if offsets:
+        detected = 'phred' + str(offsets.pop())
+        if detected != input_params['quality_encoding']:
+            notes.append('quality_encoding changed from ' + input_params['quality_encoding'] +
+                         ' to ' + detected + ' to match the reads')
+            input_params['quality_encoding'] = detected
+
+    if input_params['read_type'] == 'PE':
+        if reverse is None:
+            if forward.interleaved is False:
+                raise ValueError('The library is paired end in a single file, but consecutive '
+                                 'reads are not mates; it is not interleaved')
+            if forward.interleaved and not library_interleaved:
+                notes.append('single reads file is interleaved, deinterleaving it')
+        else:
+            if forward.interleaved:
+                raise ValueError('The forward reads file is interleaved although a separate '
+                                 'reverse reads file is given')
+            if pairs_consistent(forward.records, reverse.records) is False:
+                raise ValueError('Forward and reverse reads files are not in the same order '
+                                 '(read names differ)')
+    elif forward.interleaved:
+        raise ValueError('The reads look interleaved paired end reads, but read_type is SE')
+    return notes
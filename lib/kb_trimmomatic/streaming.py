@@ -0,0 +1,205 @@
+"""
+Uploading Trimmomatic outputs to Shock while Trimmomatic writes them.
+
+In overlap mode every output file Trimmomatic would write is a named pipe.
+A ShockStreamUpload thread reads its pipe and sends the data to a new Shock
+node as a chunked multipart POST, so trimming and network transfer run at
+the same time and the trimmed reads never touch the scratch disk.  On its
+way through, every chunk is passed to a RecordCounter that counts the FASTQ
+records (decompressing gzip'd output on the fly) and can feed them to a
+ReadQC, which replaces parsing the read counts from the Trimmomatic output
+afterwards and the separate read QC pass over the trimmed files.
+
+If an upload fails, its thread keeps draining the pipe so Trimmomatic is not
+blocked forever; the error is raised when the upload is closed.
+"""
+import os
+import threading
+import uuid
+import zlib
+
+import requests
+
+CHUNK_SIZE = 1 << 20
+
+
+class RecordCounter(object):
+    '''
+    Counts the FASTQ records and bytes of a stream fed in arbitrary chunks.
+    With a ReadQC, complete records are also added to it in batches.
+    '''
+
+    def __init__(self, qc=None, batch_size=50000):
+        self.qc = qc
+        self.batch_size = batch_size
+        self.bytes = 0
+        self.lines = 0
+        self._decompressor = None
+        self._started = False
+        self._unterminated = False
+        self._partial = b''
+        self._records = []
+
+    @property
+    def reads(self):
+        return self.lines // 4
+
+    def feed(self, chunk):
+        self.bytes += len(chunk)
+        if not self._started:
+            self._started = True
+            if chunk[:2] == b'\x1f\x8b':
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self._decompressor is not None:
+            chunk = self._decompressor.decompress(chunk)
+        if chunk:
+            self.lines += chunk.count(b'\n')
+            self._unterminated = not chunk.endswith(b'\n')
+        if self.qc is not None:
+            self._collect(chunk)
+
+    def _collect(self, chunk):
+        lines = (self._partial + chunk).split(b'\n')
+        self._partial = lines.pop()
+        self._records.extend(lines)
+        if len(self._records) >= 4 * self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        complete = len(self._records) - len(self._records) % 4
+        records = self._records[:complete]
+        self._records = self._records[complete:]
+        self.qc.add_batch([line.rstrip(b'\r') for line in records[1::4]],
+                          [line.rstrip(b'\r') for line in records[3::4]])
+
+    def close(self):
+        if self._unterminated:
+            # the last record lacks its final newline
+            self.lines += 1
+            self._unterminated = False
+        if self.qc is not None:
+            if self._partial:
+                self._records.append(self._partial)
+                self._partial = b''
+            self._flush()
+
+
+class ShockStreamUpload(object):
+    '''
+    A named pipe whose content is uploaded to a new Shock node as it is
+    written.
+
+        with ShockStreamUpload(path, shock_url, headers, file_name) as upload:
+            run trimmomatic writing to upload.path
+        upload.node  # the Shock node, upload.counter.reads the record count
+    '''
+
+    def __init__(self, path, shock_url, headers, file_name, counter=None, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.shock_url = shock_url
+        self.headers = dict(headers)
+        self.file_name = file_name
+        self.counter = counter if counter is not None else RecordCounter()
+        self.chunk_size = chunk_size
+        self.node = None
+        self.error = None
+        self._thread = None
+
+    def __enter__(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.mkfifo(self.path)
+        self._thread = threading.Thread(target=self._upload, name='stream-upload')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _body(self, pipe, boundary):
+        yield ('--%s\r\nContent-Disposition: form-data; name="upload"; filename="%s"\r\n'
+               'Content-Type: application/octet-stream\r\n\r\n'
+               % (boundary, self.file_name.replace('"', ''))).encode('utf-8')
+        while True:
+            chunk = pipe.read(self.chunk_size)
+            if not chunk:
+                break
+            self.counter.feed(chunk)
+            yield chunk
+        yield ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+
+    def _upload(self):
+        try:
+            with open(self.path, 'rb') as pipe:
+                try:
+                    boundary = uuid.uuid4().hex
+                    headers = dict(self.headers)
+                    headers['Content-Type'] = 'multipart/form-data; boundary=' + boundary
+                    # a generator body is sent with chunked transfer encoding
+                    r = requests.post(self.shock_url + '/node', headers=headers,
+                                      data=self._body(pipe, boundary))
+                    r.raise_for_status()
+                    self.node = r.json()['data']
+                    self.counter.close()
+                except Exception as e:
+                    self.error = e
+                    while pipe.read(self.chunk_size):
+                        pass
+        except Exception as e:
+            self.error = e
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._thread.join(1)
+        if self._thread.is_alive():
+            # the writer may never have opened the pipe (e.g. Trimmomatic
+            # failed on startup); opening the write end without blocking
+            # releases a reader stuck in open()
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                pass
+        self._thread.join()
+        os.remove(self.path)
+        if exc_type is None and self.error is not None:
+            raise self.error
+        return False
+
+
+class UploadGroup(object):
+    '''Enters and closes several ShockStreamUploads together.'''
+
+    def __init__(self, uploads):
+        self.uploads = list(uploads)
+        self._entered = []
+
+    def __enter__(self):
+        try:
+            for upload in self.uploads:
+                self._entered.append(upload.__enter__())
+        except Exception:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        error = None
+        for upload in self._entered:
+            try:
+                upload.__exit__(exc_type, exc_value, tb)
+            except Exception as e:
+                error = error or e
+        self._entered = []
+        if error is not None:
+            raise error
+        return False
+
+
+def shock_handle(node, shock_url):
+    '''Handle dict for a node created by ShockStreamUpload, before it is persisted.'''
+    checksum = node.get('file', {}).get('checksum', {})
+    handle = {'id': node['id'],
+              'type': 'shock',
+              'url': shock_url,
+              'file_name': node.get('file', {}).get('name', '')}
+    if checksum.get('md5'):
+        handle['remote_md5'] = checksum['md5']
+    return handle
@@ -0,0 +1,171 @@
+"""
+Streaming aggregation of the Trimmomatic -trimlog output.
+
+Trimmomatic writes one line per read to the trim log:
+
+    <read name> <surviving length> <bases cut from start> <last surviving base> <bases cut from end>
+
+On real libraries that file is several GB, so instead of writing it to disk
+Trimmomatic is pointed at a named pipe and the lines are folded into fixed
+size histograms while the trimmer runs.  Memory use only depends on the
+maximum read length, not on the number of reads.
+"""
+import os
+import threading
+
+# lengths above this land in the last histogram bin
+DEFAULT_MAX_LENGTH = 1000
+
+
+def _trim_zeros(values):
+    end = len(values)
+    while end > 0 and values[end - 1] == 0:
+        end -= 1
+    return values[:end]
+
+
+class TrimlogAggregator(object):
+    '''
+    Folds trim log lines into survival counts and length histograms.
+
+    For paired reads Trimmomatic logs the forward and the reverse mate of a
+    pair on consecutive lines, which is used to assign every pair to one of
+    the Both Surviving / Forward Only / Reverse Only / Dropped categories.
+    '''
+
+    def __init__(self, paired, max_length=DEFAULT_MAX_LENGTH):
+        self.paired = paired
+        self.max_length = max_length
+        self.reads = 0
+        self.malformed_lines = 0
+        self.surviving_length = [0] * (max_length + 1)
+        self.leading_cut = [0] * (max_length + 1)
+        self.trailing_cut = [0] * (max_length + 1)
+        if paired:
+            self.categories = {'input_read_pairs': 0, 'both_surviving': 0,
+                               'forward_only_surviving': 0, 'reverse_only_surviving': 0,
+                               'dropped': 0}
+        else:
+            self.categories = {'input_reads': 0, 'surviving': 0, 'dropped': 0}
+        self._pending_forward = None
+
+    def add_line(self, line):
+        fields = line.rsplit(None, 4)
+        if len(fields) != 5:
+            self.malformed_lines += 1
+            return
+        try:
+            length = int(fields[1])
+            leading = int(fields[2])
+            trailing = int(fields[4])
+        except ValueError:
+            self.malformed_lines += 1
+            return
+        cap = self.max_length
+        self.reads += 1
+        self.surviving_length[length if length < cap else cap] += 1
+        self.leading_cut[leading if leading < cap else cap] += 1
+        self.trailing_cut[trailing if trailing < cap else cap] += 1
+        survived = length > 0
+        categories = self.categories
+        if not self.paired:
+            categories['input_reads'] += 1
+            categories['surviving' if survived else 'dropped'] += 1
+        elif self._pending_forward is None:
+            self._pending_forward = survived
+        else:
+            forward = self._pending_forward
+            self._pending_forward = None
+            categories['input_read_pairs'] += 1
+            if forward and survived:
+                categories['both_surviving'] += 1
+            elif forward:
+                categories['forward_only_surviving'] += 1
+            elif survived:
+                categories['reverse_only_surviving'] += 1
+            else:
+                categories['dropped'] += 1
+
+    def consume(self, stream, chunk_size=1 << 20):
+        # read large blocks and split them ourselves, readline() on a pipe
+        # is considerably slower
+        remainder = ''
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            lines = (remainder + chunk).split('\n')
+            remainder = lines.pop()
+            for line in lines:
+                if line:
+                    self.add_line(line)
+        if remainder:
+            self.add_line(remainder)
+
+    def summary(self):
+        '''Counts plus compact histograms (index = length, trailing zeros removed).'''
+        return {'reads': self.reads,
+                'malformed_lines': self.malformed_lines,
+                'categories': dict(self.categories),
+                'surviving_length_histogram': _trim_zeros(self.surviving_length),
+                'leading_cut_histogram': _trim_zeros(self.leading_cut),
+                'trailing_cut_histogram': _trim_zeros(self.trailing_cut),
+                'histogram_cap': self.max_length}
+
+    def format_report(self):
+        lines = ['Trim log statistics:']
+        for name in sorted(self.categories):
+            lines.append('  %s: %d' % (name, self.categories[name]))
+        summary = self.summary()
+        for name in ('surviving_length_histogram', 'leading_cut_histogram', 'trailing_cut_histogram'):
+            lines.append('  %s: %s' % (name, ','.join(str(v) for v in summary[name])))
+        return '\n'.join(lines)
+
+
+class TrimlogPipe(object):
+    '''
+    A named pipe Trimmomatic writes its trim log to, drained by a background
+    thread into a TrimlogAggregator.
+
+        with TrimlogPipe(path, aggregator) as pipe:
+            run trimmomatic with '-trimlog ' + pipe.path
+    '''
+
+    def __init__(self, path, aggregator):
+        self.path = path
+        self.aggregator = aggregator
+        self.error = None
+        self._thread = None
+
+    def __enter__(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.mkfifo(self.path)
+        self._thread = threading.Thread(target=self._drain, name='trimlog-reader')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _drain(self):
+        try:
+            with open(self.path, 'r') as pipe:
+                self.aggregator.consume(pipe)
+        except Exception as e:
+            self.error = e
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._thread.join(1)
+        if self._thread.is_alive():
+            # the writer never opened the pipe (e.g. Trimmomatic failed on
+            # startup) or is about to close it; opening the write end without
+            # blocking releases a reader stuck in open()
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                pass
+            self._thread.join()
+        os.remove(self.path)
+        if exc_type is None and self.error is not None:
+            raise self.error
+        return False
@@ -0,0 +1,101 @@
+"""
+Workspace lookups of read libraries, with a small TTL cache.
+
+runTrimmomatic only needs the file handles and the interleaved flag of the
+input library, so instead of get_objects on the whole object (which for
+some library types carries large embedded metadata) the library is resolved
+to an exact reference with get_object_info_new and only the handle paths are
+fetched with get_object_subset.
+
+Both results are cached per user:
+
+    ('info', user, workspace, name)  -> object info, for `ttl` seconds; a
+                                        version saved meanwhile is picked up
+                                        when the entry expires
+    ('subset', user, ws/obj/version) -> handle subset; a version never
+                                        changes, the TTL only bounds memory
+
+Keys include the user so a cached entry is never served to someone who has
+not read the object themselves.
+"""
+import threading
+import time
+
+from kb_trimmomatic import metrics
+
+# every path get_read_handles looks at, for KBaseFile and KBaseAssembly libraries
+LIBRARY_PATHS = ['lib/file', 'lib/type',
+                 'lib1/file', 'lib1/type',
+                 'lib2/file', 'lib2/type',
+                 'handle', 'handle_1', 'handle_2',
+                 'interleaved']
+
+DEFAULT_TTL = 60
+DEFAULT_MAX_ENTRIES = 1024
+
+
+class TTLCache(object):
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, clock=time.time):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= self.clock():
+                del self._entries[key]
+                return None
+            return value
+
+    def put(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            now = self.clock()
+            if len(self._entries) >= self.max_entries:
+                for stale in [k for k, (expires, _) in self._entries.items() if expires <= now]:
+                    del self._entries[stale]
+                if len(self._entries) >= self.max_entries:
+                    # still full: drop the entry closest to expiry
+                    del self._entries[min(self._entries, key=lambda k: self._entries[k][0])]
+            self._entries[key] = (now + self.ttl, value)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def object_ref(info):
+    return '%s/%s/%s' % (info[6], info[0], info[4])
+
+
+def _cached(cache, kind, key, fetch):
+    value = cache.get(key)
+    if value is None:
+        metrics.WORKSPACE_CACHE.inc(kind=kind, result='miss')
+        value = fetch()
+        cache.put(key, value)
+    else:
+        metrics.WORKSPACE_CACHE.inc(kind=kind, result='hit')
+    return value
+
+
+def get_read_library(ws_client, cache, user, workspace, name):
+    '''
+    Returns {'info': object info, 'data': the LIBRARY_PATHS subset} of the
+    latest version of workspace/name.
+    '''
+    info = _cached(cache, 'info', ('info', user, workspace, name),
+                   lambda: ws_client.get_object_info_new(
+                       {'objects': [{'workspace': workspace, 'name': name}]})[0])
+    ref = object_ref(info)
+    data = _cached(cache, 'subset', ('subset', user, ref),
+                   lambda: ws_client.get_object_subset(
+                       [{'ref': ref, 'included': LIBRARY_PATHS}])[0]['data'])
+    return {'info': info, 'data': data}
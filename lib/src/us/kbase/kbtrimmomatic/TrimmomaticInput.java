@@ -2,6 +2,7 @@
 package us.kbase.kbtrimmomatic;
 
 import java.util.HashMap;
+import java.util.List;
 import java.util.Map;
 import javax.annotation.Generated;
 import com.fasterxml.jackson.annotation.JsonAnyGetter;
@@ -48,7 +49,7 @@ public class TrimmomaticInput {
     @JsonProperty("read_type")
     private String readType;
     @JsonProperty("input_read_library")
-    private String inputReadLibrary;
+    private List<String> inputReadLibrary;
     @JsonProperty("adapterFa")
     private String adapterFa;
     @JsonProperty("seed_mismatches")
@@ -123,16 +124,16 @@ public class TrimmomaticInput {
     }
 
     @JsonProperty("input_read_library")
-    public String getInputReadLibrary() {
+    public List<String> getInputReadLibrary() {
         return inputReadLibrary;
     }
 
     @JsonProperty("input_read_library")
-    public void setInputReadLibrary(String inputReadLibrary) {
+    public void setInputReadLibrary(List<String> inputReadLibrary) {
         this.inputReadLibrary = inputReadLibrary;
     }
 
-    public TrimmomaticInput withInputReadLibrary(String inputReadLibrary) {
+    public TrimmomaticInput withInputReadLibrary(List<String> inputReadLibrary) {
         this.inputReadLibrary = inputReadLibrary;
         return this;
     }
@@ -0,0 +1,36 @@
+#!/bin/bash
+# Download the contaminant sequences of the contaminant screen to a directory
+# and check them against data/contaminants.sha256, once it holds their checksums:
+#     phix.fa          the PhiX174 genome, NC_001422.1
+#     univec_core.fa   UniVec_Core
+# With --record the checksums of the downloaded files are written to the
+# checksum file instead of checked.
+set -e -o pipefail
+
+script_dir=$(dirname "$(readlink -f "$0")")
+sums=$script_dir/../data/contaminants.sha256
+record=0
+if [ "$1" == "--record" ]; then
+    record=1
+    shift
+fi
+dir=${1:?usage: fetch_contaminants.sh [--record] <directory>}
+
+mkdir -p "$dir"
+curl -fsS 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=nuccore&id=NC_001422.1&rettype=fasta&retmode=text' \
+    -o "$dir/phix.fa"
+curl -fsS https://ftp.ncbi.nlm.nih.gov/pub/UniVec/UniVec_Core -o "$dir/univec_core.fa"
+
+cd "$dir"
+if [ $record == 1 ]; then
+    grep '^#' "$sums" > "$sums.new" || true
+    sha256sum phix.fa univec_core.fa >> "$sums.new"
+    mv "$sums.new" "$sums"
+    exit 0
+fi
+if [ $(grep -vc '^#' "$sums") == 0 ]; then
+    echo "WARNING: $sums holds no checksums yet, phix.fa and univec_core.fa are not verified;" \
+        "record them with $0 --record" >&2
+    exit 0
+fi
+grep -v '^#' "$sums" | sha256sum --strict -c -
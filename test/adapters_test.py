@@ -0,0 +1,58 @@
+import unittest
+import os
+import random
+import shutil
+import tempfile
+
+from kb_trimmomatic.adapters import AdapterIndex
+
+ADAPTER_A = 'AGATCGGAAGAGCACACGTCTGAACTCCAGTCAC'
+ADAPTER_B = 'CTGTCTCTTATACACATCTCCGAGCCCACGAGAC'
+
+
+class AdapterIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.adapter_dir = os.path.join(self.tmp, 'adapters')
+        os.makedirs(self.adapter_dir)
+        for name, sequence in (('SetA-PE.fa', ADAPTER_A), ('SetB-PE.fa', ADAPTER_B),
+                               ('SetB-SE.fa', ADAPTER_B)):
+            with open(os.path.join(self.adapter_dir, name), 'w') as fasta:
+                fasta.write('>adapter\n%s\n' % sequence)
+        rng = random.Random(3)
+        self.reads = [''.join(rng.choice('ACGT') for _ in range(100)) for _ in range(200)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_detects_read_through_adapter(self):
+        reads = list(self.reads)
+        for i in range(0, 40):
+            reads[i] = reads[i][:70] + ADAPTER_B[:30]
+        index = AdapterIndex.load(self.adapter_dir, self.tmp)
+        adapter, evidence = index.detect(reads, 'PE')
+        self.assertEqual(adapter, 'SetB-PE.fa')
+        self.assertEqual(evidence['reads_with_adapter']['SetB-PE.fa'], 40)
+        self.assertEqual(evidence['reads_with_adapter']['SetA-PE.fa'], 0)
+        self.assertEqual(index.detect(reads, 'SE')[0], 'SetB-SE.fa')
+        # the built index is cached next to the scratch files
+        self.assertTrue([f for f in os.listdir(self.tmp) if f.startswith('adapter_index_')])
+
+    def test_numbered_set(self):
+        # TruSeq3-PE-2.fa holds the TruSeq3-PE.fa adapters and the read-through ones
+        for name, sequences in (('TruSeq3-PE.fa', [ADAPTER_A]), ('TruSeq3-PE-2.fa', [ADAPTER_A, ADAPTER_B])):
+            with open(os.path.join(self.adapter_dir, name), 'w') as fasta:
+                fasta.write(''.join('>adapter%d\n%s\n' % (i, sequence) for i, sequence in enumerate(sequences)))
+        os.remove(os.path.join(self.adapter_dir, 'SetB-PE.fa'))
+        reads = list(self.reads)
+        for i in range(0, 40):
+            reads[i] = reads[i][:70] + (ADAPTER_A if i % 2 else ADAPTER_B)[:30]
+        adapter, evidence = AdapterIndex.build(self.adapter_dir).detect(reads, 'PE')
+        self.assertEqual(adapter, 'TruSeq3-PE-2.fa')
+        self.assertEqual(evidence['reads_with_adapter']['TruSeq3-PE-2.fa'], 40)
+        self.assertEqual(evidence['reads_with_adapter']['TruSeq3-PE.fa'], 20)
+
+    def test_no_adapter(self):
+        index = AdapterIndex.build(self.adapter_dir)
+        self.assertEqual(index.detect(self.reads, 'PE')[0], None)
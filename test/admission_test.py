@@ -0,0 +1,148 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from kb_trimmomatic import admission
+from kb_trimmomatic.admission import AdmissionController, AdmissionRejected, Cost
+
+GB = 1 << 30
+
+
+def cost(cpus=1, memory=GB, disk=GB, input_bytes=GB):
+    return Cost(cpus=cpus, memory=memory, disk=disk, input_bytes=input_bytes)
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.ledger = os.path.join(self.work_dir, 'admission.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def controller(self, cpus=4, memory=8 * GB, disk=100 * GB, **kwargs):
+        kwargs.setdefault('poll', 0.01)
+        return AdmissionController(self.ledger, cpus, memory, disk, **kwargs)
+
+    def add_waiting(self, job_id, job_cost, since):
+        with open(self.ledger) as f:
+            ledger = json.load(f)
+        ledger['waiting']['other-host/' + job_id] = dict(job_cost._asdict(), since=since, beat=time.time())
+        with open(self.ledger, 'w') as f:
+            json.dump(ledger, f)
+
+    def test_estimate(self):
+        estimate = admission.estimate_cost([GB, GB], False, 4, 2 * GB, extra_memory=GB)
+        self.assertEqual(estimate.cpus, 4)
+        self.assertEqual(estimate.memory, 3 * GB + admission.JVM_OVERHEAD + admission.PROCESS_MEMORY)
+        self.assertEqual(estimate.disk, 4 * GB)
+        self.assertEqual(estimate.input_bytes, 2 * GB)
+
+    def test_estimate_charges_every_local_trimmer(self):
+        estimate = admission.estimate_cost([GB], False, 2, GB, trimmers=3)
+        self.assertEqual(estimate.cpus, 6)
+        self.assertEqual(estimate.memory, 3 * (GB + admission.JVM_OVERHEAD) + admission.PROCESS_MEMORY)
+        self.assertEqual(estimate.disk, admission.estimate_cost([GB], False, 2, GB).disk)
+
+    def test_admits_within_budget(self):
+        controller = self.controller()
+        self.assertEqual(controller.admit('a', cost(cpus=2)), 0.0)
+        self.assertEqual(controller.admit('b', cost(cpus=2)), 0.0)
+        state = controller.state()
+        self.assertEqual((state['running'], state['waiting'], state['cpus_used']), (2, 0, 4))
+        controller.release('a')
+        self.assertEqual(controller.state()['running'], 1)
+
+    def test_rejects_what_never_fits(self):
+        with self.assertRaises(AdmissionRejected):
+            self.controller().admit('a', cost(memory=16 * GB))
+
+    def test_rejects_when_queue_is_full(self):
+        controller = self.controller(cpus=1, max_queue=1)
+        controller.admit('a', cost())
+        self.add_waiting('b', cost(), time.time())
+        with self.assertRaises(AdmissionRejected):
+            controller.admit('c', cost())
+
+    def test_rejects_after_max_wait(self):
+        controller = self.controller(cpus=1, max_wait=0.05)
+        controller.admit('a', cost())
+        with self.assertRaises(AdmissionRejected):
+            controller.admit('b', cost())
+        self.assertEqual(controller.state()['waiting'], 0)
+
+    def test_waits_for_release(self):
+        controller = self.controller(cpus=1)
+        controller.admit('a', cost())
+        threading.Timer(0.1, controller.release, ['a']).start()
+        self.assertGreater(controller.admit('b', cost()), 0.05)
+
+    def test_small_jobs_go_first(self):
+        controller = self.controller(cpus=1)
+        controller.admit('running', cost())
+        order = []
+
+        def wait(job_id, job_cost):
+            controller.admit(job_id, job_cost)
+            order.append(job_id)
+            controller.release(job_id)
+
+        large = threading.Thread(target=wait, args=('large', cost(input_bytes=100 * GB)))
+        large.start()
+        time.sleep(0.05)
+        small = threading.Thread(target=wait, args=('small', cost(input_bytes=GB >> 4)))
+        small.start()
+        time.sleep(0.05)
+        controller.release('running')
+        large.join()
+        small.join()
+        self.assertEqual(order, ['small', 'large'])
+
+    def test_aged_job_holds_back_the_rest(self):
+        controller = self.controller(cpus=2, aging=0)
+        controller.admit('running', cost())
+        # waiting for both CPUs since before the small job arrives
+        self.add_waiting('large', cost(cpus=2, input_bytes=100 * GB), time.time() - 10)
+        controller.max_wait = 0.05
+        with self.assertRaises(AdmissionRejected):
+            controller.admit('small', cost(input_bytes=1))
+
+    def test_entries_without_heartbeat_are_dropped(self):
+        controller = self.controller(cpus=1, lease=60)
+        with open(self.ledger, 'w') as f:
+            json.dump({'running': {'other-host/gone': dict(cost()._asdict(), since=0, beat=time.time() - 61)},
+                       'waiting': {}}, f)
+        self.assertEqual(controller.admit('a', cost()), 0.0)
+
+    def test_running_jobs_renew_their_lease(self):
+        controller = self.controller(cpus=1, lease=0.2)
+        with controller.slot('a') as slot:
+            slot.admit(cost())
+            time.sleep(0.5)
+            self.assertEqual(controller.state()['running'], 1)
+        self.assertEqual(controller.state()['running'], 0)
+        # a job that stops renewing (its container is gone) loses its place
+        controller.admit('b', cost())
+        time.sleep(0.3)
+        self.assertEqual(controller.state()['running'], 0)
+
+    def test_slot_releases(self):
+        controller = self.controller(cpus=1)
+        with controller.slot('a') as slot:
+            slot.admit(cost())
+            self.assertEqual(controller.state()['running'], 1)
+        self.assertEqual(controller.state()['running'], 0)
+
+    def test_disabled(self):
+        controller = self.controller(cpus=1, enabled=False)
+        controller.admit('a', cost(cpus=8))
+        self.assertFalse(os.path.exists(self.ledger))
+
+
+if __name__ == '__main__':
+    unittest.main()
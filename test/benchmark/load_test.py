@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""
+Load generator for the kb_trimmomatic JSON-RPC server.
+
+By default the server Application is run in this process on a threaded WSGI
+server, with the Globus auth client replaced by a stub (simulated validation
+latency, counts validations) and the job service pointed at a local stand-in,
+so runTrimmomatic_async/_check can be exercised without a deployment.  With
+--url an already running server is targeted instead.
+
+The request mix is weighted between async submits, status checks, malformed
+requests and batch requests; the report gives p50/p95/p99 latency, error rate
+and throughput per request kind and overall.
+
+    python test/benchmark/load_test.py --rate 200 --concurrency 16 --duration 30
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_services import StubServices
+
+DEFAULT_MIX = 'run_async=2,check=6,malformed=1,batch=1'
+
+RUN_PARAMS = {'input_ws': 'loadtest', 'input_read_library': 'reads',
+              'output_read_library': 'reads_trimmed', 'read_type': 'PE',
+              'quality_encoding': 'phred33', 'min_length': '36'}
+
+
+class StubAuthClient(object):
+    '''Stands in for biokbase.nexus.Client; tokens starting with "bad" fail.'''
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.validations = 0
+        self._lock = threading.Lock()
+
+    def validate_token(self, token):
+        with self._lock:
+            self.validations += 1
+        time.sleep(self.latency)
+        if token.startswith('bad'):
+            raise ValueError('Invalid token')
+        return 'user_' + token[-4:], None, None
+
+
+def start_local_server(auth_latency, job_finish_after):
+    '''Import the server against stub services and serve it on a free port.'''
+    from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+    try:
+        from SocketServer import ThreadingMixIn
+    except ImportError:
+        from socketserver import ThreadingMixIn
+
+    work_dir = tempfile.mkdtemp(prefix='kb_trimmomatic_load_')
+    services = StubServices(os.path.join(work_dir, 'shock')).start()
+    services.job_service.finish_after = job_finish_after
+    config_path = os.path.join(work_dir, 'deploy.cfg')
+    with open(config_path, 'w') as cfg:
+        cfg.write('[kb_trimmomatic]\n')
+        for key, value in sorted(services.config(os.path.join(work_dir, 'scratch')).items()):
+            cfg.write('%s = %s\n' % (key, value))
+    os.environ['KB_DEPLOYMENT_CONFIG'] = config_path
+    os.environ['KB_JOB_SERVICE_URL'] = services.job_service.url
+
+    from kb_trimmomatic import kb_trimmomaticServer as server
+    auth_client = StubAuthClient(latency=auth_latency)
+    server.application.auth_client = auth_client
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    httpd = make_server('127.0.0.1', 0, server.application,
+                        server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+    return url, auth_client, lambda: (httpd.shutdown(), services.stop())
+
+
+def parse_mix(text):
+    mix = []
+    for item in text.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in ('run_async', 'check', 'malformed', 'batch'):
+            raise ValueError('Unknown request kind ' + kind)
+        mix.append((kind, float(weight or 1)))
+    return mix
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class LoadGenerator(object):
+
+    def __init__(self, url, rate, concurrency, duration, mix, tokens, seed=1):
+        self.url = url
+        self.rate = rate
+        self.concurrency = concurrency
+        self.duration = duration
+        self.mix = mix
+        self.tokens = tokens
+        self.rng = random.Random(seed)
+        self.job_ids = []
+        self.samples = []
+        self._issued = 0
+        self._lock = threading.Lock()
+
+    def _choose(self):
+        total = sum(weight for _, weight in self.mix)
+        point = self.rng.random() * total
+        for kind, weight in self.mix:
+            point -= weight
+            if point <= 0:
+                return kind
+        return self.mix[-1][0]
+
+    def _rpc(self, method, params):
+        return {'method': method, 'params': params, 'version': '1.1',
+                'id': str(self.rng.random())[2:]}
+
+    def _build(self, kind):
+        '''Return (body, headers, expect_ok).'''
+        headers = {'Authorization': self.rng.choice(self.tokens)}
+        if kind == 'check' and not self.job_ids:
+            kind = 'run_async'
+        if kind == 'run_async':
+            return kind, json.dumps(self._rpc('kb_trimmomatic.runTrimmomatic_async',
+                                              [RUN_PARAMS])), headers, True
+        if kind == 'check':
+            job_id = self.rng.choice(self.job_ids)
+            return kind, json.dumps(self._rpc('kb_trimmomatic.runTrimmomatic_check',
+                                              [job_id])), headers, True
+        if kind == 'batch':
+            calls = [self._rpc('kb_trimmomatic.runTrimmomatic_check',
+                               [self.rng.choice(self.job_ids or ['none'])]) for _ in range(3)]
+            return kind, json.dumps(calls), headers, True
+        variant = self.rng.randint(0, 3)
+        if variant == 0:
+            body = '{"method": "kb_trimmomatic.runTrimmomatic_async", "params": ['
+        elif variant == 1:
+            body = json.dumps(self._rpc('kb_trimmomatic.no_such_method', []))
+        elif variant == 2:
+            body = json.dumps(self._rpc('kb_trimmomatic.runTrimmomatic_async', [RUN_PARAMS]))
+            headers = {}
+        else:
+            body = json.dumps(self._rpc('kb_trimmomatic.runTrimmomatic_async', [RUN_PARAMS]))
+            headers = {'Authorization': 'bad_token'}
+        return kind, body, headers, False
+
+    def _next_slot(self, start):
+        with self._lock:
+            index = self._issued
+            self._issued += 1
+        return start + float(index) / self.rate
+
+    def _worker(self, start, stop):
+        session = requests.Session()
+        while True:
+            scheduled = self._next_slot(start)
+            if scheduled >= stop:
+                return
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            with self._lock:
+                kind, body, headers, expect_ok = self._build(self._choose())
+            sent = time.time()
+            try:
+                response = session.post(self.url, data=body, headers=headers, timeout=60)
+                status = response.status_code
+                ok = status == 200
+                if kind == 'run_async' and ok:
+                    with self._lock:
+                        self.job_ids.append(response.json()['result'][0])
+            except requests.RequestException:
+                status = 0
+                ok = False
+            done = time.time()
+            with self._lock:
+                self.samples.append({'kind': kind, 'status': status,
+                                     'latency': done - sent,
+                                     'lag': max(0.0, sent - scheduled),
+                                     'error': ok != expect_ok or status == 0,
+                                     'done': done})
+
+    def run(self):
+        start = time.time()
+        stop = start + self.duration
+        threads = [threading.Thread(target=self._worker, args=(start, stop))
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+    def summarize(self, elapsed):
+        def stats(samples):
+            latencies = sorted(s['latency'] for s in samples)
+            errors = sum(1 for s in samples if s['error'])
+            return {'requests': len(samples),
+                    'requests_per_second': round(len(samples) / elapsed, 2) if elapsed else 0,
+                    'error_rate': round(float(errors) / len(samples), 4) if samples else 0,
+                    'p50_ms': _ms(percentile(latencies, 0.50)),
+                    'p95_ms': _ms(percentile(latencies, 0.95)),
+                    'p99_ms': _ms(percentile(latencies, 0.99)),
+                    'max_ms': _ms(latencies[-1] if latencies else None),
+                    'statuses': _count(s['status'] for s in samples)}
+        summary = {'elapsed_seconds': round(elapsed, 3),
+                   'target_rate': self.rate,
+                   'concurrency': self.concurrency,
+                   'mean_send_lag_ms': _ms(sum(s['lag'] for s in self.samples) /
+                                           len(self.samples) if self.samples else None),
+                   'overall': stats(self.samples),
+                   'by_kind': {}}
+        for kind in sorted(set(s['kind'] for s in self.samples)):
+            summary['by_kind'][kind] = stats([s for s in self.samples if s['kind'] == kind])
+        return summary
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000.0, 2)
+
+
+def _count(values):
+    counts = {}
+    for value in values:
+        counts[str(value)] = counts.get(str(value), 0) + 1
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='kb_trimmomatic JSON-RPC load generator')
+    parser.add_argument('--url', help='target a running server instead of an in-process one')
+    parser.add_argument('--rate', type=float, default=50.0, help='requests per second')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='weighted kinds, default ' + DEFAULT_MIX)
+    parser.add_argument('--tokens', type=int, default=4,
+                        help='distinct valid tokens to rotate through')
+    parser.add_argument('--auth-latency', type=float, default=0.05,
+                        help='simulated token validation time for the in-process server')
+    parser.add_argument('--job-finish-after', type=float, default=5.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='also write the summary as JSON to this file')
+    args = parser.parse_args(argv)
+
+    auth_client = None
+    shutdown = None
+    url = args.url
+    if url is None:
+        url, auth_client, shutdown = start_local_server(args.auth_latency, args.job_finish_after)
+    tokens = ['loadtest_token_%04d' % i for i in range(args.tokens)]
+    generator = LoadGenerator(url, args.rate, args.concurrency, args.duration,
+                              parse_mix(args.mix), tokens, seed=args.seed)
+    try:
+        elapsed = generator.run()
+    finally:
+        if shutdown is not None:
+            shutdown()
+    summary = generator.summarize(elapsed)
+    if auth_client is not None:
+        summary['auth_validations'] = auth_client.validations
+    print(json.dumps(summary, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(summary, out, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+End-to-end runTrimmomatic benchmark against local service stand-ins.
+
+Each scenario generates (or reuses) a seeded synthetic library, registers it
+with the stub Shock and Workspace, runs runTrimmomatic through the Impl and
+collects the per-phase spans the job writes to its JSON-lines trace.  The
+results are written as one JSON document so runs can be compared offline.
+
+Needs the module image (Trimmomatic jar, ws-tools and the biokbase clients):
+
+    python test/benchmark/run_benchmark.py --scenario 1M --layout PE --gzip
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_fastq import LAYOUTS, write_library
+from stub_services import StubServices
+
+SCENARIOS = {'1M': 1000000, '10M': 10000000, '100M': 100000000}
+
+TRIM_PARAMS = {'quality_encoding': 'phred33',
+               'seed_mismatches': '2',
+               'palindrome_clip_threshold': '30',
+               'simple_clip_threshold': '10',
+               'leading_min_quality': '3',
+               'trailing_min_quality': '3',
+               'sliding_window_size': '4',
+               'sliding_window_min_quality': '15',
+               'min_length': '36'}
+
+WORKSPACE = 'benchmark'
+
+
+def _library_object(services, layout, paths):
+    handles = [services.shock.add_file(path) for path in paths]
+    file_type = 'fq.gz' if paths[0].endswith('.gz') else 'fq'
+    if layout == 'SE':
+        return 'KBaseFile.SingleEndLibrary', {'lib': {'file': handles[0], 'type': file_type}}
+    data = {'lib1': {'file': handles[0], 'type': file_type},
+            'interleaved': 1 if layout == 'interleaved' else 0}
+    if layout == 'PE':
+        data['lib2'] = {'file': handles[1], 'type': file_type}
+    return 'KBaseFile.PairedEndLibrary', data
+
+
+def run_scenario(name, reads, layout, compress, work_dir, seed=1, profile='none'):
+    from kb_trimmomatic.kb_trimmomaticImpl import kb_trimmomatic
+
+    data_dir = os.path.join(work_dir, 'data')
+    generate_start = time.time()
+    paths = _cached(data_dir, layout, reads, seed, compress) or \
+        write_library(data_dir, layout, reads, seed=seed, compress=compress)
+    generate_seconds = time.time() - generate_start
+
+    run_dir = os.path.join(work_dir, 'run_%s_%s_%s' % (name, layout, 'gz' if compress else 'plain'))
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    trace_dir = os.path.join(run_dir, 'traces')
+    services = StubServices(os.path.join(run_dir, 'shock')).start()
+    cwd = os.getcwd()
+    try:
+        obj_type, data = _library_object(services, layout, paths)
+        services.workspace.put_object(WORKSPACE, 'reads', obj_type, data)
+        config = services.config(os.path.join(run_dir, 'scratch'))
+        config['trace-dir'] = trace_dir
+        config['profile'] = profile
+        impl = kb_trimmomatic(config)
+
+        params = dict(TRIM_PARAMS)
+        params.update({'input_ws': WORKSPACE, 'output_ws': WORKSPACE,
+                       'input_read_library': 'reads',
+                       'output_read_library': 'reads_trimmed',
+                       'read_type': 'SE' if layout == 'SE' else 'PE',
+                       'adapterFa': 'TruSeq3-SE.fa' if layout == 'SE' else 'TruSeq3-PE.fa'})
+        ctx = {'token': 'benchmark', 'provenance': [{'service': 'kb_trimmomatic',
+               'method': 'runTrimmomatic', 'method_params': [params]}]}
+        start = time.time()
+        impl.runTrimmomatic(ctx, params)
+        wall = time.time() - start
+    finally:
+        os.chdir(cwd)
+        services.stop()
+
+    phases = []
+    for trace_file in glob.glob(os.path.join(trace_dir, '*.jsonl')):
+        with open(trace_file) as f:
+            phases.extend(json.loads(line) for line in f if line.strip())
+    return {'scenario': name,
+            'reads': reads,
+            'layout': layout,
+            'gzip': compress,
+            'seed': seed,
+            'input_bytes': sum(os.path.getsize(p) for p in paths),
+            'generate_seconds': round(generate_seconds, 3),
+            'wall_seconds': round(wall, 3),
+            'shock_bytes_served': services.shock.bytes_served,
+            'shock_bytes_received': services.shock.bytes_received,
+            'workspace_calls': services.workspace.calls,
+            'phases': phases}
+
+
+def _cached(data_dir, layout, reads, seed, compress):
+    suffix = '.fastq.gz' if compress else '.fastq'
+    base = os.path.join(data_dir, 'synthetic_%s_%d_seed%d' % (layout, reads, seed))
+    paths = [base + '_1' + suffix, base + '_2' + suffix] if layout == 'PE' else [base + suffix]
+    if all(os.path.exists(path) for path in paths):
+        return paths
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='runTrimmomatic end-to-end benchmark')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='may be repeated; defaults to 1M')
+    parser.add_argument('--layout', action='append', choices=LAYOUTS,
+                        help='may be repeated; defaults to all layouts')
+    parser.add_argument('--gzip', action='store_true', help='compress the input libraries')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--profile', default='none', choices=('none', 'cprofile', 'tracemalloc'))
+    parser.add_argument('--work-dir', default='/kb/module/work/tmp/benchmark')
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args(argv)
+
+    results = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'host': platform.node(),
+               'python': platform.python_version(),
+               'runs': []}
+    for scenario in args.scenario or ['1M']:
+        for layout in args.layout or list(LAYOUTS):
+            print('running %s %s%s' % (scenario, layout, ' gzip' if args.gzip else ''))
+            results['runs'].append(run_scenario(scenario, SCENARIOS[scenario], layout, args.gzip,
+                                                os.path.abspath(args.work_dir), seed=args.seed,
+                                                profile=args.profile))
+    with open(args.output, 'w') as out:
+        json.dump(results, out, indent=2, sort_keys=True)
+    print('results written to ' + args.output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Cold start benchmark for the async job entry point.
+
+Every async job is a fresh `python kb_trimmomaticServer.py input output token`
+process, so whatever the server module does before dispatching the request is
+paid by every job.  This runs, each in new interpreters and --repeat times:
+
+* python -c pass, the interpreter baseline;
+* importing kb_trimmomaticServer, with a breakdown of the time to build the
+  Impl, the rpc service, the Globus auth client and the Application in the
+  same process;
+* the full CLI round trip of a job: a token and a runTrimmomatic request,
+  which goes through startup, token validation and dispatch and fails at the
+  Impl's first call to the (unreachable) Workspace.
+
+A throwaway deploy.cfg points the module at unreachable services and a
+temporary scratch directory.  The auth client is the real one, but its
+validate_token is replaced so no Globus round trip is timed; nothing is
+contacted.
+
+    python test/benchmark/startup_benchmark.py --repeat 10
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'lib',
+                      'kb_trimmomatic', 'kb_trimmomaticServer.py')
+
+BREAKDOWN = '''
+import json, time
+start = time.time()
+from kb_trimmomatic import kb_trimmomaticServer as server
+imported = time.time()
+server.get_impl()
+impl = time.time()
+server.get_rpc_service()
+rpc_service = time.time()
+server.get_auth_client()
+auth_client = time.time()
+server.application.get()
+app = time.time()
+print(json.dumps({'import': imported - start, 'impl': impl - imported, 'rpc_service': rpc_service - impl,
+                  'auth_client': auth_client - rpc_service, 'application': app - auth_client}))
+'''
+
+# the async job entry point, as bin/run_kb_trimmomatic_async_job.sh runs it,
+# with the Globus validation itself stubbed out
+CLI = '''
+import sys
+from kb_trimmomatic import kb_trimmomaticServer as server
+server.get_auth_client().validate_token = lambda token: ('benchmark', None, None)
+sys.exit(server.process_async_cli(sys.argv[1], sys.argv[2], sys.argv[3]))
+'''
+
+RUN_PARAMS = {'input_ws': 'benchmark', 'input_read_library': 'reads', 'output_read_library': 'reads_trimmed',
+              'read_type': 'PE', 'quality_encoding': 'phred33', 'min_length': '36'}
+
+
+def write_config(work_dir):
+    path = os.path.join(work_dir, 'deploy.cfg')
+    with open(path, 'w') as cfg:
+        cfg.write('[kb_trimmomatic]\n')
+        cfg.write('workspace-url = http://127.0.0.1:9/ws\n')
+        cfg.write('shock-url = http://127.0.0.1:9/shock\n')
+        cfg.write('handle-service-url = http://127.0.0.1:9/handle\n')
+        cfg.write('job-service-url = http://127.0.0.1:9/njs\n')
+        cfg.write('scratch = %s\n' % os.path.join(work_dir, 'scratch'))
+        cfg.write('trace-dir = %s\n' % os.path.join(work_dir, 'traces'))
+    return path
+
+
+def timed(command, env):
+    start = time.time()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    return time.time() - start, process.returncode, out, err
+
+
+def stats(samples):
+    samples = sorted(samples)
+    return {'min_ms': round(samples[0] * 1000, 1),
+            'median_ms': round(samples[len(samples) // 2] * 1000, 1),
+            'max_ms': round(samples[-1] * 1000, 1)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='kb_trimmomatic async entry point cold start benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--python', default=sys.executable, help='interpreter to start')
+    parser.add_argument('--output', help='also write the summary as JSON to this file')
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='kb_trimmomatic_startup_')
+    try:
+        env = dict(os.environ)
+        env['KB_DEPLOYMENT_CONFIG'] = write_config(work_dir)
+        env['PYTHONPATH'] = os.path.join(os.path.dirname(SERVER), '..') + os.pathsep + env.get('PYTHONPATH', '')
+        input_path = os.path.join(work_dir, 'input.json')
+        output_path = os.path.join(work_dir, 'output.json')
+        with open(input_path, 'w') as f:
+            json.dump({'method': 'kb_trimmomatic.runTrimmomatic', 'params': [RUN_PARAMS],
+                       'version': '1.1', 'id': '1'}, f)
+
+        baseline, imports, cli = [], [], []
+        breakdown = {'import': [], 'impl': [], 'rpc_service': [], 'auth_client': [], 'application': []}
+        for _ in range(args.repeat):
+            baseline.append(timed([args.python, '-c', 'pass'], env)[0])
+            seconds, code, out, err = timed([args.python, '-c', BREAKDOWN], env)
+            if code != 0:
+                raise RuntimeError('importing the server failed:\n' + err.decode('utf-8', 'replace'))
+            imports.append(seconds)
+            for key, value in json.loads(out.decode('utf-8').strip().splitlines()[-1]).items():
+                breakdown[key].append(value)
+            seconds, code, out, err = timed([args.python, '-c', CLI, input_path, output_path, 'benchmark-token'],
+                                            env)
+            with open(output_path) as f:
+                response = json.load(f)
+            # the job must have reached the Impl, not failed on startup or dispatch
+            if 'runTrimmomatic' not in str(response.get('error', {}).get('error')):
+                raise RuntimeError('unexpected CLI response: ' + json.dumps(response))
+            cli.append(seconds)
+
+        summary = {'repeat': args.repeat,
+                   'python': args.python,
+                   'interpreter_baseline': stats(baseline),
+                   'import_and_build': stats(imports),
+                   'breakdown': dict((key, stats(values)) for key, values in breakdown.items()),
+                   'cli_round_trip': stats(cli)}
+    finally:
+        shutil.rmtree(work_dir)
+    print(json.dumps(summary, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(summary, out, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,401 @@
+"""
+Local HTTP stand-ins for Shock, the Workspace, the handle service and the
+job service.
+
+They implement only the calls runTrimmomatic and ws-tools make, keep
+everything in memory or on local disk and do not check tokens, so the
+benchmark and load tests can run without a KBase deployment.
+
+    services = StubServices(storage_dir)
+    services.start()
+    handle = services.shock.add_file('/path/to/reads.fastq')
+    services.workspace.put_object('bench', 'reads', 'KBaseFile.SingleEndLibrary',
+                                  {'lib': {'file': handle, 'type': 'fq'}})
+    ...
+    services.stop()
+"""
+import cgi
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, body, content_type='application/json', headers=()):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def _dechunk(self):
+        # chunked transfer encoded request body (streamed uploads) into a
+        # temporary file; returns (file positioned at 0, length)
+        body = tempfile.TemporaryFile()
+        length = 0
+        while True:
+            size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+            if size == 0:
+                self.rfile.readline()
+                break
+            remaining = size
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, 1 << 20))
+                body.write(chunk)
+                remaining -= len(chunk)
+            self.rfile.readline()
+            length += size
+        body.seek(0)
+        return body, length
+
+
+class StubShock(object):
+    '''Shock nodes backed by files under storage_dir.'''
+
+    def __init__(self, storage_dir):
+        self.storage_dir = storage_dir
+        self.nodes = {}
+        self.url = None
+        self.bytes_served = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+
+    def add_file(self, path, file_name=None):
+        '''Register an existing file as a node (no copy) and return its handle.'''
+        node_id = str(uuid.uuid4())
+        self.nodes[node_id] = {'path': os.path.abspath(path),
+                               'name': file_name or os.path.basename(path)}
+        return self.handle(node_id)
+
+    def handle(self, node_id):
+        node = self.nodes[node_id]
+        return {'hid': 'KBH_' + node_id[:8], 'id': node_id, 'url': self.url,
+                'type': 'shock', 'file_name': node['name'], 'remote_md5': None}
+
+    def _node_info(self, node_id):
+        node = self.nodes[node_id]
+        return {'id': node_id,
+                'file': {'name': node['name'], 'size': os.path.getsize(node['path']),
+                         'checksum': {}},
+                'attributes': None}
+
+    def handler(self):
+        shock = self
+
+        class Handler(_QuietHandler):
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                parts = parsed.path.strip('/').split('/')
+                if len(parts) != 2 or parts[0] != 'node' or parts[1] not in shock.nodes:
+                    return self._send(404, json.dumps({'status': 404, 'error': ['Node not found']}))
+                node = shock.nodes[parts[1]]
+                if 'download' not in parse_qs(parsed.query, keep_blank_values=True):
+                    return self._send(200, json.dumps({'status': 200, 'data': shock._node_info(parts[1])}))
+                size = os.path.getsize(node['path'])
+                start, end = 0, size - 1
+                code = 200
+                range_header = self.headers.get('Range')
+                if range_header and range_header.startswith('bytes='):
+                    first, _, last = range_header[len('bytes='):].partition('-')
+                    start = int(first or 0)
+                    end = min(int(last), size - 1) if last else size - 1
+                    code = 206
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(end - start + 1))
+                if code == 206:
+                    self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+                self.end_headers()
+                remaining = end - start + 1
+                with open(node['path'], 'rb') as data:
+                    data.seek(start)
+                    while remaining > 0:
+                        chunk = data.read(min(remaining, 1 << 20))
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+                        remaining -= len(chunk)
+                with shock._lock:
+                    shock.bytes_served += end - start + 1 - remaining
+
+            def do_POST(self):
+                node_id = str(uuid.uuid4())
+                path = os.path.join(shock.storage_dir, node_id)
+                content_type = self.headers.get('Content-Type', '')
+                name = node_id
+                if content_type.startswith('multipart/form-data'):
+                    fp, headers = self.rfile, self.headers
+                    if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                        fp, length = self._dechunk()
+                        headers = {'content-type': content_type, 'content-length': str(length)}
+                    form = cgi.FieldStorage(fp=fp, headers=headers,
+                                            environ={'REQUEST_METHOD': 'POST',
+                                                     'CONTENT_TYPE': content_type})
+                    if 'upload' in form:
+                        upload = form['upload']
+                        name = upload.filename or name
+                        with open(path, 'wb') as out:
+                            shutil.copyfileobj(upload.file, out)
+                    else:
+                        open(path, 'wb').close()
+                else:
+                    with open(path, 'wb') as out:
+                        out.write(self._body())
+                with shock._lock:
+                    shock.bytes_received += os.path.getsize(path)
+                shock.nodes[node_id] = {'path': path, 'name': name}
+                self._send(200, json.dumps({'status': 200, 'data': shock._node_info(node_id)}))
+
+        return Handler
+
+
+class StubWorkspace(object):
+    '''
+    Versioned objects in memory, addressed by workspace name or id and object
+    name or id.
+    '''
+
+    def __init__(self):
+        self.workspaces = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+        self.url = None
+
+    def _workspace(self, name):
+        if name not in self.workspaces:
+            self.workspaces[name] = {'id': len(self.workspaces) + 1, 'objects': {}, 'ids': {}}
+        return self.workspaces[name]
+
+    def _find_workspace(self, ident):
+        for name, ws in self.workspaces.items():
+            if str(ident) in (name, str(ws['id'])):
+                return name, ws
+        raise ValueError('No workspace ' + str(ident))
+
+    def put_object(self, workspace, name, obj_type, data, meta=None):
+        with self._lock:
+            ws = self._workspace(workspace)
+            versions = ws['objects'].setdefault(name, [])
+            obj_id = ws['ids'].setdefault(name, len(ws['ids']) + 1)
+            info = [obj_id, name, obj_type, time.strftime('%Y-%m-%dT%H:%M:%S+0000'),
+                    len(versions) + 1, 'benchmark', ws['id'], workspace, 'md5',
+                    len(json.dumps(data)), meta or {}]
+            versions.append({'data': data, 'info': info})
+            return info
+
+    def _lookup(self, spec):
+        if 'ref' in spec:
+            parts = spec['ref'].split('/')
+            ws_ident, obj_ident = parts[0], parts[1]
+            version = int(parts[2]) if len(parts) > 2 else None
+        else:
+            ws_ident = spec.get('workspace', spec.get('wsid'))
+            obj_ident = spec.get('name', spec.get('objid'))
+            version = spec.get('ver')
+        _, ws = self._find_workspace(ws_ident)
+        for name, versions in ws['objects'].items():
+            if str(obj_ident) in (name, str(versions[0]['info'][0])):
+                return versions[version - 1] if version else versions[-1]
+        raise ValueError('No object ' + str(obj_ident))
+
+    @staticmethod
+    def _subset(data, paths):
+        subset = {}
+        for path in paths:
+            keys = path.strip('/').split('/')
+            source, target = data, subset
+            for key in keys[:-1]:
+                if not isinstance(source, dict) or key not in source:
+                    source = None
+                    break
+                source = source[key]
+                target = target.setdefault(key, {})
+            if isinstance(source, dict) and keys[-1] in source:
+                target[keys[-1]] = source[keys[-1]]
+        return subset
+
+    def call(self, method, params):
+        name = method.split('.')[-1]
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if name == 'get_objects':
+            return [self._lookup(spec) for spec in params[0]]
+        if name in ('get_objects2',):
+            return {'data': [self._lookup(spec) for spec in params[0]['objects']]}
+        if name == 'get_object_subset':
+            return [{'data': self._subset(self._lookup(spec)['data'], spec.get('included', [])),
+                     'info': self._lookup(spec)['info']} for spec in params[0]]
+        if name == 'get_object_info_new':
+            return [self._lookup(spec)['info'] for spec in params[0]['objects']]
+        if name == 'get_object_info3':
+            return {'infos': [self._lookup(spec)['info'] for spec in params[0]['objects']]}
+        if name == 'save_objects':
+            ws_ident = params[0].get('workspace', params[0].get('id'))
+            try:
+                ws_name, _ = self._find_workspace(ws_ident)
+            except ValueError:
+                ws_name = str(ws_ident)
+            return [self.put_object(ws_name, obj.get('name', str(uuid.uuid4())), obj['type'],
+                                    obj['data'], obj.get('meta')) for obj in params[0]['objects']]
+        if name == 'get_workspace_info':
+            ws_name, ws = self._find_workspace(params[0].get('workspace', params[0].get('id')))
+            return [ws['id'], ws_name, 'benchmark', '', 0, 'a', 'n', 'unlocked', {}]
+        if name == 'ver':
+            return '0.0.0-stub'
+        raise ValueError('Method ' + method + ' is not implemented by the stub workspace')
+
+    def handler(self):
+        return _json_rpc_handler(self.call)
+
+
+class StubHandleService(object):
+
+    def __init__(self):
+        self.handles = {}
+        self.url = None
+
+    def call(self, method, params):
+        name = method.split('.')[-1]
+        if name == 'persist_handle':
+            hid = 'KBH_%d' % (len(self.handles) + 1)
+            self.handles[hid] = params[0]
+            return hid
+        if name in ('hids_to_handles', 'fetch_handles_by'):
+            return [self.handles.get(hid, {'hid': hid}) for hid in params[0]]
+        if name == 'are_readable':
+            return 1
+        raise ValueError('Method ' + method + ' is not implemented by the stub handle service')
+
+    def handler(self):
+        return _json_rpc_handler(self.call)
+
+
+class StubJobService(object):
+    '''
+    KBaseJobService run_job/check_job.  Jobs never run; a job reports itself
+    finished once finish_after seconds have passed since it was submitted.
+    '''
+
+    def __init__(self, finish_after=5.0):
+        self.finish_after = finish_after
+        self.jobs = {}
+        self.url = None
+        self._lock = threading.Lock()
+
+    def call(self, method, params):
+        name = method.split('.')[-1]
+        if name == 'run_job':
+            job_id = uuid.uuid4().hex
+            with self._lock:
+                self.jobs[job_id] = {'params': params[0], 'submitted': time.time()}
+            return job_id
+        if name == 'check_job':
+            job = self.jobs.get(params[0])
+            if job is None:
+                raise ValueError('No job ' + str(params[0]))
+            finished = 1 if time.time() - job['submitted'] >= self.finish_after else 0
+            state = {'finished': finished, 'job_state': 'completed' if finished else 'running'}
+            if finished:
+                state['result'] = [{'report_name': 'stub', 'report_ref': '1/1/1'}]
+            return state
+        raise ValueError('Method ' + method + ' is not implemented by the stub job service')
+
+    def handler(self):
+        return _json_rpc_handler(self.call)
+
+
+def _json_rpc_handler(dispatch):
+
+    class Handler(_QuietHandler):
+
+        def do_POST(self):
+            request = {}
+            try:
+                request = json.loads(self._body().decode('utf-8'))
+                if not isinstance(request, dict):
+                    request = {}
+                    raise ValueError('Batch requests are not supported')
+                result = dispatch(request['method'], request.get('params', []))
+                body = {'version': '1.1', 'id': request.get('id'), 'result': [result]}
+                code = 200
+            except Exception as e:
+                body = {'version': '1.1', 'id': request.get('id'),
+                        'error': {'name': 'JSONRPCError', 'code': -32500,
+                                  'message': str(e), 'error': str(e)}}
+                code = 500
+            self._send(code, json.dumps(body))
+
+    return Handler
+
+
+class StubServices(object):
+    '''Starts all stand-ins on ephemeral localhost ports.'''
+
+    def __init__(self, storage_dir, host='127.0.0.1'):
+        if not os.path.exists(storage_dir):
+            os.makedirs(storage_dir)
+        self.host = host
+        self.shock = StubShock(storage_dir)
+        self.workspace = StubWorkspace()
+        self.handle_service = StubHandleService()
+        self.job_service = StubJobService()
+        self._servers = []
+
+    def _serve(self, service):
+        server = _ThreadingHTTPServer((self.host, 0), service.handler())
+        service.url = 'http://%s:%d' % (self.host, server.server_address[1])
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self._servers.append(server)
+
+    def start(self):
+        for service in (self.shock, self.workspace, self.handle_service, self.job_service):
+            self._serve(service)
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+
+    def config(self, scratch):
+        '''A deploy.cfg style dict pointing the Impl at the stand-ins.'''
+        return {'workspace-url': self.workspace.url,
+                'shock-url': self.shock.url,
+                'handle-service-url': self.handle_service.url,
+                'job-service-url': self.job_service.url,
+                'scratch': scratch}
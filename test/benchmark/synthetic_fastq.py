@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Seeded synthetic FASTQ generator for the benchmark suite.
+
+Reads are sampled from a random reference so they look like real fragments.
+A configurable fraction of fragments is shorter than the read length and is
+read through into the TruSeq3 adapter, and base qualities decay towards the
+3' end, so the adapter clipping and quality trimming steps have work to do.
+The same seed always produces the same files.
+
+    python synthetic_fastq.py --layout PE --reads 1000000 --gzip --out-dir data/
+"""
+import argparse
+import gzip
+import os
+import random
+import sys
+
+# TruSeq3 universal adapter read-through as it appears on read 1 and read 2
+ADAPTER_1 = 'AGATCGGAAGAGCACACGTCTGAACTCCAGTCAC'
+ADAPTER_2 = 'AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGT'
+
+_COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}
+
+LAYOUTS = ('SE', 'PE', 'interleaved')
+
+
+def reverse_complement(sequence):
+    return ''.join(_COMPLEMENT[base] for base in reversed(sequence))
+
+
+class SyntheticReads(object):
+    '''
+    Generates read records (name, sequence, quality).
+
+    read_length       -- length of every read before trimming
+    adapter_fraction  -- fraction of fragments shorter than read_length
+    quality_decay     -- mean phred drop from the first to the last base
+    '''
+
+    def __init__(self, seed=1, read_length=150, adapter_fraction=0.1,
+                 quality_decay=25, reference_length=2000000, quality_pool=4096,
+                 phred_offset=33):
+        self.rng = random.Random(seed)
+        self.read_length = read_length
+        self.adapter_fraction = adapter_fraction
+        self.reference = ''.join(self.rng.choice('ACGT') for _ in range(reference_length))
+        self.reference_rc = reverse_complement(self.reference)
+        # drawing qualities per base is the slow part, so a pool of decaying
+        # quality strings is built once and sampled from
+        self.qualities = [self._quality_string(quality_decay, phred_offset)
+                          for _ in range(quality_pool)]
+
+    def _quality_string(self, decay, offset):
+        quals = []
+        for position in range(self.read_length):
+            mean = 38 - decay * (float(position) / self.read_length) ** 2
+            q = int(self.rng.gauss(mean, 3))
+            quals.append(chr(offset + min(41, max(2, q))))
+        return ''.join(quals)
+
+    def _fragment(self):
+        if self.rng.random() < self.adapter_fraction:
+            insert = self.rng.randint(self.read_length // 4, self.read_length - 1)
+        else:
+            insert = self.rng.randint(self.read_length, 3 * self.read_length)
+        start = self.rng.randint(0, len(self.reference) - insert - 1)
+        return start, insert
+
+    def _read(self, fragment, adapter):
+        if len(fragment) >= self.read_length:
+            return fragment[:self.read_length]
+        padding = adapter + 'A' * self.read_length
+        return fragment + padding[:self.read_length - len(fragment)]
+
+    def pairs(self, count):
+        ref = self.reference
+        ref_rc = self.reference_rc
+        n = len(ref)
+        for index in range(count):
+            start, insert = self._fragment()
+            forward = self._read(ref[start:start + insert], ADAPTER_1)
+            rc_start = n - start - insert
+            reverse = self._read(ref_rc[rc_start:rc_start + insert], ADAPTER_2)
+            name = 'synthetic.%d' % index
+            yield ((name + '/1', forward, self.rng.choice(self.qualities)),
+                   (name + '/2', reverse, self.rng.choice(self.qualities)))
+
+    def single(self, count):
+        ref = self.reference
+        for index in range(count):
+            start, insert = self._fragment()
+            yield ('synthetic.%d' % index, self._read(ref[start:start + insert], ADAPTER_1),
+                   self.rng.choice(self.qualities))
+
+
+def _open(path, compress):
+    if compress:
+        return gzip.open(path, 'wb', compresslevel=1)
+    return open(path, 'wb')
+
+
+def _format(record):
+    return ('@%s\n%s\n+\n%s\n' % record).encode('ascii')
+
+
+def write_library(out_dir, layout, reads, seed=1, compress=False, read_length=150,
+                  adapter_fraction=0.1, quality_decay=25):
+    '''
+    Write a library and return the list of files written (one file for SE and
+    interleaved, two for PE).  reads counts fragments, so a PE library has
+    2 * reads records.
+    '''
+    if layout not in LAYOUTS:
+        raise ValueError('layout must be one of ' + ', '.join(LAYOUTS))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    generator = SyntheticReads(seed=seed, read_length=read_length,
+                               adapter_fraction=adapter_fraction,
+                               quality_decay=quality_decay)
+    suffix = '.fastq.gz' if compress else '.fastq'
+    base = os.path.join(out_dir, 'synthetic_%s_%d_seed%d' % (layout, reads, seed))
+    if layout == 'SE':
+        paths = [base + suffix]
+        with _open(paths[0], compress) as out:
+            for record in generator.single(reads):
+                out.write(_format(record))
+    elif layout == 'interleaved':
+        paths = [base + suffix]
+        with _open(paths[0], compress) as out:
+            for forward, reverse in generator.pairs(reads):
+                out.write(_format(forward) + _format(reverse))
+    else:
+        paths = [base + '_1' + suffix, base + '_2' + suffix]
+        with _open(paths[0], compress) as out1:
+            with _open(paths[1], compress) as out2:
+                for forward, reverse in generator.pairs(reads):
+                    out1.write(_format(forward))
+                    out2.write(_format(reverse))
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--layout', choices=LAYOUTS, default='PE')
+    parser.add_argument('--reads', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--read-length', type=int, default=150)
+    parser.add_argument('--adapter-fraction', type=float, default=0.1)
+    parser.add_argument('--quality-decay', type=float, default=25)
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--out-dir', default='.')
+    args = parser.parse_args(argv)
+    paths = write_library(args.out_dir, args.layout, args.reads, seed=args.seed,
+                          compress=args.gzip, read_length=args.read_length,
+                          adapter_fraction=args.adapter_fraction,
+                          quality_decay=args.quality_decay)
+    print('\n'.join(paths))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import unittest
+import os
+import random
+import shutil
+import tempfile
+
+from kb_trimmomatic.readfilter import filter_reads
+
+try:
+    from kb_trimmomatic import contaminants
+except ImportError:
+    contaminants = None
+
+_COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def reverse_complement(sequence):
+    return ''.join(_COMPLEMENT[base] for base in reversed(sequence))
+
+
+@unittest.skipIf(contaminants is None, 'numpy is not installed')
+class ContaminantIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fasta_dir = os.path.join(self.tmp, 'fasta')
+        self.cache_dir = os.path.join(self.tmp, 'cache')
+        os.makedirs(self.fasta_dir)
+        os.makedirs(self.cache_dir)
+        rng = random.Random(42)
+        # synthetic stand-ins for the bundled FASTA files
+        self.phage = random_sequence(rng, 2000)
+        self.vector = random_sequence(rng, 500)
+        self.clean = random_sequence(rng, 100)
+        with open(os.path.join(self.fasta_dir, 'phage.fa'), 'w') as f:
+            f.write('>phage\n' + '\n'.join(self.phage[i:i + 70] for i in range(0, len(self.phage), 70)) + '\n')
+        with open(os.path.join(self.fasta_dir, 'vector.fasta'), 'w') as f:
+            f.write('>vector1\n' + self.vector[:250] + '\n>vector2\n' + self.vector[250:] + '\n')
+        contaminants._loaded.clear()
+
+    def tearDown(self):
+        contaminants._loaded.clear()
+        shutil.rmtree(self.tmp)
+
+    def test_kmer_codes(self):
+        codes, valid, starts = contaminants.kmer_codes([b'ACGTA', b'TACGT'], 3)
+        self.assertEqual(list(starts), [0, 6])
+        # windows over the separator are invalid
+        self.assertEqual([bool(v) for v in valid], [True, True, True, False, False, False, True, True, True])
+        # ACG and its reverse complement CGT share their canonical code
+        self.assertEqual(codes[0], codes[1])
+
+    def test_matches(self):
+        index = contaminants.ContaminantIndex.load(self.fasta_dir, self.cache_dir, k=21)
+        self.assertEqual(index.names, ['phage.fa', 'vector.fasta'])
+        reads = [self.phage[100:250],
+                 reverse_complement(self.phage[500:600]),
+                 self.vector[200:300],
+                 self.clean,
+                 # a clean read ending in 30 bases of vector is no contaminant
+                 self.clean[:70] + self.vector[:30],
+                 'ACGT']
+        masks = index.matches([read.encode('ascii') for read in reads])
+        self.assertEqual(masks, [1, 1, 2, 0, 0, 0])
+
+    def test_cached_index_is_mapped(self):
+        built = contaminants.ContaminantIndex.load(self.fasta_dir, self.cache_dir, k=21)
+        contaminants._loaded.clear()
+        mapped = contaminants.ContaminantIndex.load(self.fasta_dir, self.cache_dir, k=21)
+        self.assertEqual(list(mapped.kmers), list(built.kmers))
+        self.assertEqual(list(mapped.sources), list(built.sources))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_filter_routes_pairs(self):
+        index = contaminants.ContaminantIndex.load(self.fasta_dir, self.cache_dir, k=21)
+        forward = os.path.join(self.tmp, 'f.fastq')
+        reverse = os.path.join(self.tmp, 'r.fastq')
+        rng = random.Random(7)
+        with open(forward, 'w') as f, open(reverse, 'w') as r:
+            for i in range(5):
+                mate1 = self.phage[i * 100:i * 100 + 100] if i == 2 else random_sequence(rng, 100)
+                mate2 = random_sequence(rng, 100)
+                f.write('@p%d/1\n%s\n+\n%s\n' % (i, mate1, 'I' * 100))
+                r.write('@p%d/2\n%s\n+\n%s\n' % (i, mate2, 'I' * 100))
+        outputs = [os.path.join(self.tmp, name) for name in ('kept_f', 'kept_r')]
+        screened = [os.path.join(self.tmp, name) for name in ('hit_f', 'hit_r')]
+        counts = filter_reads([[forward], [reverse]], outputs, screen=index, screened_outputs=screened,
+                              batch_size=2)
+        self.assertEqual((counts['kept'], counts['contaminants']), (4, 1))
+        self.assertEqual(counts['contaminant_sources'], {'phage.fa': 1})
+        with open(screened[1]) as f:
+            self.assertEqual(f.readline(), '@p2/2\n')
+
+    def test_describe(self):
+        line = contaminants.describe({'reads': 1000, 'contaminants': 12, 'paired': False,
+                                      'contaminant_sources': {'phix.fa': 10, 'univec_core.fa': 2}})
+        self.assertEqual(line, 'Contaminants removed: 12 of 1000 reads (1.20%); phix.fa 10, univec_core.fa 2')
+
+
+if __name__ == '__main__':
+    unittest.main()
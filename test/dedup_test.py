@@ -0,0 +1,41 @@
+import unittest
+
+from kb_trimmomatic.dedup import BloomFilter, describe
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_add(self):
+        bloom = BloomFilter.for_capacity(1000, 1 << 20)
+        self.assertFalse(bloom.add(b'ACGT'))
+        self.assertTrue(bloom.add(b'ACGT'))
+        self.assertFalse(bloom.add(b'ACGA'))
+        self.assertEqual(bloom.count, 2)
+
+    def test_memory_cap(self):
+        bloom = BloomFilter.for_capacity(10 ** 9, 1024)
+        self.assertEqual(bloom.nbytes, 1024)
+        self.assertTrue(1 <= bloom.hashes)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter.for_capacity(10000, 1 << 20, error_rate=1e-3)
+        false_positives = 0
+        for i in range(10000):
+            false_positives += bloom.add(str(i).encode('ascii'))
+        self.assertTrue(false_positives < 50)
+        self.assertTrue(bloom.false_positive_rate() < 1e-2)
+
+
+class DescribeTest(unittest.TestCase):
+
+    def test_describe(self):
+        line = describe({'reads': 200, 'duplicates': 50, 'paired': True,
+                         'filter_bytes': 1 << 20, 'false_positive_rate': 1e-5})
+        self.assertTrue(line.startswith('Duplicates removed: 50 of 200 read pairs (25.0%)'))
+        line = describe({'reads': 200, 'duplicates': 50, 'sampled_out': 100, 'paired': False,
+                         'filter_bytes': 1 << 20, 'false_positive_rate': 1e-5})
+        self.assertTrue(line.startswith('Duplicates removed: 50 of 100 reads (50.0%)'))
+
+
+if __name__ == '__main__':
+    unittest.main()
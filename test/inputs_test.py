@@ -0,0 +1,74 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from kb_trimmomatic.inputs import InputResolver, is_local, parse_roots
+
+
+class InputResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.shared = os.path.join(self.tmp, 'shared')
+        self.staging = os.path.join(self.tmp, 'staging')
+        os.makedirs(os.path.join(self.shared, 'run1'))
+        os.makedirs(os.path.join(self.staging, 'alice'))
+        os.makedirs(os.path.join(self.staging, 'bob'))
+        self.bobs = os.path.join(self.staging, 'bob', 'secret.fastq')
+        open(self.bobs, 'w').close()
+        self.reads = os.path.join(self.shared, 'run1', 'reads_R1.fastq.gz')
+        open(self.reads, 'w').close()
+        open(os.path.join(self.staging, 'alice', 'reads.fastq'), 'w').close()
+        self.outside = os.path.join(self.tmp, 'private.fastq')
+        open(self.outside, 'w').close()
+        self.resolver = InputResolver([self.shared, self.staging], self.staging)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_file_url(self):
+        handles = self.resolver.handles(['file://' + self.reads], 'alice')
+        self.assertEqual(handles, [{'path': os.path.realpath(self.reads), 'file_name': 'reads_R1.fastq.gz'}])
+        self.assertTrue(is_local(handles[0]))
+        self.assertFalse(is_local({'url': 'https://shock', 'id': 'node'}))
+
+    def test_staging_area_path(self):
+        path = self.resolver.resolve('reads.fastq', 'alice')
+        self.assertEqual(path, os.path.realpath(os.path.join(self.staging, 'alice', 'reads.fastq')))
+        self.assertRaises(ValueError, self.resolver.resolve, 'reads.fastq', 'bob')
+
+    def test_outside_allowed_roots(self):
+        self.assertRaises(ValueError, self.resolver.resolve, 'file://' + self.outside, 'alice')
+        self.assertRaises(ValueError, self.resolver.resolve, '../../private.fastq', 'alice')
+        link = os.path.join(self.shared, 'link.fastq')
+        os.symlink(self.outside, link)
+        self.assertRaises(ValueError, self.resolver.resolve, 'file://' + link, 'alice')
+        # a sibling directory sharing the root's name prefix is outside too
+        os.makedirs(self.shared + '2')
+        sibling = os.path.join(self.shared + '2', 'reads.fastq')
+        open(sibling, 'w').close()
+        self.assertRaises(ValueError, self.resolver.resolve, 'file://' + sibling, 'alice')
+
+    def test_other_users_staging_area(self):
+        self.assertRaises(ValueError, self.resolver.resolve, '../bob/secret.fastq', 'alice')
+        self.assertRaises(ValueError, self.resolver.resolve, 'file://' + self.bobs, 'alice')
+        self.assertRaises(ValueError, self.resolver.resolve, 'secret.fastq', '../bob')
+        link = os.path.join(self.staging, 'alice', 'link.fastq')
+        os.symlink(self.bobs, link)
+        self.assertRaises(ValueError, self.resolver.resolve, 'link.fastq', 'alice')
+        # the owner reaches the file either way
+        self.assertEqual(self.resolver.resolve('secret.fastq', 'bob'), os.path.realpath(self.bobs))
+        self.assertEqual(self.resolver.resolve('file://' + self.bobs, 'bob'), os.path.realpath(self.bobs))
+
+    def test_disabled_and_arity(self):
+        disabled = InputResolver(parse_roots(''))
+        self.assertFalse(disabled.enabled)
+        self.assertRaises(ValueError, disabled.resolve, 'file://' + self.reads, 'alice')
+        self.assertRaises(ValueError, self.resolver.handles, [], 'alice')
+        self.assertRaises(ValueError, self.resolver.handles, ['file://' + self.reads] * 3, 'alice')
+        self.assertEqual(parse_roots(' /a, /b ,'), ['/a', '/b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
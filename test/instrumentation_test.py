@@ -0,0 +1,36 @@
+import unittest
+import json
+import shutil
+import tempfile
+
+from kb_trimmomatic.instrumentation import JobTrace
+
+
+class JobTraceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.trace_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.trace_dir)
+
+    def test_phases_are_traced(self):
+        trace = JobTrace(trace_dir=self.trace_dir)
+        with trace.phase('download') as span:
+            span.bytes_out = 100
+        with trace.phase('trim') as span:
+            span.reads = 10
+        try:
+            with trace.phase('upload'):
+                raise IOError('upload failed')
+        except IOError:
+            pass
+
+        with open(trace.trace_path) as trace_file:
+            records = [json.loads(line) for line in trace_file]
+        self.assertEqual([r['phase'] for r in records], ['download', 'trim', 'upload'])
+        self.assertEqual(records[0]['bytes_out'], 100)
+        self.assertEqual(records[2]['status'], 'error')
+        summary = trace.summary()
+        self.assertEqual(len(summary['phases']), 3)
+        self.assertIn('trim', trace.format_table())
@@ -0,0 +1,131 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from kb_trimmomatic import jobdir
+from kb_trimmomatic.jobdir import JobDirectory, InsufficientScratchSpace, estimate_scratch_bytes
+
+
+class JobDirectoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def test_directory_removed_on_error(self):
+        try:
+            with JobDirectory(self.scratch, 'a') as job_dir:
+                with open(job_dir.path('reads.fastq'), 'w') as f:
+                    f.write('@r\nACGT\n+\nIIII\n')
+                raise RuntimeError('trimming failed')
+        except RuntimeError:
+            pass
+        self.assertFalse(os.path.exists(job_dir.root))
+        self.assertEqual(jobdir.reserved_bytes(), 0)
+
+    def test_keep(self):
+        with JobDirectory(self.scratch, 'b', keep=True) as job_dir:
+            pass
+        self.assertTrue(os.path.isdir(job_dir.root))
+
+    def test_paths_stay_in_job_directory(self):
+        with JobDirectory(self.scratch, 'c') as job_dir:
+            self.assertEqual(job_dir.path('../../etc/passwd'), os.path.join(job_dir.root, 'passwd'))
+
+    def test_reservations_of_running_jobs_count(self):
+        free = jobdir.free_bytes(self.scratch)
+        with JobDirectory(self.scratch, 'd') as first, JobDirectory(self.scratch, 'e') as second:
+            first.reserve(free // 2 + 1)
+            self.assertEqual(jobdir.reserved_bytes(), free // 2 + 1)
+            self.assertRaises(InsufficientScratchSpace, second.reserve, free // 2 + 1)
+            first.release()
+            second.reserve(free // 2 + 1)
+        self.assertEqual(jobdir.reserved_bytes(), 0)
+
+    def test_estimate(self):
+        self.assertEqual(estimate_scratch_bytes([100, 50], compressed=False), 300)
+        # download next to the deinterleaved copy is smaller than copy plus outputs
+        self.assertEqual(estimate_scratch_bytes([100], compressed=True, expansion=4), 800)
+
+    def test_files_deleted_after_last_consumer(self):
+        with JobDirectory(self.scratch, 'f') as job_dir:
+            reads = job_dir.path('reads.fastq')
+            trimmed = job_dir.path('trimmed_reads.fastq')
+            for path, size in ((reads, 100), (trimmed, 60)):
+                with open(path, 'w') as f:
+                    f.write('x' * size)
+            job_dir.track(reads, ['qc_input', 'trim'])
+            job_dir.track(trimmed, ['upload'])
+
+            job_dir.record_span(FakeSpan('qc_input'))
+            self.assertTrue(os.path.exists(reads))
+            span = FakeSpan('trim')
+            job_dir.record_span(span)
+            self.assertEqual(span.attributes['scratch_bytes'], 160)
+            self.assertFalse(os.path.exists(reads))
+            self.assertTrue(os.path.exists(trimmed))
+
+            # a failed upload keeps its input
+            job_dir.record_span(FakeSpan('upload', 'error'))
+            self.assertTrue(os.path.exists(trimmed))
+            job_dir.record_span(FakeSpan('upload'))
+            self.assertFalse(os.path.exists(trimmed))
+            self.assertEqual(job_dir.usage_bytes, 0)
+            self.assertEqual(job_dir.peak_bytes, 160)
+
+    def test_resumable_directory_kept_after_failure(self):
+        try:
+            with JobDirectory(self.scratch, 'r', resumable=True) as job_dir:
+                with open(job_dir.path('forward.fastq'), 'w') as f:
+                    f.write('@r\nACGT\n+\nIIII\n')
+                # a second attempt cannot run while the first one holds the directory
+                self.assertRaises(ValueError, JobDirectory(self.scratch, 'r', resumable=True).__enter__)
+                raise RuntimeError('upload failed')
+        except RuntimeError:
+            pass
+        self.assertTrue(os.path.exists(job_dir.path('forward.fastq')))
+        with JobDirectory(self.scratch, 'r', resumable=True) as retry:
+            self.assertTrue(os.path.exists(retry.path('forward.fastq')))
+        self.assertFalse(os.path.exists(retry.root))
+
+    def test_remove_stale(self):
+        with JobDirectory(self.scratch, 'old', resumable=True) as running:
+            os.utime(running.root, (0, 0))
+            jobdir.remove_stale(self.scratch, 3600)
+            self.assertTrue(os.path.isdir(running.root))
+        os.makedirs(os.path.join(self.scratch, 'job_abandoned'))
+        os.makedirs(os.path.join(self.scratch, 'job_recent'))
+        os.utime(os.path.join(self.scratch, 'job_abandoned'), (0, 0))
+        jobdir.remove_stale(self.scratch, 3600)
+        self.assertEqual(sorted(os.listdir(self.scratch)), ['job_recent'])
+
+    def test_files_outside_job_directory_are_never_deleted(self):
+        staged = os.path.join(self.scratch, 'staged.fastq')
+        open(staged, 'w').close()
+        with JobDirectory(self.scratch, 's') as job_dir:
+            job_dir.track(staged, [])
+            job_dir.track(staged, ['trim'])
+            job_dir.record_span(FakeSpan('trim'))
+        self.assertTrue(os.path.exists(staged))
+
+    def test_budget(self):
+        with JobDirectory(self.scratch, 'g', budget=1000) as first, \
+                JobDirectory(self.scratch, 'h', budget=1000) as second:
+            first.reserve(600)
+            self.assertRaises(InsufficientScratchSpace, second.reserve, 500)
+            second.reserve(400)
+
+
+class FakeSpan(object):
+
+    def __init__(self, name, status='ok'):
+        self.name = name
+        self.status = status
+        self.attributes = {}
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from kb_trimmomatic.joblog import JobConsole
+
+
+class Stream(object):
+
+    def __init__(self):
+        self.writes = []
+        self.flushes = 0
+
+    def write(self, text):
+        self.writes.append(text)
+
+    def flush(self):
+        self.flushes += 1
+
+    def lines(self):
+        return ''.join(self.writes).splitlines()
+
+
+class JobConsoleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'logs', 'job.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_repeats_are_collapsed(self):
+        stream = Stream()
+        with JobConsole(self.path, stream=stream) as console:
+            for message in ['start', 'tick', 'tick', 'tick', 'done', 'done']:
+                console.append(message)
+        self.assertEqual(stream.lines(), ['start', 'tick', '(last message repeated 2 more times)', 'done',
+                                          '(last message repeated 1 more times)'])
+        with open(self.path) as f:
+            self.assertEqual(f.read().splitlines(), ['start', 'tick', 'tick', 'tick', 'done', 'done'])
+        self.assertEqual((console.messages, console.repeated), (6, 3))
+
+    def test_rate_limit_and_ring_buffer(self):
+        stream = Stream()
+        console = JobConsole(self.path, capacity=5, rate=10, stream=stream)
+        for i in range(1000):
+            console.append('line %d' % i)
+        summary = console.summary()
+        console.close()
+        with open(self.path) as f:
+            self.assertEqual(len(f.read().splitlines()), 1000)
+        self.assertTrue(len(stream.lines()) < 100)
+        self.assertTrue(stream.flushes < 100)
+        self.assertEqual(len(console.lines), 5)
+        self.assertTrue(console.suppressed > 900)
+        self.assertTrue(stream.lines()[-1].endswith('messages only in the job log attached to the report)'))
+        self.assertTrue(summary.startswith('Job log: 1000 messages, 0 repeats collapsed and '))
+        self.assertTrue(summary.endswith('; full log: job.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+
+from kb_trimmomatic.lanes import ConcatPipe, check_lanes, library_names
+
+
+class FakeSniff(object):
+
+    def __init__(self, quality_offset):
+        self.quality_offset = quality_offset
+
+
+class LanesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_library_names(self):
+        self.assertEqual(library_names('reads'), ['reads'])
+        self.assertEqual(library_names(['lane1', 'lane2']), ['lane1', 'lane2'])
+        self.assertRaises(ValueError, library_names, [])
+        self.assertRaises(ValueError, library_names, ['lane1', 'lane1'])
+
+    def test_check_lanes(self):
+        check_lanes(['a', 'b', 'c'], [FakeSniff(33), FakeSniff(None), None])
+        self.assertRaises(ValueError, check_lanes, ['a', 'b'], [FakeSniff(33), FakeSniff(64)])
+
+    def read_pipe(self, path, result):
+        with open(path, 'rb') as pipe:
+            result.append(pipe.read())
+
+    def test_concatenates_and_decompresses(self):
+        plain = os.path.join(self.tmp, 'lane1.fastq')
+        with open(plain, 'wb') as f:
+            f.write(b'@r1\nACGT\n+\nIIII\n')
+        compressed = os.path.join(self.tmp, 'lane2.fastq.gz')
+        with gzip.open(compressed, 'wb') as f:
+            f.write(b'@r2\nTTTT\n+\nIIII\n')
+        path = os.path.join(self.tmp, 'lanes.fastq')
+        result = []
+        with ConcatPipe(path, [plain, compressed]):
+            reader = threading.Thread(target=self.read_pipe, args=(path, result))
+            reader.start()
+            reader.join()
+        self.assertEqual(result, [b'@r1\nACGT\n+\nIIII\n@r2\nTTTT\n+\nIIII\n'])
+        self.assertFalse(os.path.exists(path))
+
+    def test_reader_never_opens(self):
+        plain = os.path.join(self.tmp, 'lane1.fastq')
+        with open(plain, 'wb') as f:
+            f.write(b'@r1\nACGT\n+\nIIII\n')
+        path = os.path.join(self.tmp, 'lanes.fastq')
+        try:
+            with ConcatPipe(path, [plain]):
+                raise RuntimeError('trimmomatic failed')
+        except RuntimeError:
+            pass
+        self.assertFalse(os.path.exists(path))
+
+    def test_unreadable_lane(self):
+        path = os.path.join(self.tmp, 'lanes.fastq')
+        result = []
+
+        def run():
+            with ConcatPipe(path, [os.path.join(self.tmp, 'missing.fastq')]):
+                reader = threading.Thread(target=self.read_pipe, args=(path, result))
+                reader.start()
+                reader.join()
+        self.assertRaises(ValueError, run)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from kb_trimmomatic.manifest import Manifest, run_key
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.job_dir = tempfile.mkdtemp()
+        self.reads = os.path.join(self.job_dir, 'forward.fastq')
+        with open(self.reads, 'w') as f:
+            f.write('@r1\nACGT\n+\nIIII\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.job_dir)
+
+    def test_checkpoints_survive_reload(self):
+        manifest = Manifest(self.job_dir, 'key')
+        self.assertEqual(manifest.check_source('1/2/3'), [])
+        manifest.done('deinterleave', [self.reads])
+        manifest.done('trim', data={'counts': {'input_reads': 1}})
+
+        resumed = Manifest(self.job_dir, 'key')
+        self.assertEqual(resumed.check_source('1/2/3'), ['deinterleave', 'trim'])
+        self.assertTrue(resumed.intact('deinterleave', [self.reads]))
+        self.assertEqual(resumed.data('trim'), {'counts': {'input_reads': 1}})
+        self.assertFalse(resumed.intact('download', [self.reads]))
+
+    def test_changed_output_is_not_intact(self):
+        manifest = Manifest(self.job_dir, 'key')
+        manifest.done('deinterleave', [self.reads])
+        with open(self.reads, 'w') as f:
+            f.write('@r1\nACGA\n+\nIIII\n')
+        # the same size, rewritten later
+        later = os.path.getmtime(self.reads) + 1
+        os.utime(self.reads, (later, later))
+        self.assertFalse(manifest.intact('deinterleave', [self.reads]))
+        os.remove(self.reads)
+        self.assertFalse(manifest.intact('deinterleave', [self.reads]))
+
+    def test_new_library_version_drops_checkpoints(self):
+        manifest = Manifest(self.job_dir, 'key')
+        manifest.check_source('1/2/3')
+        manifest.done('trim', data={})
+        resumed = Manifest(self.job_dir, 'key')
+        self.assertEqual(resumed.check_source('1/2/4'), [])
+        self.assertIsNone(resumed.get('trim'))
+
+    def test_other_key_or_disabled(self):
+        Manifest(self.job_dir, 'key').done('trim', data={})
+        self.assertIsNone(Manifest(self.job_dir, 'other').get('trim'))
+        disabled = Manifest(self.job_dir, 'key', enabled=False)
+        self.assertIsNone(disabled.get('trim'))
+        disabled.done('upload', data={})
+        self.assertIsNone(Manifest(self.job_dir, 'key').get('upload'))
+
+    def test_finished_job_is_not_resumed(self):
+        manifest = Manifest(self.job_dir, 'key')
+        manifest.check_source('1/2/3')
+        manifest.done('save_report', data={'report_name': 'r'})
+        self.assertIsNotNone(Manifest(self.job_dir, 'key').get('save_report'))
+        manifest.finish()
+        again = Manifest(self.job_dir, 'key')
+        self.assertIsNone(again.get('save_report'))
+        self.assertEqual(again.check_source('1/2/3'), [])
+
+    def test_run_key(self):
+        self.assertEqual(run_key('user', {'a': 1, 'b': 2}), run_key('user', {'b': 2, 'a': 1}))
+        self.assertNotEqual(run_key('user', {'a': 1}), run_key('other', {'a': 1}))
+
+
+if __name__ == '__main__':
+    unittest.main()
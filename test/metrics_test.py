@@ -0,0 +1,90 @@
+import unittest
+import shutil
+import tempfile
+import time
+
+from kb_trimmomatic.metrics import Registry, SharedMetrics
+
+
+def registry():
+    # the same series, as every process defines them
+    registry = Registry()
+    registry.counter('bytes_total', 'Bytes.')
+    registry.gauge('in_flight', 'In flight.')
+    registry.histogram('seconds', 'Seconds.', buckets=(1.0,))
+    return registry
+
+
+class RegistryTest(unittest.TestCase):
+
+    def test_render_prometheus_text(self):
+        registry = Registry()
+        requests = registry.counter('requests_total', 'Requests.', ('method',))
+        in_flight = registry.gauge('in_flight', 'In flight.')
+        latency = registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+        requests.inc(method='kb_trimmomatic.runTrimmomatic')
+        requests.inc(2, method='kb_trimmomatic.runTrimmomatic')
+        in_flight.inc()
+        latency.observe(0.05)
+        latency.observe(0.5)
+        latency.observe(5)
+
+        text = registry.render()
+        self.assertIn('# TYPE requests_total counter', text)
+        self.assertIn('requests_total{method="kb_trimmomatic.runTrimmomatic"} 3', text)
+        self.assertIn('in_flight 1', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_count 3', text)
+
+    def test_labels_are_checked(self):
+        registry = Registry()
+        requests = registry.counter('requests_total', 'Requests.', ('method',))
+        self.assertRaises(ValueError, requests.inc, status='200')
+        self.assertRaises(ValueError, registry.counter, 'requests_total', 'Again.')
+
+
+class SharedMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def process(self, interval=60):
+        shared = SharedMetrics(registry(), self.tmp, interval)
+        return shared, shared.registry
+
+    def test_processes_are_summed(self):
+        server, server_registry = self.process()
+        job, job_registry = self.process()
+        server_registry.get('bytes_total').inc(10)
+        job_registry.get('bytes_total').inc(5)
+        job_registry.get('in_flight').inc()
+        job_registry.get('seconds').observe(0.5)
+        job.write()
+        text = server.render()
+        self.assertIn('bytes_total 15', text)
+        self.assertIn('in_flight 1', text)
+        self.assertIn('seconds_count 1', text)
+
+    def test_processes_that_are_gone_keep_their_counts(self):
+        server, server_registry = self.process(interval=0.01)
+        job, job_registry = self.process(interval=0.01)
+        job_registry.get('bytes_total').inc(5)
+        job_registry.get('in_flight').inc()
+        job.write()
+        time.sleep(0.1)
+        text = server.render()
+        self.assertIn('bytes_total 5', text)
+        self.assertNotIn('in_flight 1', text)
+        # a process that was only stalled goes on from what was archived
+        job_registry.get('bytes_total').inc(2)
+        job.write()
+        self.assertIn('bytes_total 7', server.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from kb_trimmomatic import progress
+from kb_trimmomatic.instrumentation import JobTrace
+
+
+class JobProgressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_phases_and_estimate(self):
+        path = progress.state_path(self.tmp, 'run1')
+        lines = []
+        job = progress.JobProgress(path, log=lines.append, interval=0, log_interval=0)
+        trace = JobTrace(progress=job)
+        with trace.phase('download'):
+            job.measure(1000, 'bytes')
+            job.phase_start -= 10
+            job.add(250, 'bytes_downloaded')
+            with open(path) as f:
+                state = json.load(f)
+            self.assertEqual((state['phase'], state['percent'], state['bytes_downloaded']), ('download', 25.0, 250))
+            self.assertAlmostEqual(state['phase_eta_seconds'], 30, delta=1)
+            self.assertTrue(lines[-1].startswith('Progress: download, 25.0% of 1000 bytes, about 3'))
+        job.finish('finished')
+        with open(path) as f:
+            state = json.load(f)
+        self.assertEqual((state['status'], state['phase'], state['phases_done']), ('finished', None, ['download']))
+
+    def test_updates_are_throttled(self):
+        path = progress.state_path(self.tmp, 'run1')
+        job = progress.JobProgress(path, interval=3600)
+        job.start_phase('trim')
+        job.measure(10, 'reads')
+        job.set(5, 'reads_processed')
+        with open(path) as f:
+            self.assertNotIn('done', json.load(f))
+        self.assertEqual(job.reads_processed, 5)
+
+    def test_poll(self):
+        job = progress.JobProgress(interval=0.01)
+        job.start_phase('trim')
+        samples = iter(range(1, 1000))
+        with job.poll(lambda: next(samples), 'reads_processed'):
+            time.sleep(0.1)
+        self.assertTrue(job.done > 0)
+        self.assertEqual(job.reads_processed, job.done)
+
+    def test_job_state(self):
+        self.assertIsNone(progress.state_path(self.tmp, '../run'))
+        self.assertIsNone(progress.job_state(self.tmp, 'job1'))
+        progress.record_job(self.tmp, 'job1', 'run1')
+        progress.JobProgress(progress.state_path(self.tmp, 'run1')).start_phase('download')
+        self.assertEqual(progress.job_state(self.tmp, 'job1')['phase'], 'download')
+        self.assertRaises(ValueError, progress.record_job, self.tmp, '../job', 'run1')
+        progress.remove_stale(self.tmp, -1)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_run_records(self):
+        self.assertFalse(progress.run_recorded(self.tmp, 'run1'))
+        progress.record_run(self.tmp, 'run1')
+        self.assertTrue(progress.run_recorded(self.tmp, 'run1'))
+        self.assertFalse(progress.run_recorded(os.path.join(self.tmp, 'elsewhere'), 'run1'))
+        self.assertFalse(progress.run_recorded(self.tmp, '../run1'))
+        self.assertRaises(ValueError, progress.record_run, self.tmp, '../run1')
+
+    def test_file_offsets(self):
+        path = os.path.join(self.tmp, 'reads.fastq')
+        with open(path, 'wb') as f:
+            f.write(b'x' * 1000)
+        offsets = progress.FileOffsets([path])
+        self.assertEqual((offsets.total(), offsets()), (1000, 0))
+        with open(path, 'rb', 0) as f:
+            f.read(300)
+            self.assertEqual(offsets(), 300)
+        # read and closed
+        self.assertEqual(offsets(), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
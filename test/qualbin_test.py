@@ -0,0 +1,133 @@
+import unittest
+import gzip
+import io
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+
+try:
+    from kb_trimmomatic import qualbin
+except ImportError:
+    qualbin = None
+
+
+def fastq(count, seed=1):
+    rng = random.Random(seed)
+    records = []
+    for number in range(count):
+        length = 100
+        quality = ''.join(chr(33 + min(41, max(2, int(rng.gauss(34 - position / 10.0, 5)))))
+                          for position in range(length))
+        sequence = ''.join(rng.choice('ACGT') for _ in range(length))
+        records.append('@read%d\n%s\n+\n%s\n' % (number, sequence, quality))
+    return ''.join(records).encode('ascii')
+
+
+def gzip_bytes(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    return out.getvalue()
+
+
+@unittest.skipIf(qualbin is None, 'numpy is not installed')
+class QualityBinningTest(unittest.TestCase):
+
+    def test_lookup_table(self):
+        table = qualbin.lookup_table('illumina8')
+        self.assertEqual([int(table[33 + q]) - 33 for q in (0, 1, 2, 9, 10, 19, 20, 24, 25, 30, 35, 39, 40, 41)],
+                         [0, 1, 6, 6, 15, 15, 22, 22, 27, 33, 37, 37, 40, 40])
+        table = qualbin.lookup_table('illumina4', phred_offset=64)
+        self.assertEqual([int(table[64 + q]) - 64 for q in (0, 2, 3, 14, 15, 30, 31, 41)],
+                         [2, 2, 12, 12, 23, 23, 37, 37])
+        # newlines and bytes below the offset are left alone
+        self.assertEqual(int(table[10]), 10)
+        self.assertEqual(int(table[33]), 33)
+
+    def test_scheme_name(self):
+        self.assertIsNone(qualbin.scheme_name('none'))
+        self.assertEqual(qualbin.scheme_name('illumina4'), 'illumina4')
+        with self.assertRaises(ValueError):
+            qualbin.scheme_name('illumina2')
+
+    def test_bin_stream(self):
+        stats = qualbin.BinningStats('illumina8')
+        output = io.BytesIO()
+        qualbin.bin_stream(io.BytesIO(b'@r1\nACGT\n+\n#+5I\n@r2\nAC\n+r2\nJ!\n'), output,
+                           qualbin.lookup_table('illumina8'), stats, block_size=16)
+        self.assertEqual(output.getvalue(), b'@r1\nACGT\n+\n\'07I\n@r2\nAC\n+\nI!\n')
+        self.assertEqual((stats.reads, stats.bases), (2, 6))
+
+    def test_bin_stream_gzip(self):
+        # Trimmomatic gzips the outputs of gzip'd inputs; gathered shards are
+        # gzip members one after the other
+        data = fastq(300)
+        table = qualbin.lookup_table('illumina8')
+        plain = io.BytesIO()
+        qualbin.bin_stream(io.BytesIO(data), plain, table, qualbin.BinningStats('illumina8'))
+        members = gzip_bytes(data[:len(data) // 2]) + gzip_bytes(data[len(data) // 2:])
+        for compressed in (gzip_bytes(data), members):
+            stats = qualbin.BinningStats('illumina8')
+            output = io.BytesIO()
+            qualbin.bin_stream(io.BytesIO(compressed), output, table, stats, block_size=1000)
+            self.assertEqual(output.getvalue()[:2], b'\x1f\x8b')
+            self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(output.getvalue())).read(), plain.getvalue())
+            self.assertEqual(stats.reads, 300)
+
+    def test_compression_gain(self):
+        stats = qualbin.BinningStats('illumina8')
+        output = io.BytesIO()
+        qualbin.bin_stream(io.BytesIO(fastq(2000)), output, qualbin.lookup_table('illumina8'), stats)
+        result = stats.to_dict()
+        self.assertLess(result['sample_gzip_after'], 0.9 * result['sample_gzip_before'])
+        self.assertIn('smaller', qualbin.describe(result))
+
+    def test_pipe(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            fifo = os.path.join(work_dir, 'out.fifo')
+            output = os.path.join(work_dir, 'out.fastq')
+            stats = qualbin.BinningStats('illumina4')
+            data = fastq(100)
+            with qualbin.BinningPipe(fifo, output, qualbin.lookup_table('illumina4'), stats):
+                writer = subprocess.Popen(['sh', '-c', 'cat > "$0"', fifo], stdin=subprocess.PIPE)
+                writer.communicate(data)
+            with open(output, 'rb') as f:
+                binned = f.read()
+            self.assertEqual(len(binned), len(data))
+            self.assertEqual(stats.reads, 100)
+            self.assertFalse(os.path.exists(fifo))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_gzip_pipe(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            fifo = os.path.join(work_dir, 'binning_out.fastq.gz')
+            output = os.path.join(work_dir, 'out.fastq.gz')
+            stats = qualbin.BinningStats('illumina4')
+            with qualbin.BinningPipe(fifo, output, qualbin.lookup_table('illumina4'), stats):
+                writer = subprocess.Popen(['sh', '-c', 'gzip -c > "$0"', fifo], stdin=subprocess.PIPE)
+                writer.communicate(fastq(100))
+            with gzip.open(output, 'rb') as f:
+                self.assertEqual(len(f.read()), len(fastq(100)))
+            self.assertEqual(stats.reads, 100)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_pipe_never_opened(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(work_dir, 'out.fastq')
+            with qualbin.BinningPipe(os.path.join(work_dir, 'out.fifo'), output,
+                                     qualbin.lookup_table('illumina8'), qualbin.BinningStats('illumina8')):
+                pass
+            self.assertEqual(os.path.getsize(output), 0)
+        finally:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import io
+import multiprocessing
+import os
+import pickle
+
+try:
+    from kb_trimmomatic import readbatch
+except ImportError:
+    readbatch = None
+
+FASTQ = b'@r1 comment\nACGTN\n+\nIIII#\n@r2\nGGC\n+r2\n5I+\n@r3\n\n+\n\n@r4\nAAAAAA\n+\nIIIIII\n'
+
+
+def count_gc(batch):
+    return int(((batch.sequences == ord('G')) | (batch.sequences == ord('C'))).sum())
+
+
+@unittest.skipIf(readbatch is None, 'numpy is not installed')
+class ReadBatchTest(unittest.TestCase):
+
+    def test_parse_block(self):
+        batch, consumed = readbatch.parse_block(FASTQ + b'@r5\nAC')
+        self.assertEqual(consumed, len(FASTQ))
+        self.assertEqual(len(batch), 4)
+        self.assertEqual(list(batch.records())[:2], [(b'r1 comment', b'ACGTN', b'IIII#'), (b'r2', b'GGC', b'5I+')])
+        self.assertEqual(batch.sequence(2), b'')
+        self.assertEqual(list(batch.lengths()), [5, 3, 0, 6])
+
+    def test_crlf(self):
+        batch, consumed = readbatch.parse_block(b'@r1\r\nACG\r\n+\r\nIII\r\n')
+        self.assertEqual((consumed, list(batch.records())), (18, [(b'r1', b'ACG', b'III')]))
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, readbatch.parse_block, b'@r1\nACG\n+\nIII\nr2\nACG\n+\nIII\n')
+        self.assertRaises(ValueError, readbatch.parse_block, b'@r1\nACG\n+\nII\n')
+
+    def test_read_batches_across_blocks(self):
+        for block_size in (1, 7, 30, 1 << 20):
+            batches = list(readbatch.read_batches(io.BytesIO(FASTQ[:-1]), block_size))
+            records = [record for batch in batches for record in batch.records()]
+            self.assertEqual([name for name, _, _ in records], [b'r1 comment', b'r2', b'r3', b'r4'])
+        self.assertRaises(ValueError, list, readbatch.read_batches(io.BytesIO(FASTQ + b'@r5\nAC\n')))
+
+    def test_aligned_mates(self):
+        forward = [readbatch.read_batches(io.BytesIO(FASTQ), 7)]
+        reverse = [readbatch.read_batches(io.BytesIO(FASTQ), 1 << 20)]
+        mates = list(readbatch.aligned(forward + reverse))
+        self.assertTrue(all(len(pair[0]) == len(pair[1]) for pair in mates))
+        whole = readbatch.parse_block(FASTQ)[0].tofastq()
+        self.assertEqual(b''.join(pair[0].tofastq() for pair in mates), whole)
+        self.assertEqual(b''.join(pair[1].tofastq() for pair in mates), whole)
+        short = readbatch.read_batches(io.BytesIO(FASTQ.split(b'@r4')[0]))
+        self.assertRaises(ValueError, list, readbatch.aligned([readbatch.read_batches(io.BytesIO(FASTQ)), short]))
+
+    def test_tofastq_and_take(self):
+        batch, _ = readbatch.parse_block(FASTQ)
+        self.assertEqual(batch.tofastq(), FASTQ.replace(b'+r2\n', b'+\n'))
+        picked = batch.take(batch.lengths() > 3)
+        self.assertEqual([name for name, _, _ in picked.records()], [b'r1 comment', b'r4'])
+        self.assertEqual(readbatch.ReadBatch.from_records(list(picked.records())).tofastq(), picked.tofastq())
+        self.assertEqual(batch.take([False] * 4).tofastq(), b'')
+        self.assertEqual(batch.take([False, False, True, True]).tofastq(), b'@r3\n\n+\n\n@r4\nAAAAAA\n+\nIIIIII\n')
+
+    def test_shared_batch(self):
+        batch, _ = readbatch.parse_block(FASTQ)
+        handle = pickle.loads(pickle.dumps(readbatch.share(batch)))
+        try:
+            self.assertEqual(readbatch.attach(handle).tofastq(), batch.tofastq())
+        finally:
+            readbatch.release(handle)
+        self.assertFalse(os.path.exists(handle.path))
+
+    def test_map_shared(self):
+        batches = [readbatch.parse_block(FASTQ)[0]] * 5
+        pool = multiprocessing.Pool(2)
+        try:
+            self.assertEqual(list(readbatch.map_shared(pool, count_gc, batches, in_flight=2)), [5] * 5)
+        finally:
+            pool.close()
+            pool.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
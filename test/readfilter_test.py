@@ -0,0 +1,98 @@
+import unittest
+import gzip
+import os
+import shutil
+import tempfile
+
+from kb_trimmomatic.dedup import BloomFilter
+from kb_trimmomatic import readfilter
+from kb_trimmomatic.readfilter import filter_reads
+from kb_trimmomatic.sampling import HashSampler
+
+
+def fastq(sequences, prefix='r', suffix=''):
+    return b''.join(('@%s%d%s\n' % (prefix, i, suffix)).encode('ascii') + seq + b'\n+\n' +
+                    b'I' * len(seq) + b'\n' for i, seq in enumerate(sequences))
+
+
+class FilterReadsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data, compress=False):
+        path = os.path.join(self.tmp, name)
+        with (gzip.open(path, 'wb') if compress else open(path, 'wb')) as f:
+            f.write(data)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def bloom(self):
+        return BloomFilter.for_capacity(1000, 1 << 16)
+
+    def test_dedup_across_lanes(self):
+        lane1 = self.write('lane1.fastq.gz', fastq([b'AAAA', b'CCCC', b'AAAA']), compress=True)
+        lane2 = self.write('lane2.fastq', fastq([b'CCCC', b'GGGG'], prefix='s'))
+        output = os.path.join(self.tmp, 'filtered.fastq')
+        counts = filter_reads([[lane1, lane2]], [output], bloom=self.bloom())
+        self.assertEqual(counts, {'reads': 5, 'duplicates': 2, 'sampled_out': 0, 'contaminants': 0,
+                                  'contaminant_sources': {}, 'kept': 3})
+        self.assertEqual(self.read(output), b'@r0\nAAAA\n+\nIIII\n@r1\nCCCC\n+\nIIII\n@s1\nGGGG\n+\nIIII\n')
+
+    def test_pairs_hashed_together(self):
+        forward = self.write('f.fastq', fastq([b'AAAA', b'AAAA', b'AAAA']))
+        reverse = self.write('r.fastq', fastq([b'TTTT', b'GGGG', b'TTTT']))
+        outputs = [os.path.join(self.tmp, 'filtered_forward.fastq'), os.path.join(self.tmp, 'filtered_reverse.fastq')]
+        counts = filter_reads([[forward], [reverse]], outputs, bloom=self.bloom())
+        self.assertEqual((counts['reads'], counts['duplicates']), (3, 1))
+        self.assertEqual(self.read(outputs[0]), fastq([b'AAAA', b'AAAA']))
+        self.assertEqual(self.read(outputs[1]), fastq([b'TTTT', b'GGGG']))
+
+    def test_mates_out_of_step(self):
+        forward = self.write('f.fastq', fastq([b'AAAA', b'CCCC']))
+        reverse = self.write('r.fastq', fastq([b'TTTT']))
+        outputs = [os.path.join(self.tmp, 'f_out'), os.path.join(self.tmp, 'r_out')]
+        self.assertRaises(ValueError, filter_reads, [[forward], [reverse]], outputs, self.bloom())
+        self.assertRaises(ValueError, filter_reads, [[reverse], [forward]], outputs, self.bloom())
+
+    def test_sampling_keeps_pairs(self):
+        sequences = [b'ACGT'] * 2000
+        forward = self.write('f.fastq', fastq(sequences, suffix='/1'))
+        reverse = self.write('r.fastq', fastq(sequences, suffix='/2'))
+        outputs = [os.path.join(self.tmp, 'f_out'), os.path.join(self.tmp, 'r_out')]
+        counts = filter_reads([[forward], [reverse]], outputs, sampler=HashSampler(0.25))
+        self.assertEqual(counts['reads'], 2000)
+        self.assertEqual(counts['kept'] + counts['sampled_out'], 2000)
+        self.assertTrue(400 < counts['kept'] < 600)
+        names = [[line[:-2] for line in self.read(path).split(b'\n')[0::4] if line] for path in outputs]
+        self.assertEqual(names[0], names[1])
+        # the same subset every run
+        again = filter_reads([[forward], [reverse]], outputs, sampler=HashSampler(0.25))
+        self.assertEqual(again, counts)
+
+    def test_record_path_matches_batches(self):
+        sequences = [b'ACGT', b'CCCC', b'ACGT', b'GG'] * 500
+        forward = self.write('f.fastq.gz', fastq(sequences, suffix='/1'), compress=True)
+        reverse = self.write('r.fastq', fastq(sequences[::-1], suffix='/2'))
+        results = []
+        load_readbatch = readfilter.load_readbatch
+        for loader in (load_readbatch, lambda: None):
+            readfilter.load_readbatch = loader
+            try:
+                outputs = [os.path.join(self.tmp, 'f_out'), os.path.join(self.tmp, 'r_out')]
+                counts = filter_reads([[forward], [reverse]], outputs, bloom=self.bloom(),
+                                      sampler=HashSampler(0.5))
+            finally:
+                readfilter.load_readbatch = load_readbatch
+            results.append((counts, [self.read(path) for path in outputs]))
+        self.assertEqual(results[0], results[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
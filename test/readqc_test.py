@@ -0,0 +1,53 @@
+import unittest
+import gzip
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+try:
+    from kb_trimmomatic import readqc
+except ImportError:
+    readqc = None
+
+
+@unittest.skipIf(readqc is None, 'numpy is not installed')
+class ReadQCTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_accumulates_over_batches(self):
+        path = os.path.join(self.tmp, 'reads.fastq.gz')
+        with gzip.open(path, 'wb') as out:
+            out.write(b'@r1\nACGTN\n+\nIIII#\n@r2\nGGC\n+\n5I+\n@r3\nAAAAAA\n+\nIIIIII\n')
+        summary = readqc.ReadQC(max_length=5).add_file(path, block_size=20).summary()
+
+        self.assertEqual(summary['reads'], 3)
+        self.assertEqual(summary['bases'], 14)
+        # the 6 base read is folded into the last length bin and position
+        self.assertEqual(summary['length_histogram'], [0, 0, 0, 1, 0, 2])
+        self.assertEqual(summary['base_composition']['G'][0], round(1.0 / 3, 4))
+        self.assertEqual(summary['quality_quantiles']['p50'][0], 40)
+        self.assertEqual(summary['quality_quantiles']['p10'][0], 20)
+        self.assertAlmostEqual(summary['n_fraction'], 1.0 / 14, places=5)
+        html = readqc.format_html([('input', summary)])
+        self.assertIn('<td>input</td><td>3</td>', html)
+
+    def test_pool_matches_serial(self):
+        path = os.path.join(self.tmp, 'reads.fastq')
+        with open(path, 'wb') as out:
+            for i in range(200):
+                out.write(b'@r%d\n%s\n+\n%s\n' % (i, b'ACGGT'[:i % 5 + 1], b'I5+#A'[:i % 5 + 1]))
+        serial = readqc.qc_files([path, path])
+        pool = multiprocessing.Pool(2)
+        try:
+            parallel = readqc.qc_files([path, path], pool=pool)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(parallel.summary(), serial.summary())
+        self.assertEqual(serial.reads, 400)
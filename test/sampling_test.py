@@ -0,0 +1,46 @@
+import unittest
+
+from kb_trimmomatic.sampling import HashSampler, describe, fraction, read_name
+
+
+class SamplingTest(unittest.TestCase):
+
+    def test_read_name(self):
+        self.assertEqual(read_name(b'@read1/1\n'), b'read1')
+        self.assertEqual(read_name(b'@M0:1:FC:1:1:100:200 1:N:0:ACGT\n'), b'M0:1:FC:1:1:100:200')
+
+    def test_mates_sampled_alike(self):
+        sampler = HashSampler(0.5)
+        for i in range(200):
+            self.assertEqual(sampler.keep(('@r%d/1\n' % i).encode('ascii')),
+                             sampler.keep(('@r%d 2:N:0\n' % i).encode('ascii')))
+
+    def test_nested_subsets(self):
+        names = [('@r%d\n' % i).encode('ascii') for i in range(1000)]
+        small = set(name for name in names if HashSampler(0.1).keep(name))
+        large = set(name for name in names if HashSampler(0.3).keep(name))
+        self.assertTrue(small < large)
+
+    def test_fraction(self):
+        self.assertEqual(fraction({}, 1000, 300), (None, None))
+        self.assertEqual(fraction({'downsample_fraction': '0.2'}, 0, 0), (0.2, None))
+        self.assertEqual(fraction({'downsample_reads': 250}, 1000, 300), (0.25, 250))
+        self.assertEqual(fraction({'downsample_reads': 5000}, 1000, 300), (1.0, 5000))
+        # 100x of 3 kb with 300 bases per pair is 1000 pairs
+        self.assertEqual(fraction({'downsample_coverage': 100, 'genome_size': 3000}, 4000, 300), (0.25, 1000))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, fraction, {'downsample_fraction': 1.5}, 0, 0)
+        self.assertRaises(ValueError, fraction, {'downsample_fraction': -1}, 0, 0)
+        self.assertRaises(ValueError, fraction, {'downsample_reads': 'many'}, 1000, 300)
+        self.assertRaises(ValueError, fraction, {'downsample_reads': 10, 'downsample_fraction': 0.1}, 1000, 300)
+        self.assertRaises(ValueError, fraction, {'downsample_coverage': 100}, 1000, 300)
+        self.assertRaises(ValueError, fraction, {'downsample_reads': 10}, 0, 300)
+
+    def test_describe(self):
+        line = describe({'reads': 1000, 'sampled_out': 750, 'paired': True, 'fraction': 0.25, 'target': 250})
+        self.assertEqual(line, 'Downsampled to 250 of 1000 read pairs (fraction 0.25), aiming at 250')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import unittest
+import gzip
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from kb_trimmomatic import scatter
+from kb_trimmomatic.scatter import Coordinator, ShardFailed, WorkQueue, gather, split_shards
+
+
+def records(prefix, count):
+    return ''.join('@%s%d\nACGT\n+\nIIII\n' % (prefix, number) for number in range(count))
+
+
+# stands in for java -jar trimmomatic.jar SE -threads N -phred33 in out steps:
+# copies the input, prints its name and fails on a FAIL step
+FAKE_JAVA = '''#!%s
+import shutil, sys
+args = sys.argv[1:]
+inputs = args[6:7]
+shutil.copyfile(inputs[0], args[7])
+print('trimmed ' + inputs[0].split('/')[-1])
+sys.exit(3 if 'FAIL:1' in args[8:] else 0)
+'''
+
+
+class ScatterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.environ['PATH']
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.work_dir)
+
+    def fake_java(self):
+        bin_dir = os.path.join(self.work_dir, 'bin')
+        os.mkdir(bin_dir)
+        java = os.path.join(bin_dir, 'java')
+        with open(java, 'w') as f:
+            f.write(FAKE_JAVA % sys.executable)
+        os.chmod(java, stat.S_IRWXU)
+        os.environ['PATH'] = bin_dir + os.pathsep + self.path
+
+    def shard_tasks(self, queue, count, steps=('MINLEN:36',)):
+        shard_dir = queue.shard_dir('job')
+        os.makedirs(shard_dir)
+        tasks = []
+        for number in range(count):
+            path = os.path.join(shard_dir, 'in_%d.fastq' % number)
+            with open(path, 'w') as f:
+                f.write(records('s%d_' % number, 2))
+            tasks.append({'read_type': 'SE', 'quality_encoding': 'phred33', 'threads': 1, 'inputs': [path],
+                          'outputs': [os.path.join(shard_dir, 'out_%d.fastq' % number)], 'steps': list(steps)})
+        return tasks
+
+    def write(self, name, text, compress=False):
+        path = os.path.join(self.work_dir, name)
+        with (gzip.open(path, 'wb') if compress else open(path, 'wb')) as f:
+            f.write(text.encode('ascii'))
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read().decode('ascii')
+
+    def test_split_single_end_across_files(self):
+        first = self.write('lane1.fastq', records('a', 3))
+        second = self.write('lane2.fastq.gz', records('b', 2), compress=True)
+        shards = split_shards([[first, second]], os.path.join(self.work_dir, 'shards'), reads_per_shard=2)
+        self.assertEqual([count for _, count in shards], [2, 2, 1])
+        self.assertEqual(''.join(self.read(paths[0]) for paths, _ in shards), records('a', 3) + records('b', 2))
+
+    def test_split_keeps_pairs_together(self):
+        forward = self.write('r1.fastq', records('f', 5))
+        reverse = self.write('r2.fastq', records('r', 5))
+        shards = split_shards([[forward], [reverse]], os.path.join(self.work_dir, 'shards'), reads_per_shard=3)
+        self.assertEqual([count for _, count in shards], [3, 2])
+        self.assertEqual(self.read(shards[1][0][0]), '@f3\nACGT\n+\nIIII\n@f4\nACGT\n+\nIIII\n')
+        self.assertEqual(self.read(shards[1][0][1]), '@r3\nACGT\n+\nIIII\n@r4\nACGT\n+\nIIII\n')
+
+    def test_split_rejects_unequal_directions(self):
+        forward = self.write('r1.fastq', records('f', 3))
+        reverse = self.write('r2.fastq', records('r', 2))
+        with self.assertRaises(ValueError):
+            split_shards([[forward], [reverse]], os.path.join(self.work_dir, 'shards'))
+
+    def test_gather_in_shard_order(self):
+        parts = [[self.write('s%d_a' % number, 'a%d\n' % number), self.write('s%d_b' % number, 'b%d\n' % number)]
+                 for number in range(3)]
+        outputs = [os.path.join(self.work_dir, 'a'), os.path.join(self.work_dir, 'b')]
+        gather(parts, outputs)
+        self.assertEqual(self.read(outputs[0]), 'a0\na1\na2\n')
+        self.assertEqual(self.read(outputs[1]), 'b0\nb1\nb2\n')
+
+    def test_claim_is_exclusive(self):
+        root = os.path.join(self.work_dir, 'queue')
+        queue = WorkQueue(root)
+        queue.publish({'id': 'job-00000', 'command': 'true'})
+        self.assertEqual(queue.claim()['id'], 'job-00000')
+        self.assertIsNone(WorkQueue(root).claim())
+
+    def test_lost_claims_are_published_again(self):
+        queue = WorkQueue(os.path.join(self.work_dir, 'queue'), lease=0)
+        queue.publish({'id': 'job-00000', 'command': 'true', 'attempt': 1})
+        queue.claim('job')
+        self.assertEqual(queue.requeue_stale('job', max_attempts=2), [])
+        self.assertEqual(queue.pending('job'), ['job-00000'])
+        queue.claim('job')
+        self.assertEqual(queue.requeue_stale('job', max_attempts=2), ['job-00000'])
+
+    def test_lease_runs_on_the_coordinators_clock(self):
+        queue = WorkQueue(os.path.join(self.work_dir, 'queue'), lease=0.5)
+        queue.publish({'id': 'job-00000', 'attempt': 1})
+        task = queue.claim('job')
+        # a worker or file server clock far behind does not expire the claim
+        os.utime(queue._path('claimed', 'job-00000'), (0, 0))
+        queue.requeue_stale('job')
+        time.sleep(0.3)
+        queue.heartbeat(task)
+        queue.requeue_stale('job')
+        time.sleep(0.3)
+        queue.requeue_stale('job')
+        self.assertEqual(queue.pending('job'), [])
+        time.sleep(0.3)
+        queue.requeue_stale('job')
+        self.assertEqual(queue.pending('job'), ['job-00000'])
+
+    def test_trimmomatic_args(self):
+        queue = WorkQueue(os.path.join(self.work_dir, 'queue'))
+        task = self.shard_tasks(queue, 1, steps=['ILLUMINACLIP:/kb/module/data/adapters/TruSeq3-SE.fa:2:30:10',
+                                                 'MINLEN:36'])[0]
+        args, outputs = scatter.trimmomatic_args(queue, dict(task, attempt=1), jar='t.jar', heap_mb=512)
+        self.assertEqual(args, ['java', '-Xmx512m', '-jar', 't.jar', 'SE', '-threads', '1', '-phred33'] +
+                         task['inputs'] + task['outputs'] + task['steps'])
+        _, outputs = scatter.trimmomatic_args(queue, dict(task, attempt=2))
+        self.assertEqual(os.path.basename(outputs[0]), 'retry2_out_0.fastq')
+        for bad in ({'steps': ['MINLEN:36; rm -rf /']}, {'steps': ['-trimlog']}, {'steps': []},
+                    {'outputs': [os.path.join(self.work_dir, 'elsewhere.fastq')]},
+                    {'inputs': [os.path.join(queue.root, 'shards', '..', 'tasks', 'x')]},
+                    {'read_type': 'PE'}, {'quality_encoding': 'phred99'}, {'threads': '2 && true'},
+                    {'command': 'true', 'read_type': None}):
+            with self.assertRaises(ValueError):
+                scatter.trimmomatic_args(queue, dict(task, **bad))
+
+    def test_coordinator_with_local_workers(self):
+        self.fake_java()
+        queue = WorkQueue(os.path.join(self.work_dir, 'queue'))
+        done = []
+        coordinator = Coordinator(queue, 'job', local_workers=3, poll=0.01, timeout=60)
+        tasks = self.shard_tasks(queue, 7)
+        results = coordinator.run(tasks, progress=done.append)
+        self.assertEqual([result['output'] for result in results],
+                         [['trimmed in_%d.fastq' % number] for number in range(7)])
+        self.assertEqual([result['outputs'] for result in results], [task['outputs'] for task in tasks])
+        self.assertEqual(self.read(results[4]['outputs'][0]), records('s4_', 2))
+        self.assertEqual(done[-1], 7)
+        self.assertEqual(queue.results('job'), {})
+
+    def test_failed_shard(self):
+        self.fake_java()
+        queue = WorkQueue(os.path.join(self.work_dir, 'queue'))
+        coordinator = Coordinator(queue, 'job', local_workers=1, poll=0.01, timeout=60)
+        tasks = self.shard_tasks(queue, 2)
+        tasks[1]['steps'] = ['FAIL:1']
+        with self.assertRaises(ShardFailed):
+            coordinator.run(tasks)
+
+    def test_worker_exits_when_idle(self):
+        root = os.path.join(self.work_dir, 'queue')
+        WorkQueue(root).publish({'id': 'other-00000', 'command': 'true'})
+        self.assertEqual(scatter.run_worker(root, exit_when_idle=True), 1)
+        # a task that is no trimming is never run
+        self.assertEqual(WorkQueue(root).results('other')['other-00000']['returncode'], -1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+import gzip
+import io
+
+from kb_trimmomatic.sniffer import SniffResult, check_plan
+
+
+def fastq(names, quality='I'):
+    return ''.join('@%s\nACGTACGT\n+\n%s\n' % (name, quality * 8) for name in names).encode('ascii')
+
+
+def gzipped(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as out:
+        out.write(data)
+    return buf.getvalue()
+
+
+class SnifferTest(unittest.TestCase):
+
+    def test_truncated_gzip_interleaved_sample(self):
+        data = gzipped(fastq(['r%d/%d' % (i // 2, i % 2 + 1) for i in range(100)], quality='5'))
+        result = SniffResult(data[:len(data) - 10])
+        self.assertEqual(result.compression, 'gzip')
+        self.assertEqual(result.quality_offset, 33)
+        self.assertTrue(result.interleaved)
+        self.assertEqual(result.length_max, 8)
+
+    def test_plan_corrects_encoding(self):
+        params = {'read_type': 'SE', 'quality_encoding': 'phred33'}
+        notes = check_plan(params, SniffResult(fastq(['a', 'b', 'c', 'd'], quality='h')))
+        self.assertEqual(params['quality_encoding'], 'phred64')
+        self.assertIn('changed', notes[-1])
+
+    def test_plan_rejects_mislabelled_layouts(self):
+        interleaved = SniffResult(fastq(['r1 1:N:0', 'r1 2:N:0', 'r2 1:N:0', 'r2 2:N:0']))
+        self.assertRaises(ValueError, check_plan,
+                          {'read_type': 'SE', 'quality_encoding': 'phred33'}, interleaved)
+        single = SniffResult(fastq(['a', 'b', 'c', 'd']))
+        self.assertRaises(ValueError, check_plan,
+                          {'read_type': 'PE', 'quality_encoding': 'phred33'}, single)
+        self.assertRaises(ValueError, check_plan,
+                          {'read_type': 'PE', 'quality_encoding': 'phred33'},
+                          SniffResult(fastq(['a/1', 'b/1'])), SniffResult(fastq(['b/2', 'a/2'])))
+        self.assertRaises(ValueError, SniffResult, b'>contig\nACGT\n>x\nAC\n\n')
@@ -0,0 +1,109 @@
+import unittest
+import gzip
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark'))
+
+from kb_trimmomatic.streaming import RecordCounter, ShockStreamUpload, UploadGroup, shock_handle
+from stub_services import StubServices
+
+try:
+    from kb_trimmomatic import readqc
+except ImportError:
+    readqc = None
+
+READS = b'@r1\nACGTN\n+\nIIII#\n@r2\nGGC\n+\n5I+\n@r3\nAAAAAA\n+\nIIIIII\n'
+
+
+def gzipped(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as out:
+        out.write(data)
+    return buf.getvalue()
+
+
+class RecordCounterTest(unittest.TestCase):
+
+    def test_counts_across_chunk_boundaries(self):
+        counter = RecordCounter()
+        for i in range(0, len(READS), 7):
+            counter.feed(READS[i:i + 7])
+        counter.close()
+        self.assertEqual(counter.reads, 3)
+        self.assertEqual(counter.bytes, len(READS))
+
+    def test_gzip_and_missing_final_newline(self):
+        data = gzipped(READS[:-1])
+        counter = RecordCounter()
+        for i in range(0, len(data), 5):
+            counter.feed(data[i:i + 5])
+        counter.close()
+        self.assertEqual(counter.reads, 3)
+        self.assertEqual(counter.bytes, len(data))
+
+    @unittest.skipIf(readqc is None, 'numpy is not installed')
+    def test_feeds_read_qc(self):
+        counter = RecordCounter(readqc.ReadQC(max_length=5), batch_size=1)
+        for i in range(0, len(READS), 11):
+            counter.feed(READS[i:i + 11])
+        counter.close()
+        summary = counter.qc.summary()
+        self.assertEqual(summary['reads'], 3)
+        self.assertEqual(summary['bases'], 14)
+
+
+class ShockStreamUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.services = StubServices(os.path.join(self.tmp, 'shock'))
+        self.services.start()
+
+    def tearDown(self):
+        self.services.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_uploads_while_written(self):
+        shock_url = self.services.shock.url
+        paths = [os.path.join(self.tmp, name) for name in ('paired.fastq', 'unpaired.fastq.gz')]
+        uploads = [ShockStreamUpload(paths[0], shock_url, {}, 'paired.fastq', chunk_size=16),
+                   ShockStreamUpload(paths[1], shock_url, {}, 'unpaired.fastq.gz')]
+        with UploadGroup(uploads):
+            # what trimmomatic would do: open the outputs in order and write them
+            with open(paths[0], 'wb') as paired:
+                with open(paths[1], 'wb') as unpaired:
+                    paired.write(READS)
+                    unpaired.write(gzipped(READS[:17]))
+
+        self.assertEqual([upload.counter.reads for upload in uploads], [3, 1])
+        self.assertFalse(os.path.exists(paths[0]))
+        node = self.services.shock.nodes[uploads[0].node['id']]
+        with open(node['path'], 'rb') as f:
+            self.assertEqual(f.read(), READS)
+        self.assertEqual(node['name'], 'paired.fastq')
+        handle = shock_handle(uploads[1].node, shock_url)
+        self.assertEqual((handle['type'], handle['url'], handle['file_name']),
+                         ('shock', shock_url, 'unpaired.fastq.gz'))
+
+    def test_failed_upload_does_not_block_the_writer(self):
+        path = os.path.join(self.tmp, 'trimmed.fastq')
+        # nothing listens on port 1
+        upload = ShockStreamUpload(path, 'http://127.0.0.1:1', {}, 'trimmed.fastq')
+        try:
+            with upload:
+                with open(path, 'wb') as out:
+                    for _ in range(2000):
+                        out.write(READS)
+        except Exception:
+            pass
+        else:
+            self.fail('the upload error was not raised')
+        self.assertIsNotNone(upload.error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import os
+import shutil
+import subprocess
+import tempfile
+
+from kb_trimmomatic.trimlog import TrimlogAggregator, TrimlogPipe
+
+
+PE_LOG = """\
+read1/1 100 0 100 0
+read1/2 90 2 92 8
+read2 extra/1 0 0 0 0
+read2 extra/2 80 0 80 20
+read3/1 0 0 0 0
+read3/2 0 0 0 0
+"""
+
+
+class TrimlogTest(unittest.TestCase):
+
+    def test_paired_categories_and_histograms(self):
+        aggregator = TrimlogAggregator(paired=True, max_length=95)
+        for line in PE_LOG.splitlines():
+            aggregator.add_line(line)
+        summary = aggregator.summary()
+        self.assertEqual(summary['categories'], {'input_read_pairs': 3, 'both_surviving': 1,
+                                                 'forward_only_surviving': 0,
+                                                 'reverse_only_surviving': 1, 'dropped': 1})
+        # 100 is above the cap and counted in the last bin
+        self.assertEqual(summary['surviving_length_histogram'][95], 1)
+        self.assertEqual(summary['surviving_length_histogram'][0], 3)
+        self.assertEqual(summary['leading_cut_histogram'], [5, 0, 1])
+        self.assertEqual(summary['trailing_cut_histogram'][20], 1)
+
+    def test_single_end_through_pipe(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            aggregator = TrimlogAggregator(paired=False)
+            with TrimlogPipe(os.path.join(tmp, 'trimlog.fifo'), aggregator) as pipe:
+                subprocess.check_call('printf "a 10 0 10 0\\nb 0 0 0 0\\nbroken\\n" > ' + pipe.path,
+                                      shell=True)
+            self.assertEqual(aggregator.categories, {'input_reads': 2, 'surviving': 1, 'dropped': 1})
+            self.assertEqual(aggregator.malformed_lines, 1)
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'trimlog.fifo')))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_pipe_never_opened(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            aggregator = TrimlogAggregator(paired=False)
+            with TrimlogPipe(os.path.join(tmp, 'trimlog.fifo'), aggregator):
+                pass
+            self.assertEqual(aggregator.reads, 0)
+        finally:
+            shutil.rmtree(tmp)
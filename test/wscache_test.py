@@ -0,0 +1,73 @@
+import unittest
+
+from kb_trimmomatic.wscache import TTLCache, get_read_library, LIBRARY_PATHS
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeWorkspace(object):
+
+    def __init__(self):
+        self.version = 1
+        self.calls = []
+
+    def get_object_info_new(self, params):
+        self.calls.append(('get_object_info_new', params))
+        return [[7, 'reads', 'KBaseFile.PairedEndLibrary-2.0', '', self.version, 'u', 3, 'ws', '', 0, {}]]
+
+    def get_object_subset(self, specs):
+        self.calls.append(('get_object_subset', specs))
+        return [{'data': {'lib1': {'file': {'id': 'node'}, 'type': 'fq'}, 'interleaved': 1},
+                 'info': None}]
+
+
+class WorkspaceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = TTLCache(ttl=60, clock=self.clock)
+        self.ws = FakeWorkspace()
+
+    def test_subset_requested_by_exact_reference(self):
+        library = get_read_library(self.ws, self.cache, 'alice', 'ws', 'reads')
+        self.assertEqual(library['data']['interleaved'], 1)
+        self.assertEqual(self.ws.calls[1], ('get_object_subset', [{'ref': '3/7/1', 'included': LIBRARY_PATHS}]))
+
+    def test_repeated_lookups_hit_the_cache(self):
+        get_read_library(self.ws, self.cache, 'alice', 'ws', 'reads')
+        get_read_library(self.ws, self.cache, 'alice', 'ws', 'reads')
+        self.assertEqual(len(self.ws.calls), 2)
+        # other users fetch for themselves
+        get_read_library(self.ws, self.cache, 'bob', 'ws', 'reads')
+        self.assertEqual(len(self.ws.calls), 4)
+
+    def test_new_version_seen_after_expiry(self):
+        get_read_library(self.ws, self.cache, 'alice', 'ws', 'reads')
+        self.ws.version = 2
+        self.clock.now += 61
+        library = get_read_library(self.ws, self.cache, 'alice', 'ws', 'reads')
+        self.assertEqual(library['info'][4], 2)
+        self.assertEqual(self.ws.calls[-1][1][0]['ref'], '3/7/2')
+
+    def test_bounded(self):
+        cache = TTLCache(ttl=60, max_entries=2, clock=self.clock)
+        for key in 'abc':
+            cache.put(key, key)
+            self.clock.now += 1
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), 'c')
+        disabled = TTLCache(ttl=0)
+        disabled.put('a', 1)
+        self.assertIsNone(disabled.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()